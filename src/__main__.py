@@ -1,6 +1,11 @@
+from cpu import CPU
 from events import Events
 from graphics import Graphics
+from lcd import LCD
+from localcore import LocalCore
 from mmu import MMU
+from numbacore import numba_core
+from recompiler import Recompiler
 import sys
 from timeit import default_timer as timer
 
@@ -14,6 +19,15 @@ PREFS = {
         'debug_perf': True
         }
 
+# Execution cores, picked by the optional second argument. Each runs the
+# same CPU object, so they can be swapped between frames.
+CORES = {
+        'tick': lambda cpu: cpu,
+        'local': LocalCore,
+        'recompiler': Recompiler,
+        'numba': numba_core
+        }
+
 def load_rom(filepath):
     fh = open(filepath, 'rb')
     data = fh.read()
@@ -33,6 +47,19 @@ def run():
     # Initialise MMU - Memory controller
     mmu = MMU(rom_file)
 
+    # Initialise CPU
+    cpu = CPU(mmu)
+
+    # Pick the execution core
+    core_name = sys.argv[2] if len(sys.argv) > 2 else 'tick'
+    if core_name not in CORES:
+        print('Unknown core ' + core_name + ', choose from ' + ', '.join(CORES))
+        return 1
+    core = CORES[core_name](cpu)
+
+    # Initialise LCD timing
+    lcd = LCD(mmu, cpu.scheduler)
+
     # Initialise the graphics module
     gfx = Graphics(GB_PARAMS)
 
@@ -56,6 +83,9 @@ def run():
             running = False
             break
 
+        # Emulate one frame's worth of cycles
+        core.run_frame()
+
         # Render frame
         gfx.draw(test_pattern)
 
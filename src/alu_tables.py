@@ -0,0 +1,79 @@
+import os
+from array import array
+
+## Precomputed 8-bit ALU results
+# Each entry packs (flags << 8) | result, flags being the Z/N/H/C bits of F.
+# ADD and SUB are indexed by (carry << 16) | (a << 8) | b, the logical ops
+# by (a << 8) | b. ADC/SBC are ADD/SUB with the carry bit set, CP is SUB
+# with the result thrown away.
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alu_tables.bin')
+
+# Order and size of the tables in the file
+TABLES = [
+    ('ADD', 0x20000),
+    ('SUB', 0x20000),
+    ('AND', 0x10000),
+    ('XOR', 0x10000),
+    ('OR', 0x10000)
+]
+
+def add_entry(a, b, c):
+    total = a + b + c
+    flags = ((0x80 if (total & 0xFF) == 0 else 0x00)
+        | (0x20 if (a & 0x0F) + (b & 0x0F) + c > 0x0F else 0x00)
+        | (0x10 if total > 0xFF else 0x00))
+    return (flags << 8) | (total & 0xFF)
+
+def sub_entry(a, b, c):
+    total = a - b - c
+    flags = ((0x80 if (total & 0xFF) == 0 else 0x00)
+        | 0x40
+        | (0x20 if (a & 0x0F) < (b & 0x0F) + c else 0x00)
+        | (0x10 if total < 0 else 0x00))
+    return (flags << 8) | (total & 0xFF)
+
+def logic_entry(result, h):
+    return ((0x80 if result == 0 else 0x00) | h) << 8 | result
+
+def build_tables():
+    tables = {
+        'ADD': array('H', [add_entry(a, b, c) for c in range(2) for a in range(0x100) for b in range(0x100)]),
+        'SUB': array('H', [sub_entry(a, b, c) for c in range(2) for a in range(0x100) for b in range(0x100)]),
+        'AND': array('H', [logic_entry(a & b, 0x20) for a in range(0x100) for b in range(0x100)]),
+        'XOR': array('H', [logic_entry(a ^ b, 0x00) for a in range(0x100) for b in range(0x100)]),
+        'OR': array('H', [logic_entry(a | b, 0x00) for a in range(0x100) for b in range(0x100)])
+    }
+    return tables
+
+def save_tables(tables, path = TABLE_PATH):
+    with open(path, 'wb') as fh:
+        for name, size in TABLES:
+            tables[name].tofile(fh)
+
+def read_tables(path = TABLE_PATH):
+    tables = {}
+    with open(path, 'rb') as fh:
+        for name, size in TABLES:
+            tables[name] = array('H')
+            tables[name].fromfile(fh, size)
+    return tables
+
+_tables = None
+
+def load_tables(path = TABLE_PATH):
+    # Built on first use and cached on disk, later runs just read the file
+    global _tables
+    if (_tables is not None):
+        return _tables
+
+    try:
+        _tables = read_tables(path)
+    except (OSError, EOFError):
+        _tables = build_tables()
+        try:
+            save_tables(_tables, path)
+        except OSError:
+            pass
+
+    return _tables
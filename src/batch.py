@@ -0,0 +1,672 @@
+import numpy as np
+from functools import partial
+from cpu import REG_B, REG_C, REG_D, REG_E, REG_H, REG_L, REG_F, REG_A
+from cycles import CLOCKS, CB_CLOCKS, BRANCH_CLOCKS, INTERRUPT_CLOCKS, FRAME_CLOCKS
+from interrupts import PRIORITY, EI_DELAY
+from lcd import LINE_CLOCKS, LINES, VBLANK_LINE
+from interrupts import VBLANK
+
+## Batched CPU
+# Runs N instances of one ROM in lockstep, for RL training and search. All
+# state lives in NumPy arrays with one row per instance: N x 8 registers in
+# the CPU.regs order, N x 64K of memory and N-long SP, PC, clock and
+# interrupt arrays. Each step fetches an opcode for every running instance
+# and groups the instances by opcode, so each group runs as one vectorised
+# handler over its row indices.
+#
+# Follows CPU, quirks included, with a flat memory map: ROM writes are
+# dropped, no bank switching, and IF/IE and LY (updated from the clock the
+# same way LCD does) live in memory. P1 (0xFF00) reads come from the
+# buttons passed to step_frames.
+
+SCREEN_WIDTH = 160
+SCREEN_HEIGHT = 144
+
+# Bits of an action, clear in P1 when pressed. The high nibble is read with
+# P1 bit 5 low, the low nibble with bit 4 low.
+RIGHT = 0x01
+LEFT = 0x02
+UP = 0x04
+DOWN = 0x08
+BUTTON_A = 0x10
+BUTTON_B = 0x20
+SELECT = 0x40
+START = 0x80
+
+# Acknowledge bit and handler address for each pending mask, see PRIORITY
+ACK = np.array([0] + [bit for bit, vector in PRIORITY[1:]])
+VECTORS = np.array([0] + [vector for bit, vector in PRIORITY[1:]])
+
+# Condition codes for JP/JR/CALL/RET cc, as (flag bit, value when taken)
+CONDITIONS = [(0x80, 0), (0x80, 0x80), (0x10, 0), (0x10, 0x10)]
+
+## CB-prefixed rotates & shifts on arrays, as cpu.RLC and friends
+
+def RLC(val, c):
+    return ((val << 1) | (val >> 7)) & 0xFF, val >> 7
+
+def RRC(val, c):
+    return (val >> 1) | ((val & 0x01) << 7), val & 0x01
+
+def RL(val, c):
+    return ((val << 1) | c) & 0xFF, val >> 7
+
+def RR(val, c):
+    return (val >> 1) | (c << 7), val & 0x01
+
+def SLA(val, c):
+    return (val << 1) & 0xFF, val >> 7
+
+def SRA(val, c):
+    return (val >> 1) | (val & 0x80), val & 0x01
+
+def SWAP(val, c):
+    return ((val & 0x0F) << 4) | (val >> 4), val & 0
+
+def SRL(val, c):
+    return val >> 1, val & 0x01
+
+def zero(val):
+    # Z bit for each value
+    return (val == 0) * 0x80
+
+class BatchCPU:
+    def __init__(self, rom_file, n):
+        self.n = n
+        self.memory = np.zeros((n, 0x10000), dtype=np.uint8)
+        self.memory[:, :0x8000] = np.asarray(rom_file, dtype=np.uint8)[:0x8000]
+
+        self.regs = np.zeros((n, 8), dtype=np.int64)
+        self.sp = np.full(n, 0xFFFE, dtype=np.int64)
+        self.pc = np.full(n, 0x0100, dtype=np.int64)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        # Where the current frame ends, HALT may skip up to here
+        self.cycle_target = np.zeros(n, dtype=np.int64)
+        self.halted = np.zeros(n, dtype=bool)
+
+        # As InterruptController, IF and IE are in memory
+        self.ime = np.zeros(n, dtype=bool)
+        self.ei_delay = np.zeros(n, dtype=np.int64)
+
+        # LCD lines run so far, LY is this modulo LINES
+        self.lines = np.zeros(n, dtype=np.int64)
+        self.buttons = np.zeros(n, dtype=np.int64)
+
+        self.opcodes = self.build_opcode_table()
+        self.cb_opcodes = self.build_cb_table()
+
+    # Memory access for the instances in i, addr and val are arrays
+    # matching i
+
+    def read(self, i, addr):
+        val = self.memory[i, addr].astype(np.int64)
+        p1 = addr == 0xFF00
+        if (p1.any()):
+            val[p1] = self.read_p1(i[p1], val[p1])
+        return val
+
+    def read_p1(self, i, p1):
+        pressed = self.buttons[i]
+        pressed = np.where(p1 & 0x10, 0, pressed & 0x0F) | np.where(p1 & 0x20, 0, pressed >> 4)
+        return (p1 & 0x30) | 0xC0 | (0x0F & ~pressed)
+
+    def write(self, i, addr, val):
+        ram = addr >= 0x8000
+        if (not ram.all()):
+            i, addr, val = i[ram], addr[ram], val[ram]
+        self.memory[i, addr] = val
+
+    def fetch_8(self, i):
+        pc = self.pc[i]
+        self.pc[i] = pc + 1
+        return self.read(i, pc)
+
+    def fetch_16(self, i):
+        pc = self.pc[i]
+        self.pc[i] = pc + 2
+        return self.read(i, pc) | (self.read(i, pc + 1) << 8)
+
+    def get_pair(self, i, hi, lo):
+        return (self.regs[i, hi] << 8) | self.regs[i, lo]
+
+    def set_pair(self, i, hi, lo, val):
+        self.regs[i, hi] = (val >> 8) & 0xFF
+        self.regs[i, lo] = val & 0xFF
+
+    def push_stack(self, i, val):
+        sp = self.sp[i]
+        self.write(i, sp - 1, (val >> 8) & 0xFF)
+        self.write(i, sp - 2, val & 0xFF)
+        self.sp[i] = sp - 2
+
+    def pop_stack(self, i):
+        sp = self.sp[i]
+        self.sp[i] = sp + 2
+        return self.read(i, sp) | (self.read(i, sp + 1) << 8)
+
+    def taken(self, i, cond):
+        flag, val = cond
+        return (self.regs[i, REG_F] & flag) == val
+
+    ## Running
+
+    def step(self, i):
+        # One instruction on each instance in i
+        pc = self.pc[i]
+        ops = self.memory[i, pc]
+        self.pc[i] = pc + 1
+
+        order = np.argsort(ops, kind='stable')
+        ops = ops[order]
+        groups, starts = np.unique(ops, return_index=True)
+        for op, group in zip(groups, np.split(i[order], starts[1:])):
+            self.opcodes[op](group)
+            self.cycles[group] += CLOCKS[op]
+
+        self.run_lcd(i)
+        self.handle_interrupts(i)
+
+    def run_lcd(self, i):
+        # Lines ended since the last step, as LCD.end_line does through the
+        # scheduler
+        lines = self.cycles[i] // LINE_CLOCKS
+        done = self.lines[i]
+        ended = lines > done
+        if (not ended.any()):
+            return
+        i, lines, done = i[ended], lines[ended], done[ended]
+        self.lines[i] = lines
+        self.memory[i, 0xFF44] = lines % LINES
+
+        # Any line numbered VBLANK_LINE in (done, lines]
+        vblank = (lines - VBLANK_LINE) // LINES > (done - VBLANK_LINE) // LINES
+        self.memory[i[vblank], 0xFF0F] |= VBLANK
+
+    def pending(self, i):
+        return self.memory[i, 0xFF0F] & self.memory[i, 0xFFFF] & 0x1F
+
+    def handle_interrupts(self, i):
+        # As CPU.handle_interrupts with InterruptController.dispatch
+        pending = self.pending(i)
+        ready = (self.ime[i] & (pending != 0)) | (self.ei_delay[i] != 0)
+        if (not ready.any()):
+            return
+        i, pending = i[ready], pending[ready]
+
+        delay = self.ei_delay[i]
+        self.ei_delay[i] = np.maximum(delay - 1, 0)
+        self.ime[i] |= delay == 1
+
+        take = self.ime[i] & (pending != 0)
+        i, pending = i[take], pending[take]
+        if (not len(i)):
+            return
+        self.memory[i, 0xFF0F] &= (~ACK[pending] & 0xFF).astype(np.uint8)
+        self.ime[i] = False
+
+        # Return to the instruction after HALT
+        self.pc[i] += self.halted[i]
+        self.halted[i] = False
+        self.push_stack(i, self.pc[i])
+        self.pc[i] = VECTORS[pending]
+        self.cycles[i] += INTERRUPT_CLOCKS
+
+    def run_frame(self):
+        # Runs every instance up to its next frame boundary
+        self.cycle_target = self.cycles + (FRAME_CLOCKS - self.cycles % FRAME_CLOCKS)
+        while (True):
+            running = np.flatnonzero(self.cycles < self.cycle_target)
+            if (not len(running)):
+                break
+            self.step(running)
+
+    def step_frames(self, actions):
+        # Runs a frame per row of actions, each row holding every
+        # instance's buttons. Returns the frames as (frames, N, 144, 160)
+        # shades, or (N, 144, 160) for a single row.
+        actions = np.asarray(actions)
+        frames = []
+        for row in np.atleast_2d(actions):
+            self.buttons[:] = row
+            self.run_frame()
+            frames.append(self.render())
+        frames = np.stack(frames)
+        return frames if actions.ndim > 1 else frames[0]
+
+    def render(self):
+        # Background layer of every instance as shades 0-3
+        memory = self.memory
+        n = np.arange(self.n)[:, None, None]
+        lcdc = memory[:, 0xFF40].astype(np.int64)[:, None, None]
+        y = (np.arange(SCREEN_HEIGHT)[None, :, None] + memory[:, 0xFF42].astype(np.int64)[:, None, None]) & 0xFF
+        x = (np.arange(SCREEN_WIDTH)[None, None, :] + memory[:, 0xFF43].astype(np.int64)[:, None, None]) & 0xFF
+
+        tile = memory[n, np.where(lcdc & 0x08, 0x9C00, 0x9800) + (y >> 3) * 32 + (x >> 3)].astype(np.int64)
+        base = np.where(lcdc & 0x10, 0x8000 + tile * 16, 0x9000 + ((tile ^ 0x80) - 0x80) * 16) + (y & 0x07) * 2
+        bit = 7 - (x & 0x07)
+        colour = ((memory[n, base] >> bit) & 0x01) | (((memory[n, base + 1] >> bit) & 0x01) << 1)
+        shade = (memory[:, 0xFF47].astype(np.int64)[:, None, None] >> (colour * 2)) & 0x03
+
+        # LCD or background off
+        return np.where((lcdc & 0x81) == 0x81, shade, 0).astype(np.uint8)
+
+    def unknown_opcode(self, op, i):
+        raise NotImplementedError('Unknown opcode: ' + hex(op))
+
+    def build_opcode_table(self):
+        # Register order used by the opcode encoding, (HL) sits at index 6
+        regs = [REG_B, REG_C, REG_D, REG_E, REG_H, REG_L, None, REG_A]
+        pairs = [(REG_B, REG_C), (REG_D, REG_E), (REG_H, REG_L), (REG_A, REG_F)]
+        ops = [partial(self.unknown_opcode, op) for op in range(0x100)]
+
+        ## 8-bit loads
+        for i, r1 in enumerate(regs):
+            ops[0x06 | (i << 3)] = partial(self.LD_r_n, r1)
+            for j, r2 in enumerate(regs):
+                if (r1 is not None or r2 is not None):
+                    ops[0x40 | (i << 3) | j] = partial(self.LD_r1_r2, r1, r2)
+
+        for i, (hi, lo) in enumerate(pairs[:2]):
+            ops[0x0A | (i << 4)] = partial(self.LD_A_rr, hi, lo)
+            ops[0x02 | (i << 4)] = partial(self.LD_rr_A, hi, lo)
+        ops[0xFA] = self.LD_A_nn
+        ops[0xEA] = self.LD_nn_A
+        ops[0xF2] = self.LD_A_C
+        ops[0xE2] = self.LD_C_A
+        ops[0x2A] = partial(self.LD_A_HL_step, 1)
+        ops[0x3A] = partial(self.LD_A_HL_step, 0xFFFF)
+        ops[0x22] = partial(self.LD_HL_A_step, 1)
+        ops[0x32] = partial(self.LD_HL_A_step, 0xFFFF)
+        ops[0xE0] = self.LDH_n_A
+        ops[0xF0] = self.LDH_A_n
+
+        ## 16-bit loads
+        for i, (hi, lo) in enumerate(pairs[:3]):
+            ops[0x01 | (i << 4)] = partial(self.LD_n_nn, hi, lo)
+        ops[0x31] = self.LD_SP_nn
+        ops[0xF9] = self.LD_SP_HL
+        ops[0xF8] = self.LD_HL_SPn
+        ops[0x08] = self.LD_nn_SP
+
+        # Stack, POP AF keeps F's low nibble as CPU.POP_AF does
+        for i, (hi, lo) in enumerate(pairs):
+            ops[0xC5 | (i << 4)] = partial(self.PUSH_nn, hi, lo)
+            ops[0xC1 | (i << 4)] = partial(self.POP_nn, hi, lo)
+
+        ## 8-bit ALU
+        for i in range(8):
+            for j, r in enumerate(regs):
+                ops[0x80 | (i << 3) | j] = partial(self.ALU_r, i, r)
+            ops[0xC6 | (i << 3)] = partial(self.ALU_n, i)
+
+        for i, r in enumerate(regs):
+            ops[0x04 | (i << 3)] = partial(self.INC_r, r)
+            ops[0x05 | (i << 3)] = partial(self.DEC_r, r)
+
+        ## 16-bit ALU
+        for i, (hi, lo) in enumerate(pairs[:3]):
+            ops[0x09 | (i << 4)] = partial(self.ADD_HL_n, hi, lo)
+            ops[0x03 | (i << 4)] = partial(self.STEP_nn, hi, lo, 1)
+            ops[0x0B | (i << 4)] = partial(self.STEP_nn, hi, lo, 0xFFFF)
+        ops[0x39] = self.ADD_HL_SP
+        ops[0x33] = partial(self.STEP_SP, 1)
+        ops[0x3B] = partial(self.STEP_SP, 0xFFFF)
+        ops[0xE8] = self.ADD_SP_n
+
+        # Misc
+        ops[0x27] = self.DAA
+        ops[0x2F] = self.CPL
+        ops[0x3F] = self.CCF
+        ops[0x37] = self.SCF
+        ops[0x07] = self.RLCA
+        ops[0x17] = self.RLA
+        ops[0x0F] = self.RRCA
+        ops[0x1F] = self.RRA
+
+        # Control flow
+        ops[0x00] = self.NOP
+        ops[0x76] = self.HALT
+        ops[0x10] = self.STOP
+        ops[0xF3] = self.DI
+        ops[0xFB] = self.EI
+
+        ops[0xC3] = self.JP_nn
+        ops[0xE9] = self.JP_HL
+        ops[0x18] = self.JR_n
+        ops[0xCD] = self.CALL_nn
+        ops[0xC9] = self.RET
+        ops[0xD9] = self.RETI
+        for i, cond in enumerate(CONDITIONS):
+            ops[0xC2 | (i << 3)] = partial(self.JP_cc, cond, BRANCH_CLOCKS[0xC2 | (i << 3)])
+            ops[0x20 | (i << 3)] = partial(self.JR_cc, cond, BRANCH_CLOCKS[0x20 | (i << 3)])
+            ops[0xC4 | (i << 3)] = partial(self.CALL_cc, cond, BRANCH_CLOCKS[0xC4 | (i << 3)])
+            ops[0xC0 | (i << 3)] = partial(self.RET_cc, cond, BRANCH_CLOCKS[0xC0 | (i << 3)])
+        for n in range(0x00, 0x40, 0x08):
+            ops[0xC7 | n] = partial(self.RST, n)
+
+        ops[0xCB] = self.execute_cb
+
+        return ops
+
+    def build_cb_table(self):
+        regs = [REG_B, REG_C, REG_D, REG_E, REG_H, REG_L, None, REG_A]
+        shifts = [RLC, RRC, RL, RR, SLA, SRA, SWAP, SRL]
+        ops = []
+
+        for op in range(0x100):
+            r = regs[op & 0x07]
+            n = (op >> 3) & 0x07
+            if (op < 0x40):
+                ops.append(partial(self.CB_shift, shifts[n], r))
+            elif (op < 0x80):
+                ops.append(partial(self.BIT, 0x01 << n, r))
+            elif (op < 0xC0):
+                ops.append(partial(self.RES, 0x01 << n, r))
+            else:
+                ops.append(partial(self.SET, 0x01 << n, r))
+
+        return ops
+
+    ## Opcode handlers, each runs on the instances in i with pc past the
+    # opcode. r is None for (HL).
+
+    def get_r(self, i, r):
+        if (r is None):
+            return self.read(i, self.get_pair(i, REG_H, REG_L))
+        return self.regs[i, r]
+
+    def set_r(self, i, r, val):
+        if (r is None):
+            self.write(i, self.get_pair(i, REG_H, REG_L), val)
+        else:
+            self.regs[i, r] = val
+
+    def NOP(self, i):
+        pass
+
+    def LD_r_n(self, r, i):
+        self.set_r(i, r, self.fetch_8(i))
+
+    def LD_r1_r2(self, r1, r2, i):
+        self.set_r(i, r1, self.get_r(i, r2))
+
+    def LD_A_rr(self, hi, lo, i):
+        self.regs[i, REG_A] = self.read(i, self.get_pair(i, hi, lo))
+
+    def LD_rr_A(self, hi, lo, i):
+        self.write(i, self.get_pair(i, hi, lo), self.regs[i, REG_A])
+
+    def LD_A_nn(self, i):
+        self.regs[i, REG_A] = self.read(i, self.fetch_16(i))
+
+    def LD_nn_A(self, i):
+        self.write(i, self.fetch_16(i), self.regs[i, REG_A])
+
+    def LD_A_C(self, i):
+        self.regs[i, REG_A] = self.read(i, 0xFF00 + self.regs[i, REG_C])
+
+    def LD_C_A(self, i):
+        self.write(i, 0xFF00 + self.regs[i, REG_C], self.regs[i, REG_A])
+
+    def LD_A_HL_step(self, delta, i):
+        hl = self.get_pair(i, REG_H, REG_L)
+        self.regs[i, REG_A] = self.read(i, hl)
+        self.set_pair(i, REG_H, REG_L, (hl + delta) & 0xFFFF)
+
+    def LD_HL_A_step(self, delta, i):
+        hl = self.get_pair(i, REG_H, REG_L)
+        self.write(i, hl, self.regs[i, REG_A])
+        self.set_pair(i, REG_H, REG_L, (hl + delta) & 0xFFFF)
+
+    def LDH_n_A(self, i):
+        self.write(i, 0xFF00 + self.fetch_8(i), self.regs[i, REG_A])
+
+    def LDH_A_n(self, i):
+        self.regs[i, REG_A] = self.read(i, 0xFF00 + self.fetch_8(i))
+
+    def LD_n_nn(self, hi, lo, i):
+        self.set_pair(i, hi, lo, self.fetch_16(i))
+
+    def LD_SP_nn(self, i):
+        self.sp[i] = self.fetch_16(i)
+
+    def LD_SP_HL(self, i):
+        self.sp[i] = self.get_pair(i, REG_H, REG_L)
+
+    def LD_HL_SPn(self, i):
+        # add_16(n, SP), n unsigned
+        n = self.fetch_8(i)
+        self.set_pair(i, REG_H, REG_L, self.add_16(i, n, self.sp[i]))
+
+    def LD_nn_SP(self, i):
+        addr = self.fetch_16(i)
+        sp = self.sp[i]
+        self.write(i, addr, sp & 0xFF)
+        self.write(i, addr + 1, (sp >> 8) & 0xFF)
+
+    def PUSH_nn(self, hi, lo, i):
+        self.push_stack(i, self.get_pair(i, hi, lo))
+
+    def POP_nn(self, hi, lo, i):
+        self.set_pair(i, hi, lo, self.pop_stack(i))
+
+    def add_16(self, i, val1, val2):
+        # Flags as CPU.add_16, Z included
+        total = val1 + val2
+        f = self.regs[i, REG_F]
+        self.regs[i, REG_F] = ((f & 0x0F) | zero(total & 0xFFFF)
+            | ((val1 & 0xFFF) + (val2 & 0xFFF) > 0xFFF) * 0x20 | (total > 0xFFFF) * 0x10)
+        return total & 0xFFFF
+
+    def alu(self, k, i, x):
+        # 8-bit ALU op k (ADD, ADC, SUB, SBC, AND, XOR, OR, CP) on A and x,
+        # ADC and SBC carry in unconditionally as CPU's handlers do
+        regs = self.regs
+        a = regs[i, REG_A]
+        f = regs[i, REG_F] & 0x0F
+        if (k in (0, 1)):
+            t = a + x + k
+            regs[i, REG_F] = f | zero(t & 0xFF) | ((a & 0x0F) + (x & 0x0F) + k > 0x0F) * 0x20 | (t > 0xFF) * 0x10
+            regs[i, REG_A] = t & 0xFF
+        elif (k in (2, 3, 7)):
+            c = 1 if k == 3 else 0
+            t = a - x - c
+            regs[i, REG_F] = f | 0x40 | zero(t & 0xFF) | ((a & 0x0F) < (x & 0x0F) + c) * 0x20 | (t < 0) * 0x10
+            if (k != 7):
+                regs[i, REG_A] = t & 0xFF
+        else:
+            t = a & x if k == 4 else (a ^ x if k == 5 else a | x)
+            regs[i, REG_F] = f | zero(t) | (0x20 if k == 4 else 0x00)
+            regs[i, REG_A] = t
+
+    def ALU_r(self, k, r, i):
+        self.alu(k, i, self.get_r(i, r))
+
+    def ALU_n(self, k, i):
+        self.alu(k, i, self.fetch_8(i))
+
+    def INC_r(self, r, i):
+        val = (self.get_r(i, r) + 1) & 0xFF
+        f = self.regs[i, REG_F]
+        self.regs[i, REG_F] = (f & 0x1F) | zero(val) | ((val & 0x0F) == 0) * 0x20
+        self.set_r(i, r, val)
+
+    def DEC_r(self, r, i):
+        val = (self.get_r(i, r) - 1) & 0xFF
+        f = self.regs[i, REG_F]
+        self.regs[i, REG_F] = (f & 0x1F) | 0x40 | zero(val) | ((val & 0x0F) == 0x0F) * 0x20
+        self.set_r(i, r, val)
+
+    def ADD_HL_n(self, hi, lo, i):
+        self.add_hl(i, self.get_pair(i, hi, lo))
+
+    def ADD_HL_SP(self, i):
+        self.add_hl(i, self.sp[i])
+
+    def add_hl(self, i, val):
+        hl = self.get_pair(i, REG_H, REG_L)
+        t = hl + val
+        f = self.regs[i, REG_F]
+        self.regs[i, REG_F] = (f & 0x8F) | ((hl & 0xFFF) + (val & 0xFFF) > 0xFFF) * 0x20 | (t > 0xFFFF) * 0x10
+        self.set_pair(i, REG_H, REG_L, t & 0xFFFF)
+
+    def STEP_nn(self, hi, lo, delta, i):
+        self.set_pair(i, hi, lo, (self.get_pair(i, hi, lo) + delta) & 0xFFFF)
+
+    def STEP_SP(self, delta, i):
+        self.sp[i] = (self.sp[i] + delta) & 0xFFFF
+
+    def ADD_SP_n(self, i):
+        # Reads a 16-bit operand as CPU.ADD_SP_n does
+        self.sp[i] = self.add_16(i, self.sp[i], self.fetch_16(i))
+        self.regs[i, REG_F] &= 0x7F
+
+    def DAA(self, i):
+        regs = self.regs
+        a = regs[i, REG_A]
+        f = regs[i, REG_F]
+        c = (f & 0x10) != 0
+        h = (f & 0x20) != 0
+        sub = (f & 0x40) != 0
+
+        high = ~sub & (c | (a > 0x99))
+        a = np.where(sub, a - c * 0x60 - h * 0x06, a + high * 0x60)
+        a = a + (~sub & (h | ((a & 0x0F) > 0x09))) * 0x06
+
+        f = np.where(high, f | 0x10, f)
+        regs[i, REG_F] = (f & 0x5F) | zero(a)
+        regs[i, REG_A] = a & 0xFF
+
+    def CPL(self, i):
+        self.regs[i, REG_A] ^= 0xFF
+        self.regs[i, REG_F] |= 0x60
+
+    def CCF(self, i):
+        self.regs[i, REG_F] = (self.regs[i, REG_F] & 0x9F) ^ 0x10
+
+    def SCF(self, i):
+        self.regs[i, REG_F] = (self.regs[i, REG_F] & 0x8F) | 0x10
+
+    # Rotates on A set Z from the result, as CPU's handlers do
+
+    def RLCA(self, i):
+        a = self.regs[i, REG_A]
+        t = ((a << 1) | (a >> 7)) & 0xFF
+        self.regs[i, REG_F] = (self.regs[i, REG_F] & 0x0F) | zero(t) | ((a >> 7) << 4)
+        self.regs[i, REG_A] = t
+
+    def RLA(self, i):
+        a = self.regs[i, REG_A]
+        f = self.regs[i, REG_F]
+        t = ((a << 1) & 0xFF) | ((f >> 4) & 0x01)
+        self.regs[i, REG_F] = (f & 0x0F) | zero(t) | ((a >> 7) << 4)
+        self.regs[i, REG_A] = t
+
+    def RRCA(self, i):
+        a = self.regs[i, REG_A]
+        t = (a >> 1) | ((a & 0x01) << 7)
+        self.regs[i, REG_F] = (self.regs[i, REG_F] & 0x0F) | zero(t) | ((a & 0x01) << 4)
+        self.regs[i, REG_A] = t
+
+    def RRA(self, i):
+        a = self.regs[i, REG_A]
+        f = self.regs[i, REG_F]
+        self.regs[i, REG_A] = (a >> 1) | ((f & 0x10) << 3)
+        self.regs[i, REG_F] = (f & 0x0F) | zero(a & 0xFE) | ((a & 0x01) << 4)
+
+    def HALT(self, i):
+        # As CPU.HALT, the next event is the end of the current LCD line
+        pending = self.pending(i) != 0
+        self.halted[i[pending]] = False
+        i = i[~pending]
+        self.halted[i] = True
+        self.pc[i] -= 1
+        cycles = self.cycles[i]
+        wake = np.minimum((cycles // LINE_CLOCKS + 1) * LINE_CLOCKS, self.cycle_target[i]) - CLOCKS[0x76]
+        self.cycles[i] = np.maximum(cycles, wake)
+
+    def STOP(self, i):
+        self.pc[i] += 1
+
+    def DI(self, i):
+        self.ime[i] = False
+        self.ei_delay[i] = 0
+
+    def EI(self, i):
+        self.ei_delay[i] = np.where(self.ime[i] | (self.ei_delay[i] != 0), self.ei_delay[i], EI_DELAY)
+
+    # Jumps, calls and returns, taken branches add their extra clocks
+
+    def JP_nn(self, i):
+        self.pc[i] = self.fetch_16(i)
+
+    def JP_HL(self, i):
+        self.pc[i] = self.get_pair(i, REG_H, REG_L)
+
+    def JP_cc(self, cond, clocks, i):
+        taken = self.taken(i, cond)
+        self.pc[i[~taken]] += 2
+        self.JP_nn(i[taken])
+        self.cycles[i[taken]] += clocks
+
+    def JR_n(self, i):
+        n = self.fetch_8(i)
+        self.pc[i] = (self.pc[i] + (n ^ 0x80) - 0x80) & 0xFFFF
+
+    def JR_cc(self, cond, clocks, i):
+        taken = self.taken(i, cond)
+        self.pc[i[~taken]] += 1
+        self.JR_n(i[taken])
+        self.cycles[i[taken]] += clocks
+
+    def CALL_nn(self, i):
+        self.push_stack(i, self.pc[i] + 2)
+        self.pc[i] = self.fetch_16(i)
+
+    def CALL_cc(self, cond, clocks, i):
+        taken = self.taken(i, cond)
+        self.pc[i[~taken]] += 2
+        self.CALL_nn(i[taken])
+        self.cycles[i[taken]] += clocks
+
+    def RET(self, i):
+        self.pc[i] = self.pop_stack(i)
+
+    def RET_cc(self, cond, clocks, i):
+        i = i[self.taken(i, cond)]
+        self.RET(i)
+        self.cycles[i] += clocks
+
+    def RETI(self, i):
+        self.ime[i] = True
+        self.ei_delay[i] = 0
+        self.RET(i)
+
+    def RST(self, n, i):
+        self.push_stack(i, self.pc[i])
+        self.pc[i] = n
+
+    def execute_cb(self, i):
+        ops = self.fetch_8(i)
+        for op in np.unique(ops):
+            group = i[ops == op]
+            self.cb_opcodes[op](group)
+            self.cycles[group] += CB_CLOCKS[op]
+
+    # CB-prefixed operations
+
+    def CB_shift(self, shift, r, i):
+        f = self.regs[i, REG_F]
+        val, carry = shift(self.get_r(i, r), (f & 0x10) >> 4)
+        self.set_r(i, r, val)
+        self.regs[i, REG_F] = (self.regs[i, REG_F] & 0x0F) | zero(val) | (carry << 4)
+
+    def BIT(self, mask, r, i):
+        val = self.get_r(i, r)
+        self.regs[i, REG_F] = (self.regs[i, REG_F] & 0x1F) | np.where(val & mask, 0x20, 0xA0)
+
+    def RES(self, mask, r, i):
+        self.set_r(i, r, self.get_r(i, r) & (mask ^ 0xFF))
+
+    def SET(self, mask, r, i):
+        self.set_r(i, r, self.get_r(i, r) | mask)
@@ -0,0 +1,368 @@
+import ast
+import hashlib
+import importlib
+import inspect
+import os
+import sys
+import textwrap
+import types
+from functools import partial
+
+## Specialised opcode handlers
+# The opcode table binds generic handlers to register indices with partial,
+# e.g. partial(LD_r1_r2, REG_A, REG_B). This writes each (handler, operands)
+# pair out as its own function with the operands as constants, self.regs
+# as a closure variable and get_flag/set_flag on constant flag names turned
+# into direct bit operations on F, so the hot path makes one plain call
+# with no partial or flag name lookups. Handlers with an immediate operand
+# also get a variant taking it as an argument, for CPU's decode cache. The
+# generated module is cached next
+# to this file and rebuilt when cpu.py or this file changes, or when a
+# table needs a handler it doesn't have yet.
+
+MODULE = 'cpu_handlers'
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), MODULE + '.py')
+
+HEADER = '''# Generated by codegen.py from cpu.py, do not edit
+from cpu import *
+
+SOURCE_HASH = %r
+
+SIGNATURES = %r
+
+def build(self):
+    regs = self.regs
+'''
+
+_digest = None
+
+def source_hash():
+    global _digest
+    if (_digest is None):
+        digest = hashlib.sha1()
+        for name in ('cpu', 'codegen'):
+            digest.update(inspect.getsource(sys.modules[name]).encode())
+        _digest = digest.hexdigest()
+    return _digest
+
+def signature(cpu, handler):
+    # (method name, constant operands) for a handler that can be
+    # specialised, otherwise None
+    args = ()
+    if (isinstance(handler, partial)):
+        if (handler.keywords or not all(type(arg) in (int, bool) for arg in handler.args)):
+            return None
+        args = handler.args
+        handler = handler.func
+    if (not isinstance(handler, types.MethodType) or handler.__self__ is not cpu):
+        return None
+    if (getattr(type(cpu), handler.__name__, None) is not handler.__func__):
+        return None
+    return (handler.__name__, args)
+
+def function_name(sig):
+    name, args = sig
+    return '_'.join([name] + ['%X' % arg for arg in args])
+
+# Bit of each flag in F
+FLAG_BITS = {'Z': 7, 'N': 6, 'H': 5, 'C': 4}
+
+# Helpers that leave flags pending with lazy_flags
+PENDING = ('add_8', 'add_16', 'sub_8', 'sub_16')
+
+SYNC = '''if self.pending_flags is not None:
+    self.sync_flags()'''
+
+def self_call(node, names):
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+        and isinstance(node.func.value, ast.Name) and node.func.value.id == 'self'
+        and node.func.attr in names)
+
+# Operand fetches and the operand length each reads
+FETCHES = {'fetch_8': 1, 'fetch_16': 2}
+
+def fetches(node):
+    return [n for n in ast.walk(node) if self_call(n, FETCHES)]
+
+def reads_pc(node):
+    return any(isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name) and n.value.id == 'self'
+        and n.attr == 'pc' and isinstance(n.ctx, ast.Load) for n in ast.walk(node))
+
+def method_ast(cls, name):
+    return ast.parse(textwrap.dedent(inspect.getsource(getattr(cls, name)))).body[0]
+
+def flag_call(node, name):
+    # Flag named by a self.get_flag/self.set_flag call, or None
+    if (self_call(node, (name,)) and node.args and isinstance(node.args[0], ast.Constant)
+            and node.args[0].value in FLAG_BITS):
+        return node.args[0].value
+    return None
+
+class ReadFlags(ast.NodeTransformer):
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        flag = flag_call(node, 'get_flag')
+        if (flag is None):
+            return node
+        return ast.parse('(regs[6] >> %d & 1)' % FLAG_BITS[flag], mode='eval').body
+
+class InlineFlags(ast.NodeTransformer):
+    # Flags are synced before the statement, which is only safe when
+    # nothing in it leaves new flags pending
+    def inline(self, node, field):
+        part = getattr(node, field)
+        if (part is None):
+            return node
+        calls = [n for n in ast.walk(part) if flag_call(n, 'get_flag') or flag_call(n, 'set_flag')]
+        if (not calls or any(self_call(n, PENDING) for n in ast.walk(part))):
+            return node
+
+        part = ReadFlags().visit(part)
+        setattr(node, field, part)
+        flag = flag_call(part, 'set_flag') if isinstance(node, ast.Expr) else None
+        if (flag is not None):
+            bit = FLAG_BITS[flag]
+            val = part.args[1]
+            if (isinstance(val, ast.Constant)):
+                source = 'regs[6] = regs[6] | %d' if val.value else 'regs[6] = regs[6] & %d'
+                node = ast.parse(source % ((1 << bit) if val.value else 0xFF ^ (1 << bit))).body[0]
+            else:
+                node = ast.parse('regs[6] = regs[6] & %d | (%s) << %d'
+                    % (0xFF ^ (1 << bit), ast.unparse(val), bit)).body[0]
+        elif (any(flag_call(n, 'set_flag') for n in ast.walk(part))):
+            return node
+
+        return ast.parse(SYNC).body + [node]
+
+    def visit_Expr(self, node):
+        return self.inline(node, 'value')
+
+    def visit_Assign(self, node):
+        return self.inline(node, 'value')
+
+    def visit_AugAssign(self, node):
+        return self.inline(node, 'value')
+
+    def visit_Return(self, node):
+        return self.inline(node, 'value')
+
+    def visit_If(self, node):
+        self.generic_visit(node)
+        return self.inline(node, 'test')
+
+class InlineFetches(ast.NodeTransformer):
+    # Calls like self.JR_n() to methods without arguments that fetch an
+    # operand are replaced by the method's body, so the fetch can be seen
+    def __init__(self, cls):
+        self.cls = cls
+
+    def visit_Expr(self, node):
+        call = node.value
+        if (not self_call(call, dir(self.cls)) or call.args or call.keywords):
+            return node
+        method = method_ast(self.cls, call.func.attr)
+        if (len(method.args.args) != 1 or not fetches(method)):
+            return node
+        return [self.visit(statement) for statement in method.body]
+
+class TakeOperand(ast.NodeTransformer):
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if (self_call(node, FETCHES)):
+            return ast.copy_location(ast.Name('operand', ast.Load()), node)
+        return node
+
+def take_operand(statements):
+    # Replaces the one fetch in statements with the operand argument and
+    # moves pc past the operand just before the statement holding it, so
+    # pc reads after it see what they did before. Returns the statements
+    # and the operand length, or None if the fetch can't be moved that way.
+    kept = []
+    length = None
+    for node in statements:
+        found = fetches(node)
+        if (not found):
+            kept.append(node)
+            continue
+
+        if (isinstance(node, ast.If) and not fetches(node.test)):
+            body = take_operand(node.body)
+            orelse = take_operand(node.orelse)
+            if (body is None or orelse is None):
+                return None
+            node.body, length = body
+            node.orelse, other = orelse
+            length = length or other
+        else:
+            header = node.test if isinstance(node, ast.If) else node
+            if (isinstance(node, (ast.For, ast.While, ast.With, ast.Try)) or reads_pc(header)):
+                return None
+            length = FETCHES[found[0].func.attr]
+            kept.append(ast.parse('self.pc += %d' % length).body[0])
+            if (isinstance(node, ast.If)):
+                node.test = TakeOperand().visit(node.test)
+            else:
+                node = TakeOperand().visit(node)
+        kept.append(node)
+
+    return kept, length
+
+def is_sync(node):
+    return isinstance(node, ast.If) and ast.unparse(node) == SYNC
+
+def has_calls(node):
+    # Any call that might leave flags pending
+    return any(isinstance(n, ast.Call) and not (isinstance(n.func, ast.Name) and n.func.id in ('int', 'bool'))
+        for n in ast.walk(node))
+
+def drop_repeated_syncs(statements, synced = False):
+    # A sync is only needed again once something has been called since
+    # the last one
+    kept = []
+    for node in statements:
+        if (is_sync(node)):
+            if (synced):
+                continue
+            synced = True
+        elif (isinstance(node, ast.If)):
+            inner = synced and not has_calls(node.test)
+            node.body = drop_repeated_syncs(node.body, inner)
+            node.orelse = drop_repeated_syncs(node.orelse, inner)
+            synced = synced and not has_calls(node)
+        elif (has_calls(node)):
+            synced = False
+        kept.append(node)
+    return kept
+
+class Specialise(ast.NodeTransformer):
+    def __init__(self, constants):
+        self.constants = constants
+
+    def visit_Name(self, node):
+        if (node.id in self.constants and isinstance(node.ctx, ast.Load)):
+            return ast.copy_location(ast.Constant(self.constants[node.id]), node)
+        return node
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        if (isinstance(node.value, ast.Name) and node.value.id == 'self'
+                and node.attr == 'regs' and isinstance(node.ctx, ast.Load)):
+            return ast.copy_location(ast.Name('regs', ast.Load()), node)
+        return node
+
+def specialise(cls, sig, operand = False):
+    # Source lines of the handler's body with its operands filled in, or
+    # None if it assigns to one of them. With operand, (lines, operand
+    # length) of the variant taking its immediate operand as an argument,
+    # or None if it has no single fetch to replace.
+    name, args = sig
+    method = method_ast(cls, name)
+    params = [arg.arg for arg in method.args.args[1:]]
+    if (len(params) != len(args)):
+        return None
+
+    length = None
+    if (operand):
+        method = InlineFetches(cls).visit(method)
+        if (len(fetches(method)) != 1):
+            return None
+        taken = take_operand(method.body)
+        if (taken is None):
+            return None
+        method.body, length = taken
+
+    for node in ast.walk(method):
+        if (isinstance(node, ast.Name) and node.id in params and not isinstance(node.ctx, ast.Load)):
+            return None
+
+    # Register indices are constants as well
+    constants = dict((name, val) for name, val in vars(sys.modules['cpu']).items() if name.startswith('REG_') and type(val) is int)
+    constants.update(zip(params, args))
+    method = Specialise(constants).visit(method)
+    method = InlineFlags().visit(method)
+    method.body = drop_repeated_syncs(method.body)
+    lines = [ast.unparse(statement) for statement in method.body]
+    return (lines, length) if operand else lines
+
+def generate(cls, signatures, digest):
+    lines = [HEADER % (digest, sorted(signatures))]
+    names = {}
+    operand_names = {}
+
+    for sig in sorted(signatures):
+        body = specialise(cls, sig)
+        if (body is None):
+            continue
+        names[sig] = function_name(sig)
+        lines.append('    def %s():' % names[sig])
+        for statement in body:
+            lines.append(textwrap.indent(statement, ' ' * 8))
+        lines.append('')
+
+        variant = specialise(cls, sig, True)
+        if (variant is None):
+            continue
+        body, length = variant
+        operand_names[sig] = ('%s_operand' % names[sig], length)
+        lines.append('    def %s_operand(operand):' % names[sig])
+        for statement in body:
+            lines.append(textwrap.indent(statement, ' ' * 8))
+        lines.append('')
+
+    # Handlers, and (operand variant, operand length) pairs
+    lines.append('    return {')
+    lines.append(',\n'.join('        %r: %s' % (sig, name) for sig, name in names.items()))
+    lines.append('    }, {')
+    lines.append(',\n'.join('        %r: (%s, %d)' % (sig, name, length) for sig, (name, length) in operand_names.items()))
+    lines.append('    }')
+    return '\n'.join(lines) + '\n'
+
+_module = None
+
+def load_module(signatures):
+    # Generated module covering signatures, from the cache if it's current
+    global _module
+    digest = source_hash()
+
+    if (_module is None):
+        try:
+            _module = importlib.import_module(MODULE)
+        except (ImportError, SyntaxError):
+            _module = None
+
+    known = set()
+    if (_module is not None and getattr(_module, 'SOURCE_HASH', None) == digest):
+        known = set(_module.SIGNATURES)
+        if (signatures <= known):
+            return _module
+
+    source = generate(sys.modules['cpu'].CPU, signatures | known, digest)
+    module = types.ModuleType(MODULE)
+    module.__file__ = MODULE_PATH
+    exec(compile(source, MODULE_PATH, 'exec'), module.__dict__)
+    try:
+        with open(MODULE_PATH, 'w') as fh:
+            fh.write(source)
+    except OSError:
+        pass
+
+    sys.modules[MODULE] = _module = module
+    return module
+
+# Signatures of each opcode table layout seen, by layout key
+_layouts = {}
+
+def specialise_table(cpu, ops, layout):
+    # Replaces every handler in ops that has a generated version, returns
+    # the new table and a table of (operand variant, operand length) or
+    # None. Tables with the same layout key hold the same handlers.
+    sigs = _layouts.get(layout)
+    if (sigs is None):
+        sigs = [signature(cpu, handler) for handler in ops]
+        load_module(set(sig for sig in sigs if sig is not None))
+        _layouts[layout] = sigs
+    handlers, operand_handlers = _module.build(cpu)
+
+    table = [handlers.get(sig, handler) if sig is not None else handler
+        for sig, handler in zip(sigs, ops)]
+    return table, [operand_handlers.get(sig) for sig in sigs]
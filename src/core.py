@@ -0,0 +1,28 @@
+from cycles import FRAME_CLOCKS
+
+## Execution cores
+# Everything that can run a CPU: CPU itself, the reference, which steps one
+# instruction through its handler table, LocalCore and Recompiler. Each
+# core works on the state held by its `cpu`, so cores can be swapped between
+# calls and compared by validator.LockstepValidator. step() runs one
+# instruction, or for Recompiler one block.
+
+class Core:
+    cpu = None
+
+    def step(self):
+        raise NotImplementedError('Core.step')
+
+    def run(self, steps):
+        step = self.step
+        for i in range(steps):
+            step()
+
+    def run_cycles(self, n):
+        # Runs whole steps until at least n clocks have passed, returns the
+        # number of clocks actually run
+        raise NotImplementedError('Core.run_cycles')
+
+    def run_frame(self):
+        # Runs up to the next frame boundary, overshoot comes off the next frame
+        return self.run_cycles(FRAME_CLOCKS - self.cpu.cycles % FRAME_CLOCKS)
@@ -1,61 +1,202 @@
 import numpy as np
-
-class CPU:
-    def __init__(self, mmu):
-        self.regs = {
-            'A': 0x00,
-            'B': 0x00,
-            'C': 0x00,
-            'D': 0x00,
-            'E': 0x00,
-            'F': 0x00,
-            'H': 0x00,
-            'L': 0x00
-        }
+from functools import partial
+import alu_tables
+import codegen
+from core import Core
+from cycles import CLOCKS, CB_CLOCKS, INTERRUPT_CLOCKS
+from scheduler import Scheduler, NEVER
+
+## Register file
+# Indices into CPU.regs, in the order used by the opcode encoding.
+# F sits at index 6, the slot the encoding uses for (HL).
+REG_B = 0
+REG_C = 1
+REG_D = 2
+REG_E = 3
+REG_H = 4
+REG_L = 5
+REG_F = 6
+REG_A = 7
+
+REG_INDEX = {
+    'A': REG_A,
+    'B': REG_B,
+    'C': REG_C,
+    'D': REG_D,
+    'E': REG_E,
+    'F': REG_F,
+    'H': REG_H,
+    'L': REG_L
+}
+
+REG_PAIRS = {
+    'AF': (REG_A, REG_F),
+    'BC': (REG_B, REG_C),
+    'DE': (REG_D, REG_E),
+    'HL': (REG_H, REG_L)
+}
+
+## CB-prefixed rotates & shifts
+# Each takes a byte and the carry flag, returns (result, carry out)
+
+def RLC(val, c):
+    return ((val << 1) | (val >> 7)) & 0xFF, val >> 7
+
+def RRC(val, c):
+    return (val >> 1) | ((val & 0x01) << 7), val & 0x01
+
+def RL(val, c):
+    return ((val << 1) | c) & 0xFF, val >> 7
+
+def RR(val, c):
+    return (val >> 1) | (c << 7), val & 0x01
+
+def SLA(val, c):
+    return (val << 1) & 0xFF, val >> 7
+
+def SRA(val, c):
+    return (val >> 1) | (val & 0x80), val & 0x01
+
+def SWAP(val, c):
+    return ((val & 0x0F) << 4) | (val >> 4), 0
+
+def SRL(val, c):
+    return val >> 1, val & 0x01
+
+## Lazy flag evaluation
+# Each takes the ALU operands and carry in, returns the Z/N/H/C bits of F
+
+def ADD_8_FLAGS(val1, val2, c):
+    total = val1 + val2 + c
+    return ((0x80 if (total & 0xFF) == 0 else 0x00)
+        | (0x20 if (val1 & 0x0F) + (val2 & 0x0F) + c > 0x0F else 0x00)
+        | (0x10 if total > 0xFF else 0x00))
+
+def ADD_16_FLAGS(val1, val2, c):
+    total = val1 + val2 + c
+    return ((0x80 if (total & 0xFFFF) == 0 else 0x00)
+        | (0x20 if (val1 & 0xFFF) + (val2 & 0xFFF) + c > 0xFFF else 0x00)
+        | (0x10 if total > 0xFFFF else 0x00))
+
+def SUB_8_FLAGS(val1, val2, c):
+    total = val1 - val2 - c
+    return ((0x80 if (total & 0xFF) == 0 else 0x00)
+        | 0x40
+        | (0x20 if (val1 & 0x0F) < (val2 & 0x0F) + c else 0x00)
+        | (0x10 if total < 0 else 0x00))
+
+def SUB_16_FLAGS(val1, val2, c):
+    total = val1 - val2 - c
+    return ((0x80 if (total & 0xFFFF) == 0 else 0x00)
+        | 0x40
+        | (0x20 if (val1 & 0xFFF) < (val2 & 0xFFF) + c else 0x00)
+        | (0x10 if total < 0 else 0x00))
+
+class CPU(Core):
+    def __init__(self, mmu, lazy_flags = False, use_alu_tables = False, specialise = True, decode_cache = True):
+        # Mutate in place only (cpu.regs[:] = ...), the CB and generated
+        # handlers capture it
+        self.regs = bytearray(8)
 
         self.sp = 0xFFFE
         self.pc = 0x0100
-        self.interrupt_master_enable = False
+        self.interrupts = mmu.interrupts
+
+        # Clocks run since power on, 4 per M-cycle
+        self.cycles = 0
+        # Where the current run_cycles call stops, HALT may skip up to here
+        self.cycle_target = 0
+        self.scheduler = Scheduler()
+        self.halted = False
 
         self.mmu = mmu
 
+        # With lazy flags the ALU helpers only record their operands, F is
+        # brought up to date by sync_flags() when something reads it
+        self.lazy_flags = lazy_flags
+        self.pending_flags = None
+        if (lazy_flags):
+            self.add_8 = self.add_8_lazy
+            self.add_16 = self.add_16_lazy
+            self.sub_8 = self.sub_8_lazy
+            self.sub_16 = self.sub_16_lazy
+
+        # Opt-in lookup tables for the 8-bit ALU, see alu_tables
+        self.alu_tables = None
+        if (use_alu_tables):
+            self.alu_tables = alu_tables.load_tables()
+            self.add_8 = self.add_8_table
+            self.sub_8 = self.sub_8_table
+
+        self.opcodes = self.build_opcode_table()
+        self.cb_opcodes = self.build_cb_table()
+        # (handler taking its immediate operand, operand length) or None
+        self.operand_opcodes = [None] * 0x100
+
+        # Generated handlers with their operands filled in, see codegen
+        if (specialise):
+            self.opcodes, self.operand_opcodes = codegen.specialise_table(self, self.opcodes, use_alu_tables)
+
+        # ROM never changes, so instructions run from it are decoded once
+        # into (handler, operand, length, clocks), see decode. Each bank
+        # mapped at 0x0000 and each mapped at 0x4000 has its own cache,
+        # picked when the MMU switches banks.
+        self.decode_cache = decode_cache
+        self.fixed_caches = {}
+        self.rom_caches = {}
+        self.select_bank(mmu.rom_bank, mmu.rom_bank_0)
+        mmu.add_bank_listener(self.select_bank)
+        mmu.clock = lambda: self.cycles
+
+    @property
+    def cpu(self):
+        # As a Core, the CPU runs itself
+        return self
+
+    @property
+    def interrupt_master_enable(self):
+        return self.interrupts.ime
+
+    @interrupt_master_enable.setter
+    def interrupt_master_enable(self, val):
+        self.interrupts.set_ime(val)
+
+    # Name-based register access, kept for tests and debugging.
+    # Opcode handlers index self.regs directly.
+
     def get_reg_8(self, reg):
-        return self.regs[reg]
+        self.sync_flags()
+        return self.regs[REG_INDEX[reg]]
 
     def set_reg_8(self, reg, val):
-        self.regs[reg] = val
+        self.sync_flags()
+        self.regs[REG_INDEX[reg]] = val
 
     def get_reg_16(self, reg):
-        if (reg == 'AF'):
-            return (self.regs['A'] << 8) | self.regs['F']
-        elif (reg == 'BC'):
-            return (self.regs['B'] << 8) | self.regs['C']
-        elif (reg == 'DE'):
-            return (self.regs['D'] << 8) | self.regs['E']
-        elif (reg == 'HL'):
-            return (self.regs['H'] << 8) | self.regs['L']
-        elif (reg == 'SP'):
+        self.sync_flags()
+        if (reg == 'SP'):
             return self.sp
         elif (reg == 'PC'):
             return self.pc
+        hi, lo = REG_PAIRS[reg]
+        return self.get_pair(hi, lo)
 
     def set_reg_16(self, reg, val):
-        if (reg == 'AF'):
-            self.regs['A'] = (val & 0xFF00) >> 8
-            self.regs['F'] = val & 0x00FF
-        elif (reg == 'BC'):
-            self.regs['B'] = (val & 0xFF00) >> 8
-            self.regs['C'] = val & 0x00FF
-        elif (reg == 'DE'):
-            self.regs['D'] = (val & 0xFF00) >> 8
-            self.regs['E'] = val & 0x00FF
-        elif (reg == 'HL'):
-            self.regs['H'] = (val & 0xFF00) >> 8
-            self.regs['L'] = val & 0x00FF
-        elif (reg == 'SP'):
+        self.sync_flags()
+        if (reg == 'SP'):
             self.sp = val
         elif (reg == 'PC'):
             self.pc = val
+        else:
+            hi, lo = REG_PAIRS[reg]
+            self.set_pair(hi, lo, val)
+
+    def get_pair(self, hi, lo):
+        return (self.regs[hi] << 8) | self.regs[lo]
+
+    def set_pair(self, hi, lo, val):
+        self.regs[hi] = (val & 0xFF00) >> 8
+        self.regs[lo] = val & 0x00FF
 
     def fetch_8(self):
         val = self.mmu.get(self.pc)
@@ -63,1163 +204,861 @@ class CPU:
         return val
 
     def fetch_16(self):
-        val1 = self.mmu.get(self.pc)
-        val2 = self.mmu.get(self.pc + 1)
+        val = self.mmu.read16(self.pc)
         self.pc = self.pc + 2
-        val = (val2 << 8) | val1 # Least sig byte popped first, might be wrong
         return val
 
+    def select_bank(self, bank, bank_0 = 0):
+        self.fixed_cache = self.fixed_caches.setdefault(bank_0, {})
+        self.bank_cache = self.rom_caches.setdefault(bank, {})
+
+    def flush_decode_cache(self):
+        # Needed when a handler in self.opcodes is replaced
+        for cache in list(self.fixed_caches.values()) + list(self.rom_caches.values()):
+            cache.clear()
+
+    def decode(self, pc):
+        # Decode cache entry for the ROM instruction at pc. The handler runs
+        # with pc past the opcode and is passed the operand if it isn't
+        # None, otherwise it fetches its own operands.
+        get = self.mmu.get
+        op = get(pc)
+        variant = self.operand_opcodes[op]
+        if (variant is None):
+            entry = (self.opcodes[op], None, 1, CLOCKS[op])
+        else:
+            handler, length = variant
+            if (length == 2):
+                operand = self.mmu.read16(pc + 1)
+            else:
+                operand = get(pc + 1)
+            entry = (handler, operand, length + 1, CLOCKS[op])
+
+        # Entries below 0x4000 can't depend on the switchable bank
+        if (pc < 0x4000):
+            if (pc + entry[2] <= 0x4000):
+                self.fixed_cache[pc] = entry
+        else:
+            self.bank_cache[pc] = entry
+        return entry
+
+    def sync_flags(self):
+        if (self.pending_flags is not None):
+            flags, val1, val2, c = self.pending_flags
+            self.pending_flags = None
+            self.regs[REG_F] = (self.regs[REG_F] & 0x0F) | flags(val1, val2, c)
+
     def get_flag(self, flag):
+        if (self.pending_flags is not None):
+            self.sync_flags()
+
         if (flag == 'Z'):
-            return (self.get_reg_8('F') & 0b10000000) >> 7
+            return (self.regs[REG_F] & 0b10000000) >> 7
         elif (flag == 'N'):
-            return (self.get_reg_8('F') & 0b01000000) >> 6
+            return (self.regs[REG_F] & 0b01000000) >> 6
         elif (flag == 'H'):
-            return (self.get_reg_8('F') & 0b00100000) >> 5
+            return (self.regs[REG_F] & 0b00100000) >> 5
         elif (flag == 'C'):
-            return (self.get_reg_8('F') & 0b00010000) >> 4
+            return (self.regs[REG_F] & 0b00010000) >> 4
         else:
             raise NotImplementedError('Unknown flag get: ' + flag)
 
     def set_flag(self, flag, val):
+        if (self.pending_flags is not None):
+            self.sync_flags()
+
         if (flag == 'Z'):
-            self.set_reg_8('F', self.get_reg_8('F') & 0b01111111 | (val << 7))
+            self.regs[REG_F] = self.regs[REG_F] & 0b01111111 | (val << 7)
         elif (flag == 'N'):
-            self.set_reg_8('F', self.get_reg_8('F') & 0b10111111 | (val << 6))
+            self.regs[REG_F] = self.regs[REG_F] & 0b10111111 | (val << 6)
         elif (flag == 'H'):
-            self.set_reg_8('F', self.get_reg_8('F') & 0b11011111 | (val << 5))
+            self.regs[REG_F] = self.regs[REG_F] & 0b11011111 | (val << 5)
         elif (flag == 'C'):
-            self.set_reg_8('F', self.get_reg_8('F') & 0b11101111 | (val << 4))
+            self.regs[REG_F] = self.regs[REG_F] & 0b11101111 | (val << 4)
         else:
             raise NotImplementedError('Unknown flag set: ' + flag)
 
     def push_stack(self, addr):
-        SP = self.get_reg_16('SP')
-        self.mmu.set(SP - 1, (addr & 0xFF00) >> 8)
-        self.mmu.set(SP - 2, (addr & 0xFF))
-        self.set_reg_16('SP', SP - 2)
+        SP = self.sp - 2
+        self.mmu.write16(SP, addr)
+        self.sp = SP
 
     def pop_stack(self):
-        SP = self.get_reg_16('SP')
-        lo = self.mmu.get(SP)
-        hi = self.mmu.get(SP + 1)
-        self.set_reg_16('SP', SP + 2)
-        return (hi << 8) | lo
+        SP = self.sp
+        self.sp = SP + 2
+        return self.mmu.read16(SP)
 
     def add_8(self, val1, val2, use_carry = False):
-        total = (int(val1) + int(val2) + int(use_carry))
+        total = val1 + val2 + use_carry
         wrappedTotal = total % 0x100
         self.set_flag('Z', int(wrappedTotal == 0))
         self.set_flag('N', 0)
-        self.set_flag('H', int((val1 & 0x0F) + (val2 & 0x0F) + (int(use_carry) & 0x0F) > 0x0F))
+        self.set_flag('H', int((val1 & 0x0F) + (val2 & 0x0F) + use_carry > 0x0F))
         self.set_flag('C', int(total > 0xFF))
         return wrappedTotal
 
     def add_16(self, val1, val2, use_carry = False):
-        total = (int(val1) + int(val2) + int(use_carry))
+        total = val1 + val2 + use_carry
         wrappedTotal = total % 0x10000
         self.set_flag('Z', int(wrappedTotal == 0))
         self.set_flag('N', 0)
-        self.set_flag('H', int((val1 & 0xFFF) + (val2 & 0xFFF) + (int(use_carry) & 0x0FFF) > 0x0FFF))
+        self.set_flag('H', int((val1 & 0xFFF) + (val2 & 0xFFF) + use_carry > 0x0FFF))
         self.set_flag('C', int(total > 0xFFFF))
         return wrappedTotal
 
     def sub_8(self, val1, val2, use_carry = False):
-        total = (int(val1) - int(val2) - int(use_carry))
+        total = val1 - val2 - use_carry
         wrappedTotal = total % 0x100
         self.set_flag('Z', int(wrappedTotal == 0))
         self.set_flag('N', 1)
-        self.set_flag('H', int((val1 & 0xF) < ((val2 & 0xF) + int(use_carry))))
+        self.set_flag('H', int((val1 & 0xF) < ((val2 & 0xF) + use_carry)))
         self.set_flag('C', int(total < 0x00))
         return wrappedTotal
 
     def sub_16(self, val1, val2, use_carry = False):
-        total = (int(val1) - int(val2) - int(use_carry))
+        total = val1 - val2 - use_carry
         wrappedTotal = total % 0x10000
         self.set_flag('Z', int(wrappedTotal == 0))
         self.set_flag('N', 1)
-        self.set_flag('H', int((val1 & 0xFFF) < ((val2 & 0xFFF) + int(use_carry))))
+        self.set_flag('H', int((val1 & 0xFFF) < ((val2 & 0xFFF) + use_carry)))
         self.set_flag('C', int(total < 0x0000))
         return wrappedTotal
 
+    # Table-driven variants of add_8 and sub_8
+
+    def add_8_table(self, val1, val2, use_carry = False):
+        entry = self.alu_tables['ADD'][(use_carry << 16) | (val1 << 8) | val2]
+        self.pending_flags = None
+        self.regs[REG_F] = (self.regs[REG_F] & 0x0F) | (entry >> 8)
+        return entry & 0xFF
+
+    def sub_8_table(self, val1, val2, use_carry = False):
+        entry = self.alu_tables['SUB'][(use_carry << 16) | (val1 << 8) | val2]
+        self.pending_flags = None
+        self.regs[REG_F] = (self.regs[REG_F] & 0x0F) | (entry >> 8)
+        return entry & 0xFF
+
+    # Lazy variants of the above, all four flags are left pending
+
+    def add_8_lazy(self, val1, val2, use_carry = False):
+        c = int(use_carry)
+        self.pending_flags = (ADD_8_FLAGS, val1, val2, c)
+        return (val1 + val2 + c) & 0xFF
+
+    def add_16_lazy(self, val1, val2, use_carry = False):
+        c = int(use_carry)
+        self.pending_flags = (ADD_16_FLAGS, val1, val2, c)
+        return (val1 + val2 + c) & 0xFFFF
+
+    def sub_8_lazy(self, val1, val2, use_carry = False):
+        c = int(use_carry)
+        self.pending_flags = (SUB_8_FLAGS, val1, val2, c)
+        return (val1 - val2 - c) & 0xFF
+
+    def sub_16_lazy(self, val1, val2, use_carry = False):
+        c = int(use_carry)
+        self.pending_flags = (SUB_16_FLAGS, val1, val2, c)
+        return (val1 - val2 - c) & 0xFFFF
+
     def tick(self):
-        op = self.fetch_8()
-        self.execute(op)
-        self.handle_interrupts()
+        pc = self.pc
+        if (pc < 0x8000 and self.decode_cache):
+            handler, operand, length, clocks = (self.fixed_cache if pc < 0x4000 else self.bank_cache).get(pc) or self.decode(pc)
+            self.pc = pc + 1
+            if (operand is None):
+                handler()
+            else:
+                handler(operand)
+            self.cycles += clocks
+        else:
+            op = self.fetch_8()
+            self.opcodes[op]()
+            self.cycles += CLOCKS[op]
+        if (self.cycles >= self.scheduler.next_time):
+            self.scheduler.run_due(self.cycles)
+        if (self.interrupts.ready):
+            self.handle_interrupts()
+
+    def run_cycles(self, n):
+        # Runs whole instructions until at least n clocks have passed,
+        # returns the number of clocks actually run
+        opcodes = self.opcodes
+        fetch_8 = self.fetch_8
+        decoded = self.decode_cache
+        decode = self.decode
+        handle_interrupts = self.handle_interrupts
+        interrupts = self.interrupts
+        scheduler = self.scheduler
+        start = self.cycles
+        target = start + n
+        self.cycle_target = target
+
+        while (self.cycles < target):
+            pc = self.pc
+            if (pc < 0x8000 and decoded):
+                handler, operand, length, clocks = (self.fixed_cache if pc < 0x4000 else self.bank_cache).get(pc) or decode(pc)
+                self.pc = pc + 1
+                if (operand is None):
+                    handler()
+                else:
+                    handler(operand)
+                self.cycles += clocks
+            else:
+                op = fetch_8()
+                opcodes[op]()
+                self.cycles += CLOCKS[op]
+            if (self.cycles >= scheduler.next_time):
+                scheduler.run_due(self.cycles)
+            if (interrupts.ready):
+                handle_interrupts()
+
+        return self.cycles - start
+
+    def step(self):
+        self.tick()
+
+    def save_state(self):
+        # Everything needed to carry on from here later with load_state,
+        # the scheduled events keep their callbacks
+        self.sync_flags()
+        interrupts = self.interrupts
+        return {
+            'regs': bytes(self.regs),
+            'sp': self.sp,
+            'pc': self.pc,
+            'cycles': self.cycles,
+            'halted': self.halted,
+            'interrupts': (interrupts.flags, interrupts.enable, interrupts.ime, interrupts.ei_delay),
+            'events': (list(self.scheduler.events), self.scheduler.count),
+            'memory': self.mmu.save_state()
+        }
+
+    def load_state(self, state):
+        self.pending_flags = None
+        self.regs[:] = state['regs']
+        self.sp = state['sp']
+        self.pc = state['pc']
+        self.cycles = state['cycles']
+        self.halted = state['halted']
+
+        interrupts = self.interrupts
+        interrupts.flags, interrupts.enable, interrupts.ime, interrupts.ei_delay = state['interrupts']
+        interrupts.update()
+
+        events, count = state['events']
+        self.scheduler.events = list(events)
+        self.scheduler.count = count
+        self.scheduler.next_time = events[0][0] if events else NEVER
+
+        self.mmu.load_state(state['memory'])
 
     def execute(self, op):
+        self.opcodes[op]()
+        self.cycles += CLOCKS[op]
+
+    def execute_cb(self):
+        op = self.fetch_8()
+        self.cb_opcodes[op]()
+        self.cycles += CB_CLOCKS[op]
+
+    def unknown_opcode(self, op):
+        raise NotImplementedError('Unknown opcode: ' + hex(op))
+
+    def build_opcode_table(self):
+        # Register order used by the opcode encoding, (HL) sits at index 6
+        regs = [REG_B, REG_C, REG_D, REG_E, REG_H, REG_L, None, REG_A]
+        ops = [partial(self.unknown_opcode, op) for op in range(0x100)]
+
         ## 8-bit loads
         # LD nn, n
-        if (op == 0x06):
-            n = self.fetch_8()
-            self.LD_nn_n('B', n)
-        elif (op == 0x0E):
-            n = self.fetch_8()
-            self.LD_nn_n('C', n)
-        elif (op == 0x16):
-            n = self.fetch_8()
-            self.LD_nn_n('D', n)
-        elif (op == 0x1E):
-            n = self.fetch_8()
-            self.LD_nn_n('E', n)
-        elif (op == 0x26):
-            n = self.fetch_8()
-            self.LD_nn_n('H', n)
-        elif (op == 0x2E):
-            n = self.fetch_8()
-            self.LD_nn_n('L', n)
+        for i, r in enumerate(regs):
+            if r is not None and r != REG_A:
+                ops[0x06 | (i << 3)] = partial(self.LD_nn_n, r)
 
         # LD r1, r2
-        elif (op == 0x7F):
-            self.LD_r1_r2('A', 'A')
-        elif (op == 0x78):
-            self.LD_r1_r2('A', 'B')
-        elif (op == 0x79):
-            self.LD_r1_r2('A', 'C')
-        elif (op == 0x7A):
-            self.LD_r1_r2('A', 'D')
-        elif (op == 0x7B):
-            self.LD_r1_r2('A', 'E')
-        elif (op == 0x7C):
-            self.LD_r1_r2('A', 'H')
-        elif (op == 0x7D):
-            self.LD_r1_r2('A', 'L')
-        elif (op == 0x40):
-            self.LD_r1_r2('B', 'B')
-        elif (op == 0x41):
-            self.LD_r1_r2('B', 'C')
-        elif (op == 0x42):
-            self.LD_r1_r2('B', 'D')
-        elif (op == 0x43):
-            self.LD_r1_r2('B', 'E')
-        elif (op == 0x44):
-            self.LD_r1_r2('B', 'H')
-        elif (op == 0x45):
-            self.LD_r1_r2('B', 'L')
-        elif (op == 0x48):
-            self.LD_r1_r2('C', 'B')
-        elif (op == 0x49):
-            self.LD_r1_r2('C', 'C')
-        elif (op == 0x4A):
-            self.LD_r1_r2('C', 'D')
-        elif (op == 0x4B):
-            self.LD_r1_r2('C', 'E')
-        elif (op == 0x4C):
-            self.LD_r1_r2('C', 'H')
-        elif (op == 0x4D):
-            self.LD_r1_r2('C', 'L')
-        elif (op == 0x50):
-            self.LD_r1_r2('D', 'B')
-        elif (op == 0x51):
-            self.LD_r1_r2('D', 'C')
-        elif (op == 0x52):
-            self.LD_r1_r2('D', 'D')
-        elif (op == 0x53):
-            self.LD_r1_r2('D', 'E')
-        elif (op == 0x54):
-            self.LD_r1_r2('D', 'H')
-        elif (op == 0x55):
-            self.LD_r1_r2('D', 'L')
-        elif (op == 0x58):
-            self.LD_r1_r2('E', 'B')
-        elif (op == 0x59):
-            self.LD_r1_r2('E', 'C')
-        elif (op == 0x5A):
-            self.LD_r1_r2('E', 'D')
-        elif (op == 0x5B):
-            self.LD_r1_r2('E', 'E')
-        elif (op == 0x5C):
-            self.LD_r1_r2('E', 'H')
-        elif (op == 0x5D):
-            self.LD_r1_r2('E', 'L')
-        elif (op == 0x60):
-            self.LD_r1_r2('H', 'B')
-        elif (op == 0x61):
-            self.LD_r1_r2('H', 'C')
-        elif (op == 0x62):
-            self.LD_r1_r2('H', 'D')
-        elif (op == 0x63):
-            self.LD_r1_r2('H', 'E')
-        elif (op == 0x64):
-            self.LD_r1_r2('H', 'H')
-        elif (op == 0x65):
-            self.LD_r1_r2('H', 'L')
-        elif (op == 0x68):
-            self.LD_r1_r2('L', 'B')
-        elif (op == 0x69):
-            self.LD_r1_r2('L', 'C')
-        elif (op == 0x6A):
-            self.LD_r1_r2('L', 'D')
-        elif (op == 0x6B):
-            self.LD_r1_r2('L', 'E')
-        elif (op == 0x6C):
-            self.LD_r1_r2('L', 'H')
-        elif (op == 0x6D):
-            self.LD_r1_r2('L', 'L')
-
-        # LD r, (HL)   #Technically part of LD r1, r2
-        elif (op == 0x7E):
-            self.LD_r_HL('A')
-        elif (op == 0x46):
-            self.LD_r_HL('B')
-        elif (op == 0x4E):
-            self.LD_r_HL('C')
-        elif (op == 0x56):
-            self.LD_r_HL('D')
-        elif (op == 0x5E):
-            self.LD_r_HL('E')
-        elif (op == 0x66):
-            self.LD_r_HL('H')
-        elif (op == 0x6E):
-            self.LD_r_HL('L')
-
-        # LD (HL), r   #Technically part of LD r1, r2
-        elif (op == 0x70):
-            self.LD_HL_r('B')
-        elif (op == 0x71):
-            self.LD_HL_r('C')
-        elif (op == 0x72):
-            self.LD_HL_r('D')
-        elif (op == 0x73):
-            self.LD_HL_r('E')
-        elif (op == 0x74):
-            self.LD_HL_r('H')
-        elif (op == 0x75):
-            self.LD_HL_r('L')
-
-        # LD (HL), n   #Technically part of LD r1, r2
-        elif (op == 0x36):
-            self.LD_HL_n()
+        for i, r1 in enumerate(regs):
+            for j, r2 in enumerate(regs):
+                if r1 is not None and r2 is not None:
+                    ops[0x40 | (i << 3) | j] = partial(self.LD_r1_r2, r1, r2)
+
+        # LD r, (HL) & LD (HL), r   #Technically part of LD r1, r2
+        for i, r in enumerate(regs):
+            if r is not None:
+                ops[0x46 | (i << 3)] = partial(self.LD_r_HL, r)
+                ops[0x70 | i] = partial(self.LD_HL_r, r)
+        ops[0x36] = self.LD_HL_n
 
         # LD A, n
-        elif (op == 0x0A):
-            self.LD_A_rr('BC')
-        elif (op == 0x1A):
-            self.LD_A_rr('DE')
-        elif (op == 0x7E):
-            self.LD_A_rr('HL')
-        elif (op == 0xFA):
-            self.LD_A_nn()
-        elif (op == 0x3E):
-            self.LD_A_n()
+        ops[0x0A] = partial(self.LD_A_rr, REG_B, REG_C)
+        ops[0x1A] = partial(self.LD_A_rr, REG_D, REG_E)
+        ops[0xFA] = self.LD_A_nn
+        ops[0x3E] = self.LD_A_n
 
         # LD n, A
-        elif (op == 0x47):
-            self.LD_n_A('B')
-        elif (op == 0x4F):
-            self.LD_n_A('C')
-        elif (op == 0x57):
-            self.LD_n_A('D')
-        elif (op == 0x5F):
-            self.LD_n_A('E')
-        elif (op == 0x67):
-            self.LD_n_A('H')
-        elif (op == 0x6F):
-            self.LD_n_A('L')
-        elif (op == 0x02):
-            self.LD_rr_A('BC')
-        elif (op == 0x12):
-            self.LD_rr_A('DE')
-        elif (op == 0x77):
-            self.LD_rr_A('HL')
-        elif (op == 0xEA):
-            self.LD_nn_A()
+        ops[0x02] = partial(self.LD_rr_A, REG_B, REG_C)
+        ops[0x12] = partial(self.LD_rr_A, REG_D, REG_E)
+        ops[0xEA] = self.LD_nn_A
 
         # LD A,C & LD C, A
-        elif (op == 0xF2):
-            self.LD_A_C()
-        elif (op == 0xE2):
-            self.LD_C_A()
+        ops[0xF2] = self.LD_A_C
+        ops[0xE2] = self.LD_C_A
 
         # LDD & LDI
-        elif (op == 0x3A):
-            self.LDD_A_HL()
-        elif (op == 0x32):
-            self.LDD_HL_A()
-        elif (op == 0x2A):
-            self.LDI_A_HL()
-        elif (op == 0x22):
-            self.LDI_HL_A()
+        ops[0x3A] = self.LDD_A_HL
+        ops[0x32] = self.LDD_HL_A
+        ops[0x2A] = self.LDI_A_HL
+        ops[0x22] = self.LDI_HL_A
 
         # LDH
-        elif (op == 0xE0):
-            self.LDH_n_A()
-        elif (op == 0xF0):
-            self.LDH_A_n()
+        ops[0xE0] = self.LDH_n_A
+        ops[0xF0] = self.LDH_A_n
 
         ## 16-bit loads
         # LD n, nn
-        elif (op == 0x01):
-            self.LD_n_nn('BC')
-        elif (op == 0x11):
-            self.LD_n_nn('DE')
-        elif (op == 0x21):
-            self.LD_n_nn('HL')
-        elif (op == 0x31):
-            self.LD_n_nn('SP')
+        ops[0x01] = partial(self.LD_n_nn, REG_B, REG_C)
+        ops[0x11] = partial(self.LD_n_nn, REG_D, REG_E)
+        ops[0x21] = partial(self.LD_n_nn, REG_H, REG_L)
+        ops[0x31] = self.LD_SP_nn
 
         # LD SP
-        elif (op == 0xF9):
-            self.LD_SP_HL()
-        elif (op == 0xF8):
-            self.LD_HL_SPn()
-        elif (op == 0x08):
-            self.LD_nn_SP()
+        ops[0xF9] = self.LD_SP_HL
+        ops[0xF8] = self.LD_HL_SPn
+        ops[0x08] = self.LD_nn_SP
 
         # Stack
-        elif (op == 0xF5):
-            self.PUSH_nn('AF')
-        elif (op == 0xC5):
-            self.PUSH_nn('BC')
-        elif (op == 0xD5):
-            self.PUSH_nn('DE')
-        elif (op == 0xE5):
-            self.PUSH_nn('HL')
-        elif (op == 0xF1):
-            self.POP_nn('AF')
-        elif (op == 0xC1):
-            self.POP_nn('BC')
-        elif (op == 0xD1):
-            self.POP_nn('DE')
-        elif (op == 0xE1):
-            self.POP_nn('HL')
+        pairs = [(REG_B, REG_C), (REG_D, REG_E), (REG_H, REG_L), (REG_A, REG_F)]
+        for i, (hi, lo) in enumerate(pairs[:3]):
+            ops[0xC5 | (i << 4)] = partial(self.PUSH_nn, hi, lo)
+            ops[0xC1 | (i << 4)] = partial(self.POP_nn, hi, lo)
+        ops[0xF5] = self.PUSH_AF
+        ops[0xF1] = self.POP_AF
 
         ## 8-bit ALU
-        # Addition
-        elif (op == 0x87):
-            self.ADD_A_r('A')
-        elif (op == 0x80):
-            self.ADD_A_r('B')
-        elif (op == 0x81):
-            self.ADD_A_r('C')
-        elif (op == 0x82):
-            self.ADD_A_r('D')
-        elif (op == 0x83):
-            self.ADD_A_r('E')
-        elif (op == 0x84):
-            self.ADD_A_r('H')
-        elif (op == 0x85):
-            self.ADD_A_r('L')
-        elif (op == 0x86):
-            self.ADD_A_HL()
-        elif (op == 0xC6):
-            self.ADD_A_n()
-        elif (op == 0x8F):
-            self.ADC_A_r('A')
-        elif (op == 0x88):
-            self.ADC_A_r('B')
-        elif (op == 0x89):
-            self.ADC_A_r('C')
-        elif (op == 0x8A):
-            self.ADC_A_r('D')
-        elif (op == 0x8B):
-            self.ADC_A_r('E')
-        elif (op == 0x8C):
-            self.ADC_A_r('H')
-        elif (op == 0x8D):
-            self.ADC_A_r('L')
-        elif (op == 0x8E):
-            self.ADC_A_HL()
-        elif (op == 0xCE):
-            self.ADC_A_n()
-
-        # Subtraction
-        elif (op == 0x97):
-            self.SUB_A_r('A')
-        elif (op == 0x90):
-            self.SUB_A_r('B')
-        elif (op == 0x91):
-            self.SUB_A_r('C')
-        elif (op == 0x92):
-            self.SUB_A_r('D')
-        elif (op == 0x93):
-            self.SUB_A_r('E')
-        elif (op == 0x94):
-            self.SUB_A_r('H')
-        elif (op == 0x95):
-            self.SUB_A_r('L')
-        elif (op == 0x96):
-            self.SUB_A_HL()
-        elif (op == 0xD6):
-            self.SUB_A_n()
-        elif (op == 0x9F):
-            self.SBC_A_r('A')
-        elif (op == 0x98):
-            self.SBC_A_r('B')
-        elif (op == 0x99):
-            self.SBC_A_r('C')
-        elif (op == 0x9A):
-            self.SBC_A_r('D')
-        elif (op == 0x9B):
-            self.SBC_A_r('E')
-        elif (op == 0x9C):
-            self.SBC_A_r('H')
-        elif (op == 0x9D):
-            self.SBC_A_r('L')
-        elif (op == 0x9E):
-            self.SBC_A_HL()
-        elif (op == 0xDE):
-            self.SBC_A_n()
-
-        # AND/OR/XOR
-        elif (op == 0xA7):
-            self.AND_r('A')
-        elif (op == 0xA0):
-            self.AND_r('B')
-        elif (op == 0xA1):
-            self.AND_r('C')
-        elif (op == 0xA2):
-            self.AND_r('D')
-        elif (op == 0xA3):
-            self.AND_r('E')
-        elif (op == 0xA4):
-            self.AND_r('H')
-        elif (op == 0xA5):
-            self.AND_r('L')
-        elif (op == 0xA6):
-            self.AND_HL()
-        elif (op == 0xE6):
-            self.AND_n()
-        elif (op == 0xB7):
-            self.OR_r('A')
-        elif (op == 0xB0):
-            self.OR_r('B')
-        elif (op == 0xB1):
-            self.OR_r('C')
-        elif (op == 0xB2):
-            self.OR_r('D')
-        elif (op == 0xB3):
-            self.OR_r('E')
-        elif (op == 0xB4):
-            self.OR_r('H')
-        elif (op == 0xB5):
-            self.OR_r('L')
-        elif (op == 0xB6):
-            self.OR_HL()
-        elif (op == 0xF6):
-            self.OR_n()
-        elif (op == 0xAF):
-            self.XOR_r('A')
-        elif (op == 0xA8):
-            self.XOR_r('B')
-        elif (op == 0xA9):
-            self.XOR_r('C')
-        elif (op == 0xAA):
-            self.XOR_r('D')
-        elif (op == 0xAB):
-            self.XOR_r('E')
-        elif (op == 0xAC):
-            self.XOR_r('H')
-        elif (op == 0xAD):
-            self.XOR_r('L')
-        elif (op == 0xAE):
-            self.XOR_HL()
-        elif (op == 0xEE):
-            self.XOR_n()
-        elif (op == 0xBF):
-            self.CP_r('A')
-        elif (op == 0xB8):
-            self.CP_r('B')
-        elif (op == 0xB9):
-            self.CP_r('C')
-        elif (op == 0xBA):
-            self.CP_r('D')
-        elif (op == 0xBB):
-            self.CP_r('E')
-        elif (op == 0xBC):
-            self.CP_r('H')
-        elif (op == 0xBD):
-            self.CP_r('L')
-        elif (op == 0xBE):
-            self.CP_HL()
-        elif (op == 0xFE):
-            self.CP_n()
-        elif (op == 0x3C):
-            self.INC_r('A')
-        elif (op == 0x04):
-            self.INC_r('B')
-        elif (op == 0x0C):
-            self.INC_r('C')
-        elif (op == 0x14):
-            self.INC_r('D')
-        elif (op == 0x1C):
-            self.INC_r('E')
-        elif (op == 0x24):
-            self.INC_r('H')
-        elif (op == 0x2C):
-            self.INC_r('L')
-        elif (op == 0x34):
-            self.INC_HL()
-        elif (op == 0x3D):
-            self.DEC_r('A')
-        elif (op == 0x05):
-            self.DEC_r('B')
-        elif (op == 0x0D):
-            self.DEC_r('C')
-        elif (op == 0x15):
-            self.DEC_r('D')
-        elif (op == 0x1D):
-            self.DEC_r('E')
-        elif (op == 0x25):
-            self.DEC_r('H')
-        elif (op == 0x2D):
-            self.DEC_r('L')
-        elif (op == 0x35):
-            self.DEC_HL()
+        alu = [
+            (self.ADD_A_r, self.ADD_A_HL, self.ADD_A_n),
+            (self.ADC_A_r, self.ADC_A_HL, self.ADC_A_n),
+            (self.SUB_A_r, self.SUB_A_HL, self.SUB_A_n),
+            (self.SBC_A_r, self.SBC_A_HL, self.SBC_A_n),
+            (self.AND_r, self.AND_HL, self.AND_n),
+            (self.XOR_r, self.XOR_HL, self.XOR_n),
+            (self.OR_r, self.OR_HL, self.OR_n),
+            (self.CP_r, self.CP_HL, self.CP_n)
+        ]
+        for i, (op_r, op_HL, op_n) in enumerate(alu):
+            for j, r in enumerate(regs):
+                if r is not None:
+                    ops[0x80 | (i << 3) | j] = partial(op_r, r)
+            ops[0x86 | (i << 3)] = op_HL
+            ops[0xC6 | (i << 3)] = op_n
+
+        if (self.alu_tables is not None):
+            # (table, carry in, store result) in the same order as above,
+            # ADC and SBC always carry in as their handlers do
+            alu = [
+                ('ADD', 0, True),
+                ('ADD', 1, True),
+                ('SUB', 0, True),
+                ('SUB', 1, True),
+                ('AND', 0, True),
+                ('XOR', 0, True),
+                ('OR', 0, True),
+                ('SUB', 0, False)
+            ]
+            for i, (name, carry, store) in enumerate(alu):
+                table = self.alu_tables[name]
+                offset = carry << 16
+                for j, r in enumerate(regs):
+                    if r is not None:
+                        ops[0x80 | (i << 3) | j] = partial(self.ALU_table_r, table, offset, store, r)
+                ops[0x86 | (i << 3)] = partial(self.ALU_table_HL, table, offset, store)
+                ops[0xC6 | (i << 3)] = partial(self.ALU_table_n, table, offset, store)
+
+        # INC/DEC
+        for i, r in enumerate(regs):
+            if r is not None:
+                ops[0x04 | (i << 3)] = partial(self.INC_r, r)
+                ops[0x05 | (i << 3)] = partial(self.DEC_r, r)
+        ops[0x34] = self.INC_HL
+        ops[0x35] = self.DEC_HL
 
         ## 16-bit ALU
-        elif (op == 0x09):
-            self.ADD_HL_n('BC')
-        elif (op == 0x19):
-            self.ADD_HL_n('DE')
-        elif (op == 0x29):
-            self.ADD_HL_n('HL')
-        elif (op == 0x39):
-            self.ADD_HL_n('SP')
-        elif (op == 0xE8):
-            self.ADD_SP_n()
-        elif (op == 0x03):
-            self.INC_nn('BC')
-        elif (op == 0x13):
-            self.INC_nn('DE')
-        elif (op == 0x23):
-            self.INC_nn('HL')
-        elif (op == 0x33):
-            self.INC_nn('SP')
-        elif (op == 0x0B):
-            self.DEC_nn('BC')
-        elif (op == 0x1B):
-            self.DEC_nn('DE')
-        elif (op == 0x2B):
-            self.DEC_nn('HL')
-        elif (op == 0x3B):
-            self.DEC_nn('SP')
+        for i, (hi, lo) in enumerate(pairs[:3]):
+            ops[0x09 | (i << 4)] = partial(self.ADD_HL_n, hi, lo)
+            ops[0x03 | (i << 4)] = partial(self.INC_nn, hi, lo)
+            ops[0x0B | (i << 4)] = partial(self.DEC_nn, hi, lo)
+        ops[0x39] = self.ADD_HL_SP
+        ops[0x33] = self.INC_SP
+        ops[0x3B] = self.DEC_SP
+        ops[0xE8] = self.ADD_SP_n
 
         # Misc
-        elif (op == 0x27):
-            self.DAA()
-        elif (op == 0x2F):
-            self.CPL()
-        elif (op == 0x3F):
-            self.CCF()
-        elif (op == 0x37):
-            self.SCF()
+        ops[0x27] = self.DAA
+        ops[0x2F] = self.CPL
+        ops[0x3F] = self.CCF
+        ops[0x37] = self.SCF
 
         # Rotates & shifts
-        elif (op == 0x07):
-            self.RLCA()
-        elif (op == 0x17):
-            self.RLA()
-        elif (op == 0x0F):
-            self.RRCA()
-        elif (op == 0x1F):
-            self.RRA()
+        ops[0x07] = self.RLCA
+        ops[0x17] = self.RLA
+        ops[0x0F] = self.RRCA
+        ops[0x1F] = self.RRA
 
         # Control flow
         # TODO: Sort out interrupts and the likes
-        elif (op == 0x00):
-            self.NOP()
-        elif (op == 0x76):
-            self.HALT()
-        elif (op == 0x10):
-            op2 = self.fetch_8()
-            if (op2 == 0x00):
-                self.STOP()
-        elif (op == 0xF3):
-            self.DI()
-        elif (op == 0xFB):
-            self.EI()
+        ops[0x00] = self.NOP
+        ops[0x76] = self.HALT
+        ops[0x10] = self.STOP
+        ops[0xF3] = self.DI
+        ops[0xFB] = self.EI
 
         # Jumps
-        elif (op == 0xC3):
-            self.JP_nn()
-        elif (op == 0xC2):
-            self.JP_NZ()
-        elif (op == 0xCA):
-            self.JP_Z()
-        elif (op == 0xD2):
-            self.JP_NC()
-        elif (op == 0xDA):
-            self.JP_C()
-        elif (op == 0xE9):
-            self.JP_HL()
-        elif (op == 0x18):
-            self.JR_n()
-        elif (op == 0x20):
-            self.JR_NZ()
-        elif (op == 0x28):
-            self.JR_Z()
-        elif (op == 0x30):
-            self.JR_NC()
-        elif (op == 0x38):
-            self.JR_C()
+        ops[0xC3] = self.JP_nn
+        ops[0xC2] = self.JP_NZ
+        ops[0xCA] = self.JP_Z
+        ops[0xD2] = self.JP_NC
+        ops[0xDA] = self.JP_C
+        ops[0xE9] = self.JP_HL
+        ops[0x18] = self.JR_n
+        ops[0x20] = self.JR_NZ
+        ops[0x28] = self.JR_Z
+        ops[0x30] = self.JR_NC
+        ops[0x38] = self.JR_C
 
         # Calls
-        elif (op == 0xCD):
-            self.CALL_nn()
-        elif (op == 0xC4):
-            self.CALL_NZ()
-        elif (op == 0xCC):
-            self.CALL_Z()
-        elif (op == 0xD4):
-            self.CALL_NC()
-        elif (op == 0xDC):
-            self.CALL_C()
+        ops[0xCD] = self.CALL_nn
+        ops[0xC4] = self.CALL_NZ
+        ops[0xCC] = self.CALL_Z
+        ops[0xD4] = self.CALL_NC
+        ops[0xDC] = self.CALL_C
 
         # Restarts
-        elif (op == 0xC7):
-            self.RST(0x00)
-        elif (op == 0xCF):
-            self.RST(0x08)
-        elif (op == 0xD7):
-            self.RST(0x10)
-        elif (op == 0xDF):
-            self.RST(0x18)
-        elif (op == 0xE7):
-            self.RST(0x20)
-        elif (op == 0xEF):
-            self.RST(0x28)
-        elif (op == 0xF7):
-            self.RST(0x30)
-        elif (op == 0xFF):
-            self.RST(0x38)
+        for n in range(0x00, 0x40, 0x08):
+            ops[0xC7 | n] = partial(self.RST, n)
 
         # Returns
-        elif (op == 0xC9):
-            self.RET()
-        elif (op == 0xC0):
-            self.RET_NZ()
-        elif (op == 0xC8):
-            self.RET_Z()
-        elif (op == 0xD0):
-            self.RET_NC()
-        elif (op == 0xD8):
-            self.RET_C()
-        elif (op == 0xD9):
-            self.RETI()
-
-        # Extended operations:
-        elif (op == 0xCB):
-            op2 = self.fetch_8()
-
-            # Swaps
-            if (op2 == 0x37):
-                self.SWAP_r('A')
-            elif (op2 == 0x30):
-                self.SWAP_r('B')
-            elif (op2 == 0x31):
-                self.SWAP_r('C')
-            elif (op2 == 0x32):
-                self.SWAP_r('D')
-            elif (op2 == 0x33):
-                self.SWAP_r('E')
-            elif (op2 == 0x34):
-                self.SWAP_r('H')
-            elif (op2 == 0x35):
-                self.SWAP_r('L')
-            elif (op2 == 0x36):
-                self.SWAP_HL()
-
-            # Rotates
-            elif (op2 == 0x07):
-                self.RLC_n('A')
-            elif (op2 == 0x00):
-                self.RLC_n('B')
-            elif (op2 == 0x01):
-                self.RLC_n('C')
-            elif (op2 == 0x02):
-                self.RLC_n('D')
-            elif (op2 == 0x03):
-                self.RLC_n('E')
-            elif (op2 == 0x04):
-                self.RLC_n('H')
-            elif (op2 == 0x05):
-                self.RLC_n('L')
-            elif (op2 == 0x17):
-                self.RL_n('A')
-            elif (op2 == 0x10):
-                self.RL_n('B')
-            elif (op2 == 0x11):
-                self.RL_n('C')
-            elif (op2 == 0x12):
-                self.RL_n('D')
-            elif (op2 == 0x13):
-                self.RL_n('E')
-            elif (op2 == 0x14):
-                self.RL_n('H')
-            elif (op2 == 0x15):
-                self.RL_n('L')
-            elif (op2 == 0x0F):
-                self.RRC_n('A')
-            elif (op2 == 0x08):
-                self.RRC_n('B')
-            elif (op2 == 0x09):
-                self.RRC_n('C')
-            elif (op2 == 0x0A):
-                self.RRC_n('D')
-            elif (op2 == 0x0B):
-                self.RRC_n('E')
-            elif (op2 == 0x0C):
-                self.RRC_n('H')
-            elif (op2 == 0x0D):
-                self.RRC_n('L')
-            elif (op2 == 0x1F):
-                self.RR_n('A')
-            elif (op2 == 0x18):
-                self.RR_n('B')
-            elif (op2 == 0x19):
-                self.RR_n('C')
-            elif (op2 == 0x1A):
-                self.RR_n('D')
-            elif (op2 == 0x1B):
-                self.RR_n('E')
-            elif (op2 == 0x1C):
-                self.RR_n('H')
-            elif (op2 == 0x1D):
-                self.RR_n('L')
-            elif (op2 == 0x06):
-                self.RLC_HL()
-            elif (op2 == 0x16):
-                self.RL_HL()
-            elif (op2 == 0x0E):
-                self.RRC_HL()
-            elif (op2 == 0x1E):
-                self.RR_HL()
-
-            # Shifts
-
-            elif (op2 == 0x27):
-                self.SLA_n('A')
-            elif (op2 == 0x20):
-                self.SLA_n('B')
-            elif (op2 == 0x21):
-                self.SLA_n('C')
-            elif (op2 == 0x22):
-                self.SLA_n('D')
-            elif (op2 == 0x23):
-                self.SLA_n('E')
-            elif (op2 == 0x24):
-                self.SLA_n('H')
-            elif (op2 == 0x25):
-                self.SLA_n('L')
-            elif (op2 == 0x2F):
-                self.SRA_n('A')
-            elif (op2 == 0x28):
-                self.SRA_n('B')
-            elif (op2 == 0x29):
-                self.SRA_n('C')
-            elif (op2 == 0x2A):
-                self.SRA_n('D')
-            elif (op2 == 0x2B):
-                self.SRA_n('E')
-            elif (op2 == 0x2C):
-                self.SRA_n('H')
-            elif (op2 == 0x2D):
-                self.SRA_n('L')
-            elif (op2 == 0x3F):
-                self.SRL_n('A')
-            elif (op2 == 0x38):
-                self.SRL_n('B')
-            elif (op2 == 0x39):
-                self.SRL_n('C')
-            elif (op2 == 0x3A):
-                self.SRL_n('D')
-            elif (op2 == 0x3B):
-                self.SRL_n('E')
-            elif (op2 == 0x3C):
-                self.SRL_n('H')
-            elif (op2 == 0x3D):
-                self.SRL_n('L')
-            elif (op2 == 0x26):
-                self.SLA_HL()
-            elif (op2 == 0x2E):
-                self.SRA_HL()
-            elif (op2 == 0x3E):
-                self.SRL_HL()
-
-            # Bit functions
-
-            elif (op2 >= 0x40 and op2 <= 0x7F):
-                self.BIT(op2)
-            elif (op2 >= 0xC0 and op2 <= 0xFF):
-                self.SET(op2)
-            elif (op2 >= 0x80 and op2 <= 0xBF):
-                self.RES(op2)
+        ops[0xC9] = self.RET
+        ops[0xC0] = self.RET_NZ
+        ops[0xC8] = self.RET_Z
+        ops[0xD0] = self.RET_NC
+        ops[0xD8] = self.RET_C
+        ops[0xD9] = self.RETI
+
+        # Extended operations
+        ops[0xCB] = self.execute_cb
+
+        return ops
+
+    def build_cb_table(self):
+        # Bits 0-2 select the register, (HL) sits at index 6
+        regs = [REG_B, REG_C, REG_D, REG_E, REG_H, REG_L, None, REG_A]
+        # Bits 3-5 select the rotate/shift, or the bit for BIT/RES/SET
+        shifts = [RLC, RRC, RL, RR, SLA, SRA, SWAP, SRL]
+        ops = []
+
+        for op in range(0x100):
+            r = regs[op & 0x07]
+            n = (op >> 3) & 0x07
+            if (op < 0x40):
+                ops.append(self.make_cb_shift(shifts[n], r))
+            elif (op < 0x80):
+                ops.append(self.make_BIT(n, r))
+            elif (op < 0xC0):
+                ops.append(self.make_RES(n, r))
             else:
-                raise NotImplementedError('Unknown opcode: 0xCB, ' + hex(op2))
+                ops.append(self.make_SET(n, r))
 
+        if (self.lazy_flags):
+            # Shifts and BIT read F directly, settle pending flags first
+            for op in range(0x80):
+                ops[op] = self.make_synced(ops[op])
 
-        else:
-            raise NotImplementedError('Unknown opcode: ' + hex(op))
+        return ops
 
     def handle_interrupts(self):
-        if self.interrupt_master_enable:
-            interrupt_flags = self.mmu.get(0xFF0F)
-            interrupt_enable = self.mmu.get(0xFFFF)
-            if interrupt_flags & interrupt_enable:
-                if (interrupt_flags & 1) & (interrupt_enable & 1):
-                    #V-Blank
-                    self.push_stack(self.pc)
-                    self.pc = 0x0040
-                    self.mmu.set(0xFF0F, interrupt_flags & ~1)
-                elif (interrupt_flags & 2) & (interrupt_enable & 2):
-                    #LCDC status
-                    self.push_stack(self.pc)
-                    self.pc = 0x0048
-                    self.mmu.set(0xFF0F, interrupt_flags & ~2)
-                elif (interrupt_flags & 4) & (interrupt_enable & 4):
-                    #Timer overflow
-                    self.push_stack(self.pc)
-                    self.pc = 0x0050
-                    self.mmu.set(0xFF0F, interrupt_flags & ~4)
-                elif (interrupt_flags & 8) & (interrupt_enable & 8):
-                    #Serial transfer complete
-                    self.push_stack(self.pc)
-                    self.pc = 0x0058
-                    self.mmu.set(0xFF0F, interrupt_flags & ~8)
-                elif (interrupt_flags & 16) & (interrupt_enable & 16):
-                    #P10-P13 input low
-                    self.push_stack(self.pc)
-                    self.pc = 0x0060
-                    self.mmu.set(0xFF0F, interrupt_flags & ~16)
-                self.interrupt_master_enable = False
+        # Only called while interrupts.ready is set
+        vector = self.interrupts.dispatch()
+        if (vector is None):
+            return
+        if (self.halted):
+            # Return to the instruction after HALT
+            self.halted = False
+            self.pc += 1
+        self.push_stack(self.pc)
+        self.pc = vector
+        self.cycles += INTERRUPT_CLOCKS
 
     ## OPCODE FUNCTIONS
     # 8-bit loads
 
-    def LD_nn_n(self, r, val):
-        self.regs[r] = val
+    def LD_nn_n(self, r):
+        self.regs[r] = self.fetch_8()
 
     def LD_r1_r2(self, r1, r2):
         self.regs[r1] = self.regs[r2]
 
     def LD_HL_r(self, r): #Technically part of LD r1, r2
-        addr = self.get_reg_16('HL')
+        addr = self.get_pair(REG_H, REG_L)
         self.mmu.set(addr, self.regs[r])
 
     def LD_r_HL(self, r): #Technically part of LD r1, r2
-        addr = self.get_reg_16('HL')
+        addr = self.get_pair(REG_H, REG_L)
         self.regs[r] = self.mmu.get(addr)
 
     def LD_HL_n(self): #Technically part of LD r1, r2
         n = self.fetch_8()
-        addr = self.get_reg_16('HL')
+        addr = self.get_pair(REG_H, REG_L)
         self.mmu.set(addr, n)
 
-    def LD_A_rr(self, reg):
-        addr = self.get_reg_16(reg)
-        self.set_reg_8('A', self.mmu.get(addr))
+    def LD_A_rr(self, hi, lo):
+        addr = self.get_pair(hi, lo)
+        self.regs[REG_A] = self.mmu.get(addr)
 
     def LD_A_nn(self):
         addr = self.fetch_16()
-        self.set_reg_8('A', self.mmu.get(addr))
+        self.regs[REG_A] = self.mmu.get(addr)
 
     def LD_A_n(self):
-        self.set_reg_8('A', self.fetch_8())
+        self.regs[REG_A] = self.fetch_8()
 
-    def LD_n_A(self, reg):
-        self.set_reg_8(reg, self.get_reg_8('A'))
-
-    def LD_rr_A(self, reg):
-        addr = self.get_reg_16(reg)
-        self.mmu.set(addr, self.get_reg_8('A'))
+    def LD_rr_A(self, hi, lo):
+        addr = self.get_pair(hi, lo)
+        self.mmu.set(addr, self.regs[REG_A])
 
     def LD_nn_A(self):
         addr = self.fetch_16()
-        self.mmu.set(addr, self.get_reg_8('A'))
+        self.mmu.set(addr, self.regs[REG_A])
 
     def LD_A_C(self):
-        self.set_reg_8('A', self.mmu.get(0xFF00 + self.get_reg_8('C')))
+        self.regs[REG_A] = self.mmu.get(0xFF00 + self.regs[REG_C])
 
     def LD_C_A(self):
-        self.mmu.set(0xFF00 + self.get_reg_8('C'), self.get_reg_8('A'))
+        self.mmu.set(0xFF00 + self.regs[REG_C], self.regs[REG_A])
 
     def LDD_A_HL(self):
-        self.set_reg_8('A', self.mmu.get(self.get_reg_16('HL')))
-        HL = self.get_reg_16('HL')
-        self.set_reg_16('HL', HL - (1 if (HL > 0x00) else -0xFFFF))
+        self.regs[REG_A] = self.mmu.get(self.get_pair(REG_H, REG_L))
+        HL = self.get_pair(REG_H, REG_L)
+        self.set_pair(REG_H, REG_L, HL - (1 if (HL > 0x00) else -0xFFFF))
 
     def LDD_HL_A(self):
-        self.mmu.set(self.get_reg_16('HL'), self.get_reg_8('A'))
-        HL = self.get_reg_16('HL')
-        self.set_reg_16('HL', HL - (1 if (HL > 0x00) else -0xFFFF))
+        self.mmu.set(self.get_pair(REG_H, REG_L), self.regs[REG_A])
+        HL = self.get_pair(REG_H, REG_L)
+        self.set_pair(REG_H, REG_L, HL - (1 if (HL > 0x00) else -0xFFFF))
 
     def LDI_A_HL(self):
-        self.set_reg_8('A', self.mmu.get(self.get_reg_16('HL')))
-        HL = self.get_reg_16('HL')
-        self.set_reg_16('HL', HL + (1 if (HL < 0xFFFF) else -0xFFFF))
+        self.regs[REG_A] = self.mmu.get(self.get_pair(REG_H, REG_L))
+        HL = self.get_pair(REG_H, REG_L)
+        self.set_pair(REG_H, REG_L, HL + (1 if (HL < 0xFFFF) else -0xFFFF))
 
     def LDI_HL_A(self):
-        self.mmu.set(self.get_reg_16('HL'), self.get_reg_8('A'))
-        HL = self.get_reg_16('HL')
-        self.set_reg_16('HL', HL + (1 if (HL < 0xFFFF) else -0xFFFF))
+        self.mmu.set(self.get_pair(REG_H, REG_L), self.regs[REG_A])
+        HL = self.get_pair(REG_H, REG_L)
+        self.set_pair(REG_H, REG_L, HL + (1 if (HL < 0xFFFF) else -0xFFFF))
 
     def LDH_n_A(self):
         n = self.fetch_8()
-        self.mmu.set(0xFF00 + n, self.get_reg_8('A'))
+        self.mmu.set(0xFF00 + n, self.regs[REG_A])
 
     def LDH_A_n(self):
         n = self.fetch_8()
-        self.set_reg_8('A', self.mmu.get(0xFF00 + n))
+        self.regs[REG_A] = self.mmu.get(0xFF00 + n)
 
     # 16-bit loads
 
-    def LD_n_nn(self, reg):
-        self.set_reg_16(reg, self.fetch_16())
+    def LD_n_nn(self, hi, lo):
+        self.set_pair(hi, lo, self.fetch_16())
+
+    def LD_SP_nn(self):
+        self.sp = self.fetch_16()
 
     def LD_SP_HL(self):
-        self.set_reg_16('SP', self.get_reg_16('HL'))
+        self.sp = self.get_pair(REG_H, REG_L)
 
     def LD_HL_SPn(self):
-        self.set_reg_16('HL', self.add_16(self.fetch_8(), self.get_reg_16('SP')))
+        self.set_pair(REG_H, REG_L, self.add_16(self.fetch_8(), self.sp))
 
     def LD_nn_SP(self):
-        val = self.get_reg_16('SP')
+        val = self.sp
         addr = self.fetch_16()
         self.mmu.set(addr, (val & 0x00FF))
         self.mmu.set(addr + 1, (val & 0xFF00) >> 8)
 
-    def PUSH_nn(self, reg):
-        self.push_stack(self.get_reg_16(reg))
+    def PUSH_nn(self, hi, lo):
+        self.push_stack(self.get_pair(hi, lo))
+
+    def POP_nn(self, hi, lo):
+        self.set_pair(hi, lo, self.pop_stack())
 
-    def POP_nn(self, reg):
-        self.set_reg_16(reg, self.pop_stack())
+    def PUSH_AF(self):
+        self.sync_flags()
+        self.push_stack(self.get_pair(REG_A, REG_F))
+
+    def POP_AF(self):
+        self.pending_flags = None
+        self.set_pair(REG_A, REG_F, self.pop_stack())
 
     def ADD_A_r(self, reg):
-        self.set_reg_8('A', self.add_8(
-            self.get_reg_8('A'),
-            self.get_reg_8(reg)
-        ))
+        self.regs[REG_A] = self.add_8(
+            self.regs[REG_A],
+            self.regs[reg]
+        )
 
     def ADD_A_HL(self):
-        self.set_reg_8('A', self.add_8(
-            self.get_reg_8('A'),
-            self.mmu.get(self.get_reg_16('HL'))
-        ))
+        self.regs[REG_A] = self.add_8(
+            self.regs[REG_A],
+            self.mmu.get(self.get_pair(REG_H, REG_L))
+        )
 
     def ADD_A_n(self):
-        self.set_reg_8('A', self.add_8(
-            self.get_reg_8('A'),
+        self.regs[REG_A] = self.add_8(
+            self.regs[REG_A],
             self.fetch_8()
-        ))
+        )
 
     def ADC_A_r(self, reg):
-        self.set_reg_8('A', self.add_8(
-            self.get_reg_8('A'),
-            self.get_reg_8(reg),
+        self.regs[REG_A] = self.add_8(
+            self.regs[REG_A],
+            self.regs[reg],
             True
-        ))
+        )
 
     def ADC_A_HL(self):
-        self.set_reg_8('A', self.add_8(
-            self.get_reg_8('A'),
-            self.mmu.get(self.get_reg_16('HL')),
+        self.regs[REG_A] = self.add_8(
+            self.regs[REG_A],
+            self.mmu.get(self.get_pair(REG_H, REG_L)),
             True
-        ))
+        )
 
     def ADC_A_n(self):
-        self.set_reg_8('A', self.add_8(
-            self.get_reg_8('A'),
+        self.regs[REG_A] = self.add_8(
+            self.regs[REG_A],
             self.fetch_8(),
             True
-        ))
+        )
 
     def SUB_A_r(self, reg):
-        self.set_reg_8('A', self.sub_8(
-            self.get_reg_8('A'),
-            self.get_reg_8(reg)
-        ))
+        self.regs[REG_A] = self.sub_8(
+            self.regs[REG_A],
+            self.regs[reg]
+        )
 
     def SUB_A_HL(self):
-        self.set_reg_8('A', self.sub_8(
-            self.get_reg_8('A'),
-            self.mmu.get(self.get_reg_16('HL'))
-        ))
+        self.regs[REG_A] = self.sub_8(
+            self.regs[REG_A],
+            self.mmu.get(self.get_pair(REG_H, REG_L))
+        )
 
     def SUB_A_n(self):
-        self.set_reg_8('A', self.sub_8(
-            self.get_reg_8('A'),
+        self.regs[REG_A] = self.sub_8(
+            self.regs[REG_A],
             self.fetch_8()
-        ))
+        )
 
     def SBC_A_r(self, reg):
-        self.set_reg_8('A', self.sub_8(
-            self.get_reg_8('A'),
-            self.get_reg_8(reg),
+        self.regs[REG_A] = self.sub_8(
+            self.regs[REG_A],
+            self.regs[reg],
             True
-        ))
+        )
 
     def SBC_A_HL(self):
-        self.set_reg_8('A', self.sub_8(
-            self.get_reg_8('A'),
-            self.mmu.get(self.get_reg_16('HL')),
+        self.regs[REG_A] = self.sub_8(
+            self.regs[REG_A],
+            self.mmu.get(self.get_pair(REG_H, REG_L)),
             True
-        ))
+        )
 
     def SBC_A_n(self):
-        self.set_reg_8('A', self.sub_8(
-            self.get_reg_8('A'),
+        self.regs[REG_A] = self.sub_8(
+            self.regs[REG_A],
             self.fetch_8(),
             True
-        ))
+        )
 
     def AND_r(self, reg):
-        result = self.get_reg_8('A') & self.get_reg_8(reg)
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] & self.regs[reg]
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 1)
         self.set_flag('C', 0)
 
     def AND_HL(self):
-        result = self.get_reg_8('A') & self.mmu.get(self.get_reg_16('HL'))
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] & self.mmu.get(self.get_pair(REG_H, REG_L))
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 1)
         self.set_flag('C', 0)
 
     def AND_n(self):
-        result = self.get_reg_8('A') & self.fetch_8()
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] & self.fetch_8()
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 1)
         self.set_flag('C', 0)
 
     def OR_r(self, reg):
-        result = self.get_reg_8('A') | self.get_reg_8(reg)
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] | self.regs[reg]
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 0)
         self.set_flag('C', 0)
 
     def OR_HL(self):
-        result = self.get_reg_8('A') | self.mmu.get(self.get_reg_16('HL'))
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] | self.mmu.get(self.get_pair(REG_H, REG_L))
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 0)
         self.set_flag('C', 0)
 
     def OR_n(self):
-        result = self.get_reg_8('A') | self.fetch_8()
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] | self.fetch_8()
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 0)
         self.set_flag('C', 0)
 
     def XOR_r(self, reg):
-        result = self.get_reg_8('A') ^ self.get_reg_8(reg)
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] ^ self.regs[reg]
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 0)
         self.set_flag('C', 0)
 
     def XOR_HL(self):
-        result = self.get_reg_8('A') ^ self.mmu.get(self.get_reg_16('HL'))
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] ^ self.mmu.get(self.get_pair(REG_H, REG_L))
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 0)
         self.set_flag('C', 0)
 
     def XOR_n(self):
-        result = self.get_reg_8('A') ^ self.fetch_8()
-        self.set_reg_8('A', result)
+        result = self.regs[REG_A] ^ self.fetch_8()
+        self.regs[REG_A] = result
         self.set_flag('Z', int(result == 0x00))
         self.set_flag('N', 0)
         self.set_flag('H', 0)
         self.set_flag('C', 0)
 
+    # Table-driven 8-bit ALU, one lookup gives the result and Z/N/H/C
+
+    def ALU_table_r(self, table, offset, store, reg):
+        regs = self.regs
+        entry = table[offset | (regs[REG_A] << 8) | regs[reg]]
+        self.pending_flags = None
+        regs[REG_F] = (regs[REG_F] & 0x0F) | (entry >> 8)
+        if (store):
+            regs[REG_A] = entry & 0xFF
+
+    def ALU_table_HL(self, table, offset, store):
+        regs = self.regs
+        val = self.mmu.get(self.get_pair(REG_H, REG_L))
+        entry = table[offset | (regs[REG_A] << 8) | val]
+        self.pending_flags = None
+        regs[REG_F] = (regs[REG_F] & 0x0F) | (entry >> 8)
+        if (store):
+            regs[REG_A] = entry & 0xFF
+
+    def ALU_table_n(self, table, offset, store):
+        regs = self.regs
+        val = self.fetch_8()
+        entry = table[offset | (regs[REG_A] << 8) | val]
+        self.pending_flags = None
+        regs[REG_F] = (regs[REG_F] & 0x0F) | (entry >> 8)
+        if (store):
+            regs[REG_A] = entry & 0xFF
+
     def CP_r(self, reg):
-        a = self.get_reg_8('A')
+        a = self.regs[REG_A]
         self.SUB_A_r(reg)
-        self.set_reg_8('A', a)
+        self.regs[REG_A] = a
 
     def CP_HL(self):
-        a = self.get_reg_8('A')
+        a = self.regs[REG_A]
         self.SUB_A_HL()
-        self.set_reg_8('A', a)
+        self.regs[REG_A] = a
 
     def CP_n(self):
-        a = self.get_reg_8('A')
+        a = self.regs[REG_A]
         self.SUB_A_n()
-        self.set_reg_8('A', a)
+        self.regs[REG_A] = a
 
     def INC_r(self, reg):
-        result = (self.get_reg_8(reg) + 1) % 0x100
+        result = (self.regs[reg] + 1) % 0x100
         self.set_flag('Z', (result == 0x00))
         self.set_flag('N', False)
-        self.set_flag('H', int(((self.get_reg_8(reg) & 0x0F) + 0x01) > 0x0F))
-        self.set_reg_8(reg, result)
+        self.set_flag('H', int(((self.regs[reg] & 0x0F) + 0x01) > 0x0F))
+        self.regs[reg] = result
 
     def INC_HL(self):
-        result = (self.mmu.get(self.get_reg_16('HL')) + 1) % 0x100
+        result = (self.mmu.get(self.get_pair(REG_H, REG_L)) + 1) % 0x100
         self.set_flag('Z', (result == 0x00))
         self.set_flag('N', False)
-        self.set_flag('H', int(((self.mmu.get(self.get_reg_16('HL')) & 0x0F) + 0x01) > 0x0F))
-        self.mmu.set(self.get_reg_16('HL'), result)
+        self.set_flag('H', int(((self.mmu.get(self.get_pair(REG_H, REG_L)) & 0x0F) + 0x01) > 0x0F))
+        self.mmu.set(self.get_pair(REG_H, REG_L), result)
 
     def DEC_r(self, reg):
-        result = (self.get_reg_8(reg) - 1) % 0x100
+        result = (self.regs[reg] - 1) % 0x100
         self.set_flag('Z', (result == 0x00))
         self.set_flag('N', True)
-        self.set_flag('H', int(self.get_reg_8(reg) & 0x0F) == 0)
-        self.set_reg_8(reg, result)
+        self.set_flag('H', int(self.regs[reg] & 0x0F) == 0)
+        self.regs[reg] = result
 
     def DEC_HL(self):
-        result = (self.mmu.get(self.get_reg_16('HL')) - 1) % 0x100
+        result = (self.mmu.get(self.get_pair(REG_H, REG_L)) - 1) % 0x100
         self.set_flag('Z', (result == 0x00))
         self.set_flag('N', True)
-        self.set_flag('H', int((self.mmu.get(self.get_reg_16('HL')) & 0x0F) == 0))
-        self.mmu.set(self.get_reg_16('HL'), result)
+        self.set_flag('H', int((self.mmu.get(self.get_pair(REG_H, REG_L)) & 0x0F) == 0))
+        self.mmu.set(self.get_pair(REG_H, REG_L), result)
+
+    def ADD_HL_n(self, hi, lo):
+        # Ensure Z isn't affected
+        z = self.get_flag('Z')
+        self.set_pair(REG_H, REG_L, self.add_16(
+            self.get_pair(REG_H, REG_L),
+            self.get_pair(hi, lo),
+            False
+        ))
+        self.set_flag('Z', z)
 
-    def ADD_HL_n(self, reg):
+    def ADD_HL_SP(self):
         # Ensure Z isn't affected
         z = self.get_flag('Z')
-        self.set_reg_16('HL', self.add_16(
-            self.get_reg_16('HL'),
-            self.get_reg_16(reg),
+        self.set_pair(REG_H, REG_L, self.add_16(
+            self.get_pair(REG_H, REG_L),
+            self.sp,
             False
         ))
         self.set_flag('Z', z)
 
     def ADD_SP_n(self):
-        self.set_reg_16('SP', self.add_16(
-            self.get_reg_16('SP'),
+        self.sp = self.add_16(
+            self.sp,
             self.fetch_16(),
             False
-        ))
+        )
         self.set_flag('Z', 0)
 
-    def INC_nn(self, reg):
-        self.set_reg_16(reg, (self.get_reg_16(reg) + 1) % 0x10000)
-
-    def DEC_nn(self, reg):
-        self.set_reg_16(reg, (self.get_reg_16(reg) - 1) % 0x10000)
-
-    def SWAP_r(self, reg):
-        oldval = self.get_reg_8(reg)
-        hi = (oldval & 0xF0) >> 4
-        lo = oldval & 0x0F
-        newval = (lo << 4) | hi
+    def INC_nn(self, hi, lo):
+        self.set_pair(hi, lo, (self.get_pair(hi, lo) + 1) % 0x10000)
 
-        self.set_reg_8(reg, newval)
+    def DEC_nn(self, hi, lo):
+        self.set_pair(hi, lo, (self.get_pair(hi, lo) - 1) % 0x10000)
 
-    def SWAP_HL(self):
-        oldval = self.mmu.get(self.get_reg_16('HL'))
-        hi = (oldval & 0xF0) >> 4
-        lo = oldval & 0x0F
-        newval = (lo << 4) | hi
+    def INC_SP(self):
+        self.sp = (self.sp + 1) % 0x10000
 
-        self.mmu.set(self.get_reg_16('HL'), newval)
+    def DEC_SP(self):
+        self.sp = (self.sp - 1) % 0x10000
 
     def DAA(self):
-        a = self.get_reg_8('A')
+        a = self.regs[REG_A]
         c = self.get_flag('C')
         h = self.get_flag('H')
 
@@ -1233,12 +1072,12 @@ class CPU:
             if (h or (a & 0x0F) > 0x09):
                 a += 0x06
 
-        self.set_reg_8('A', a % 0x100)
+        self.regs[REG_A] = a % 0x100
         self.set_flag('Z', int(a == 0))
         self.set_flag('H', 0)
 
     def CPL(self):
-        self.set_reg_8('A', self.get_reg_8('A') ^ 0xFF)
+        self.regs[REG_A] = self.regs[REG_A] ^ 0xFF
         self.set_flag('N', 1)
         self.set_flag('H', 1)
 
@@ -1256,50 +1095,63 @@ class CPU:
         pass
 
     def HALT(self):
-        print('HALT called, not implemented, passing')
-        pass
+        # Sleep until an enabled interrupt is requested. While asleep HALT
+        # stays at pc and runs again, skipping time to the next scheduled
+        # event or the end of the current run rather than stepping.
+        if (self.interrupts.pending):
+            self.halted = False
+            return
+
+        self.halted = True
+        self.pc -= 1
+        # The caller adds HALT's own 4 clocks
+        wake = min(self.scheduler.next_time, self.cycle_target) - CLOCKS[0x76]
+        if (wake > self.cycles):
+            self.cycles = wake
 
     def STOP(self):
-        print('STOP called, not implemented, passing')
-        pass
+        # STOP is followed by a 0x00 byte
+        if (self.fetch_8() == 0x00):
+            print('STOP called, not implemented, passing')
 
     def DI(self):
-        self.interrupt_master_enable = False
+        self.interrupts.set_ime(False)
 
     def EI(self):
-        self.interrupt_master_enable = True
+        # Enabled once the next instruction has run
+        self.interrupts.enable_delayed()
 
     # Rotates
 
     def RLCA(self):
-        val = self.get_reg_8('A') << 1
+        val = self.regs[REG_A] << 1
 
         if ((val & 0x100) >> 8 == 1):
             val -= 0x100
             val += 0x01
 
-        self.set_flag('C', (self.get_reg_8('A') & 0b10000000) >> 7)
+        self.set_flag('C', (self.regs[REG_A] & 0b10000000) >> 7)
         self.set_flag('Z', 1 if val == 0 else 0)
         self.set_flag('N', 0)
         self.set_flag('H', 0)
-        self.set_reg_8('A', val)
+        self.regs[REG_A] = val
 
     def RLA(self):
-        val = self.get_reg_8('A') << 1
+        val = self.regs[REG_A] << 1
 
         if ((val & 0x100) >> 8 == 1):
             val -= 0x100
 
         val += self.get_flag('C')
 
-        self.set_flag('C', (self.get_reg_8('A') & 0b10000000) >> 7)
+        self.set_flag('C', (self.regs[REG_A] & 0b10000000) >> 7)
         self.set_flag('Z', 1 if val == 0 else 0)
         self.set_flag('N', 0)
         self.set_flag('H', 0)
-        self.set_reg_8('A', val)
+        self.regs[REG_A] = val
 
     def RRCA(self):
-        val = self.get_reg_8('A')
+        val = self.regs[REG_A]
 
         carry = val % 2
         self.set_flag('C', carry)
@@ -1307,297 +1159,98 @@ class CPU:
         val = val >> 1
         val += 0x80 * carry
 
-        self.set_reg_8('A', val)
+        self.regs[REG_A] = val
         self.set_flag('Z', 1 if val == 0 else 0)
         self.set_flag('N', 0)
         self.set_flag('H', 0)
 
     def RRA(self):
-        val = self.get_reg_8('A')
-        old_c = self.get_flag('C')
-
-        self.set_flag('C', val % 2)
-        val -= val % 2
-
-        self.set_reg_8('A', (val >> 1) + (old_c * 0x80))
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-
-    def RLC_n(self, reg):
-        val = self.get_reg_8(reg) << 1
-
-        if ((val & 0x100) >> 8 == 1):
-            val -= 0x100
-            val += 0x01
-
-        self.set_flag('C', (self.get_reg_8(reg) & 0b10000000) >> 7)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-        self.set_reg_8(reg, val)
-
-    def RL_n(self, reg):
-        val = self.get_reg_8(reg) << 1
-
-        if ((val & 0x100) >> 8 == 1):
-            val -= 0x100
-
-        val += self.get_flag('C')
-
-        self.set_flag('C', (self.get_reg_8(reg) & 0b10000000) >> 7)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-        self.set_reg_8(reg, val)
-
-    def RRC_n(self, reg):
-        val = self.get_reg_8(reg)
-
-        carry = val % 2
-        self.set_flag('C', carry)
-        val -= carry
-        val = val >> 1
-        val += 0x80 * carry
-
-        self.set_reg_8(reg, val)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-
-    def RR_n(self, reg):
-        val = self.get_reg_8(reg)
-        old_c = self.get_flag('C')
-
-        self.set_flag('C', val % 2)
-        val -= val % 2
-
-        self.set_reg_8(reg, (val >> 1) + (old_c * 0x80))
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-
-    def RLC_HL(self):
-        val = self.mmu.get(self.get_reg_16('HL')) << 1
-
-        if ((val & 0x100) >> 8 == 1):
-            val -= 0x100
-            val += 0x01
-
-        self.set_flag('C', (self.mmu.get(self.get_reg_16('HL')) & 0b10000000) >> 7)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-        self.mmu.set(self.get_reg_16('HL'), val)
-
-    def RL_HL(self):
-        val = self.mmu.get(self.get_reg_16('HL')) << 1
-
-        if ((val & 0x100) >> 8 == 1):
-            val -= 0x100
-
-        val += self.get_flag('C')
-
-        self.set_flag('C', (self.mmu.get(self.get_reg_16('HL')) & 0b10000000) >> 7)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-        self.mmu.set(self.get_reg_16('HL'), val)
-
-    def RRC_HL(self):
-        val = self.mmu.get(self.get_reg_16('HL'))
-
-        carry = val % 2
-        self.set_flag('C', carry)
-        val -= carry
-        val = val >> 1
-        val += 0x80 * carry
-
-        self.mmu.set(self.get_reg_16('HL'), val)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-
-    def RR_HL(self):
-        val = self.mmu.get(self.get_reg_16('HL'))
+        val = self.regs[REG_A]
         old_c = self.get_flag('C')
 
         self.set_flag('C', val % 2)
         val -= val % 2
 
-        self.mmu.set(self.get_reg_16('HL'), (val >> 1) + (old_c * 0x80))
+        self.regs[REG_A] = (val >> 1) + (old_c * 0x80)
         self.set_flag('Z', 1 if val == 0 else 0)
         self.set_flag('N', 0)
         self.set_flag('H', 0)
 
-    # Shifts
+    # CB-prefixed operations
+    # Built once per CPU with the target register and bit baked in
 
-    def SLA_n(self, reg):
-        val = self.get_reg_8(reg) << 1
+    def make_synced(self, handler):
+        sync = self.sync_flags
 
-        if ((val & 0x100) >> 8 == 1):
-            val -= 0x100
+        def op():
+            sync()
+            handler()
 
-        self.set_flag('C', (self.get_reg_8(reg) & 0b10000000) >> 7)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-        self.set_reg_8(reg, val)
+        return op
 
-    def SRA_n(self, reg):
-        val = self.get_reg_8(reg)
-        msb = val & 0b10000000
+    def make_cb_shift(self, shift, r):
+        regs = self.regs
+        mmu = self.mmu
 
-        self.set_flag('C', val % 2)
-        val -= val % 2
-        val = val >> 1
-        val += msb
-
-        self.set_reg_8(reg, val)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-
-    def SRL_n(self, reg):
-        val = self.get_reg_8(reg)
-
-        self.set_flag('C', val % 2)
-        val -= val % 2
-        val = val >> 1
-
-        self.set_reg_8(reg, val)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-
-    def SLA_HL(self):
-        val = self.mmu.get(self.get_reg_16('HL')) << 1
-
-        if ((val & 0x100) >> 8 == 1):
-            val -= 0x100
-
-        self.set_flag('C', (self.mmu.get(self.get_reg_16('HL')) & 0b10000000) >> 7)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-        self.mmu.set(self.get_reg_16('HL'), val)
-
-    def SRA_HL(self):
-        val = self.mmu.get(self.get_reg_16('HL'))
-        msb = val & 0b10000000
-
-        self.set_flag('C', val % 2)
-        val -= val % 2
-        val = val >> 1
-        val += msb
-
-        self.mmu.set(self.get_reg_16('HL'), val)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
+        if (r is None):
+            def op():
+                addr = (regs[REG_H] << 8) | regs[REG_L]
+                result, carry = shift(mmu.get(addr), (regs[REG_F] & 0x10) >> 4)
+                mmu.set(addr, result)
+                regs[REG_F] = (regs[REG_F] & 0x0F) | (0x00 if result else 0x80) | (carry << 4)
+        else:
+            def op():
+                result, carry = shift(regs[r], (regs[REG_F] & 0x10) >> 4)
+                regs[r] = result
+                regs[REG_F] = (regs[REG_F] & 0x0F) | (0x00 if result else 0x80) | (carry << 4)
+
+        return op
+
+    def make_BIT(self, bit, r):
+        regs = self.regs
+        mmu = self.mmu
+        mask = 0x01 << bit
+
+        # Z is set if the bit is clear, N reset, H set, C unaffected
+        if (r is None):
+            def op():
+                val = mmu.get((regs[REG_H] << 8) | regs[REG_L])
+                regs[REG_F] = (regs[REG_F] & 0x1F) | (0x20 if val & mask else 0xA0)
+        else:
+            def op():
+                regs[REG_F] = (regs[REG_F] & 0x1F) | (0x20 if regs[r] & mask else 0xA0)
 
-    def SRL_HL(self):
-        val = self.mmu.get(self.get_reg_16('HL'))
+        return op
 
-        self.set_flag('C', val % 2)
-        val -= val % 2
-        val = val >> 1
+    def make_SET(self, bit, r):
+        regs = self.regs
+        mmu = self.mmu
+        mask = 0x01 << bit
 
-        self.mmu.set(self.get_reg_16('HL'), val)
-        self.set_flag('Z', 1 if val == 0 else 0)
-        self.set_flag('N', 0)
-        self.set_flag('H', 0)
-
-    def BIT(self, opcode):
-        opcode -= 0x40
-        reg_index = opcode & 0b00000111
-
-        reg = ''
-        if (reg_index == 0):
-            reg = 'B'
-        elif (reg_index == 1):
-            reg = 'C'
-        elif (reg_index == 2):
-            reg = 'D'
-        elif (reg_index == 3):
-            reg = 'E'
-        elif (reg_index == 4):
-            reg = 'H'
-        elif (reg_index == 5):
-            reg = 'L'
-        elif (reg_index == 6):
-            reg = 'HL'
-        elif (reg_index == 7):
-            reg = 'A'
-
-        bit = int((opcode & 0b11111000) / 0x08)
-
-        if (reg == 'HL'):
-            self.set_flag('Z', (self.mmu.get(self.get_reg_16(reg)) >> bit) ^ 0x01)
+        if (r is None):
+            def op():
+                addr = (regs[REG_H] << 8) | regs[REG_L]
+                mmu.set(addr, mmu.get(addr) | mask)
         else:
-            self.set_flag('Z', (self.get_reg_8(reg) >> bit) ^ 0x01)
+            def op():
+                regs[r] = regs[r] | mask
 
-        self.set_flag('N', 0)
-        self.set_flag('H', 1)
+        return op
 
-    def SET(self, opcode):
-        opcode -= 0xC0
-        reg_index = opcode & 0b00000111
-
-        reg = ''
-        if (reg_index == 0):
-            reg = 'B'
-        elif (reg_index == 1):
-            reg = 'C'
-        elif (reg_index == 2):
-            reg = 'D'
-        elif (reg_index == 3):
-            reg = 'E'
-        elif (reg_index == 4):
-            reg = 'H'
-        elif (reg_index == 5):
-            reg = 'L'
-        elif (reg_index == 6):
-            reg = 'HL'
-        elif (reg_index == 7):
-            reg = 'A'
-
-        bit = int((opcode & 0b11111000) / 0x08)
-
-        if (reg == 'HL'):
-            self.mmu.set(self.get_reg_16(reg), self.mmu.get(self.get_reg_16(reg)) | (0x01 << bit))
-        else:
-            self.set_reg_8(reg, self.get_reg_8(reg) | (0x01 << bit))
-        self.set_flag('H', 1)
+    def make_RES(self, bit, r):
+        regs = self.regs
+        mmu = self.mmu
+        mask = (0x01 << bit) ^ 0xFF
 
-    def RES(self, opcode):
-        opcode -= 0x80
-        reg_index = opcode & 0b00000111
-
-        reg = ''
-        if (reg_index == 0):
-            reg = 'B'
-        elif (reg_index == 1):
-            reg = 'C'
-        elif (reg_index == 2):
-            reg = 'D'
-        elif (reg_index == 3):
-            reg = 'E'
-        elif (reg_index == 4):
-            reg = 'H'
-        elif (reg_index == 5):
-            reg = 'L'
-        elif (reg_index == 6):
-            reg = 'HL'
-        elif (reg_index == 7):
-            reg = 'A'
-
-        bit = int((opcode & 0b11111000) / 0x08)
-
-        if (reg == 'HL'):
-            self.mmu.set(self.get_reg_16(reg), self.mmu.get(self.get_reg_16(reg)) & ((0x01 << bit)^ 0xFF))
+        if (r is None):
+            def op():
+                addr = (regs[REG_H] << 8) | regs[REG_L]
+                mmu.set(addr, mmu.get(addr) & mask)
         else:
-            self.set_reg_8(reg, self.get_reg_8(reg) & ((0x01 << bit) ^ 0xFF))
+            def op():
+                regs[r] = regs[r] & mask
+
+        return op
 
     # Jumps
 
@@ -1607,54 +1260,64 @@ class CPU:
     def JP_NZ(self):
         if (self.get_flag('Z') == 0):
             self.pc = self.fetch_16()
+            self.cycles += 4
         else:
             self.pc += 2
 
     def JP_Z(self):
         if (self.get_flag('Z') == 1):
             self.pc = self.fetch_16()
+            self.cycles += 4
         else:
             self.pc += 2
 
     def JP_NC(self):
         if (self.get_flag('C') == 0):
             self.pc = self.fetch_16()
+            self.cycles += 4
         else:
             self.pc += 2
 
     def JP_C(self):
         if (self.get_flag('C') == 1):
             self.pc = self.fetch_16()
+            self.cycles += 4
         else:
             self.pc += 2
 
     def JP_HL(self):
-        self.pc = self.get_reg_16('HL')
+        self.pc = self.get_pair(REG_H, REG_L)
 
     def JR_n(self):
-        self.pc += self.fetch_8()
+        # Signed offset from the next instruction
+        n = self.fetch_8()
+        self.pc = (self.pc + (n ^ 0x80) - 0x80) & 0xFFFF
 
     def JR_NZ(self):
         if (self.get_flag('Z') == 0):
-            self.pc += self.fetch_8()
+            self.JR_n()
+            self.cycles += 4
         else:
             self.pc += 1
 
     def JR_Z(self):
         if (self.get_flag('Z') == 1):
-            self.pc += self.fetch_8()
+            self.JR_n()
+            self.cycles += 4
         else:
             self.pc += 1
 
     def JR_NC(self):
         if (self.get_flag('C') == 0):
-            self.pc += self.fetch_8()
+            self.JR_n()
+            self.cycles += 4
         else:
             self.pc += 1
 
     def JR_C(self):
         if (self.get_flag('C') == 1):
-            self.pc += self.fetch_8()
+            self.JR_n()
+            self.cycles += 4
         else:
             self.pc += 1
 
@@ -1667,24 +1330,28 @@ class CPU:
     def CALL_NZ(self):
         if (self.get_flag('Z') == 0):
             self.CALL_nn()
+            self.cycles += 12
         else:
             self.pc += 2
 
     def CALL_Z(self):
         if (self.get_flag('Z') == 1):
             self.CALL_nn()
+            self.cycles += 12
         else:
             self.pc += 2
 
     def CALL_NC(self):
         if (self.get_flag('C') == 0):
             self.CALL_nn()
+            self.cycles += 12
         else:
             self.pc += 2
 
     def CALL_C(self):
         if (self.get_flag('C') == 1):
             self.CALL_nn()
+            self.cycles += 12
         else:
             self.pc += 2
 
@@ -1702,19 +1369,24 @@ class CPU:
     def RET_NZ(self):
         if (self.get_flag('Z') == 0):
             self.RET()
+            self.cycles += 12
 
     def RET_Z(self):
         if (self.get_flag('Z') == 1):
             self.RET()
+            self.cycles += 12
 
     def RET_NC(self):
         if (self.get_flag('C') == 0):
             self.RET()
+            self.cycles += 12
 
     def RET_C(self):
         if (self.get_flag('C') == 1):
             self.RET()
+            self.cycles += 12
 
     def RETI(self):
-        self.EI()
+        # Unlike EI, no delay
+        self.interrupts.set_ime(True)
         self.RET()
@@ -0,0 +1,54 @@
+## Instruction timings
+# M-cycles per opcode. Conditional jumps, calls and returns are listed at
+# their not-taken cost, BRANCH_CYCLES holds what a taken branch adds.
+# 0 marks opcodes the CPU doesn't have.
+
+CYCLES = [
+    # 0  1  2  3  4  5  6  7  8  9  A  B  C  D  E  F
+    1, 3, 2, 2, 1, 1, 2, 1, 5, 2, 2, 2, 1, 1, 2, 1, # 0x00
+    1, 3, 2, 2, 1, 1, 2, 1, 3, 2, 2, 2, 1, 1, 2, 1, # 0x10
+    2, 3, 2, 2, 1, 1, 2, 1, 2, 2, 2, 2, 1, 1, 2, 1, # 0x20
+    2, 3, 2, 2, 3, 3, 3, 1, 2, 2, 2, 2, 1, 1, 2, 1, # 0x30
+    1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 1, 2, 1, # 0x40
+    1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 1, 2, 1, # 0x50
+    1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 1, 2, 1, # 0x60
+    2, 2, 2, 2, 2, 2, 1, 2, 1, 1, 1, 1, 1, 1, 2, 1, # 0x70
+    1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 1, 2, 1, # 0x80
+    1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 1, 2, 1, # 0x90
+    1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 1, 2, 1, # 0xA0
+    1, 1, 1, 1, 1, 1, 2, 1, 1, 1, 1, 1, 1, 1, 2, 1, # 0xB0
+    2, 3, 3, 4, 3, 4, 2, 4, 2, 4, 3, 1, 3, 6, 2, 4, # 0xC0
+    2, 3, 3, 0, 3, 4, 2, 4, 2, 4, 3, 0, 3, 0, 2, 4, # 0xD0
+    3, 3, 2, 0, 0, 4, 2, 4, 4, 1, 4, 0, 0, 0, 2, 4, # 0xE0
+    3, 3, 2, 1, 0, 4, 2, 4, 3, 2, 4, 1, 0, 0, 2, 4  # 0xF0
+]
+
+# Extra M-cycles for a taken JR cc, JP cc, CALL cc and RET cc
+BRANCH_CYCLES = {
+    0x20: 1, 0x28: 1, 0x30: 1, 0x38: 1,
+    0xC2: 1, 0xCA: 1, 0xD2: 1, 0xDA: 1,
+    0xC4: 3, 0xCC: 3, 0xD4: 3, 0xDC: 3,
+    0xC0: 3, 0xC8: 3, 0xD0: 3, 0xD8: 3
+}
+
+# M-cycles for CB-prefixed opcodes on top of the prefix itself. (HL)
+# forms read and write memory, BIT (HL) only reads.
+CB_CYCLES = [
+    (2 if (op & 0xC0) == 0x40 else 3) if (op & 0x07) == 0x06 else 1
+    for op in range(0x100)
+]
+
+# Dispatching an interrupt
+INTERRUPT_CYCLES = 5
+
+# The counter on CPU runs in clocks, 4 per M-cycle
+CLOCKS = [m * 4 for m in CYCLES]
+CB_CLOCKS = [m * 4 for m in CB_CYCLES]
+BRANCH_CLOCKS = dict((op, m * 4) for op, m in BRANCH_CYCLES.items())
+INTERRUPT_CLOCKS = INTERRUPT_CYCLES * 4
+
+# One frame of the LCD, 154 lines of 456 clocks
+FRAME_CLOCKS = 70224
+
+# One second at the 4.194304 MHz clock
+SECOND_CLOCKS = 4194304
@@ -0,0 +1,9 @@
+class DivergenceError(RuntimeError):
+    def __init__(self, step, pc, op, differences):
+        # step counts from 1, differences maps field -> (reference, candidate)
+        self.step = step
+        self.pc = pc
+        self.op = op
+        self.differences = differences
+        fields = ', '.join('%s %r != %r' % (name, ref, cand) for name, (ref, cand) in differences.items())
+        self.args = ('Cores diverged at step %s, 0x%04X (op 0x%02X): %s' % (step, pc, op, fields),)
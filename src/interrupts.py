@@ -0,0 +1,86 @@
+## Interrupt controller
+# Holds IF (0xFF0F), IE (0xFFFF) and the master enable. The MMU routes
+# writes of the two registers here, and keeps `ready` up to date so the CPU
+# only has to test one value after each instruction. IF and IE are copied
+# into `memory`, the MMU's address space, whenever they change so reads
+# of them are plain memory reads.
+
+# Interrupt bits, highest priority first
+VBLANK = 0x01
+LCD_STAT = 0x02
+TIMER = 0x04
+SERIAL = 0x08
+JOYPAD = 0x10
+
+# Requested and enabled bits -> (bit to acknowledge, handler address). The
+# lowest set bit wins.
+PRIORITY = [None] + [
+    (mask & -mask, 0x0040 + 8 * ((mask & -mask).bit_length() - 1))
+    for mask in range(1, 0x20)
+]
+
+# EI takes effect after the instruction following it. Counted in checks,
+# the one straight after EI and the one after the next instruction.
+EI_DELAY = 2
+
+class InterruptController:
+    def __init__(self, memory = None):
+        self.memory = memory
+        self.flags = 0x00
+        self.enable = 0x00
+        self.ime = False
+        self.ei_delay = 0
+
+        # Requested and enabled, whatever the master enable says
+        self.pending = 0
+        # Non-zero when the CPU has to call dispatch() after an instruction
+        self.ready = 0
+
+    def update(self):
+        self.pending = self.flags & self.enable & 0x1F
+        self.ready = (self.pending if self.ime else 0) | self.ei_delay
+        if (self.memory is not None):
+            self.memory[0xFF0F] = self.flags
+            self.memory[0xFFFF] = self.enable
+
+    def set_flags(self, val):
+        self.flags = val
+        self.update()
+
+    def set_enable(self, val):
+        self.enable = val
+        self.update()
+
+    def set_ime(self, val):
+        # DI, RETI and interrupt dispatch take effect at once
+        self.ime = bool(val)
+        self.ei_delay = 0
+        self.update()
+
+    def enable_delayed(self):
+        if (not self.ime and not self.ei_delay):
+            self.ei_delay = EI_DELAY
+            self.update()
+
+    def request(self, bit):
+        self.flags |= bit
+        self.update()
+
+    def dispatch(self):
+        # Called after an instruction while ready is set. Acknowledges the
+        # highest priority interrupt and returns its handler address, or
+        # None if there is nothing to take yet.
+        if (self.ei_delay):
+            self.ei_delay -= 1
+            if (self.ei_delay == 0):
+                self.ime = True
+
+        if (not self.ime or not self.pending):
+            self.update()
+            return None
+
+        bit, vector = PRIORITY[self.pending]
+        self.flags &= ~bit & 0xFF
+        self.ime = False
+        self.update()
+        return vector
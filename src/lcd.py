@@ -0,0 +1,22 @@
+from interrupts import VBLANK
+
+## LCD timing
+# Steps the line counter LY (0xFF44) and requests the V-Blank interrupt
+# when line 144 starts. Nothing is drawn yet.
+
+LINE_CLOCKS = 456
+LINES = 154
+VBLANK_LINE = 144
+
+class LCD:
+    def __init__(self, mmu, scheduler):
+        self.mmu = mmu
+        self.scheduler = scheduler
+        self.scheduler.schedule(LINE_CLOCKS, self.end_line)
+
+    def end_line(self, time):
+        ly = (self.mmu.get(0xFF44) + 1) % LINES
+        self.mmu.set(0xFF44, ly)
+        if (ly == VBLANK_LINE):
+            self.mmu.interrupts.request(VBLANK)
+        self.scheduler.schedule(time + LINE_CLOCKS, self.end_line)
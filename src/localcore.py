@@ -0,0 +1,199 @@
+from core import Core
+from cycles import CLOCKS, CB_CLOCKS, BRANCH_CLOCKS
+from recompiler import REGS, PAIRS, CONDITIONS, alu_source, push_source, translate
+
+## Local-variable core
+# An alternative to CPU.run_cycles: one generated run() function holding
+# A-L, SP, PC, F and the clock count in locals, with memory access and the
+# handler tables bound as locals too. Opcodes are dispatched through a
+# binary if-tree on the opcode with each leaf inlined. State is spilled back
+# to the CPU object when run() returns, before scheduled events and
+# interrupts, and around the few opcodes left to the CPU's own handlers.
+# Between calls the CPU object is always up to date, so debuggers and save
+# states see the same thing as with CPU.tick.
+
+SPILL = [
+    'regs[:] = (b, c, d, e, h, l, f, a)',
+    'cpu.sp = sp',
+    'cpu.pc = pc',
+    'cpu.cycles = cycles'
+]
+
+RELOAD = [
+    'b, c, d, e, h, l, f, a = regs',
+    'sp = cpu.sp',
+    'pc = cpu.pc',
+    'cycles = cpu.cycles'
+]
+
+# Immediate operands, pc points past the opcode
+N = 'read(pc)'
+NN = '(read(pc) | (read(pc + 1) << 8))'
+
+def handler_source(op):
+    # Runs the CPU's own handler for op, which may use and move any state
+    return SPILL + [
+        'opcodes[0x%02X]()' % op,
+        'if (cpu.pending_flags is not None):',
+        '    cpu.sync_flags()'
+    ] + RELOAD
+
+def cb_source():
+    # The CB handlers only touch the registers and memory
+    return [
+        'x = %s' % N,
+        'pc += 1',
+        'regs[:] = (b, c, d, e, h, l, f, a)',
+        'cb_opcodes[x]()',
+        'b, c, d, e, h, l, f, a = regs',
+        'cycles += CB_CLOCKS[x]'
+    ]
+
+def branch_source(op, cond, taken, length):
+    lines = ['if %s:' % cond]
+    lines += ['    ' + line for line in taken]
+    lines += ['    cycles += %d' % BRANCH_CLOCKS[op], 'else:', '    pc += %d' % length]
+    return lines
+
+def strip_exits(lines):
+    # Nothing is cached here, so translate's block exits after writes go
+    return [line for line in lines
+        if not line.startswith(('dirty = ', 'if (dirty', '    '))]
+
+def opcode_source(op):
+    # Source for one opcode with pc past the opcode byte, clocks not included
+    cond = CONDITIONS[(op >> 3) & 0x03]
+    call = ['nn = %s' % NN, 't = pc + 2'] + push_source('t >> 8', 't & 0xFF') + ['pc = nn']
+    ret = ['pc = read(sp) | (read(sp + 1) << 8)', 'sp += 2']
+
+    if (op == 0xCB):
+        return cb_source()
+
+    # Immediate operands
+    if ((op & 0xC7) == 0x06):
+        dst = REGS[(op >> 3) & 0x07]
+        if (dst is None):
+            return ['write((h << 8) | l, %s)' % N, 'pc += 1']
+        return ['%s = %s' % (dst, N), 'pc += 1']
+    if ((op & 0xC7) == 0xC6):
+        return ['n = %s' % N, 'pc += 1'] + alu_source((op >> 3) & 0x07, 'n')
+    if (op in (0x01, 0x11, 0x21)):
+        hi, lo = PAIRS[op >> 4]
+        return ['%s = %s' % (lo, N), '%s = read(pc + 1)' % hi, 'pc += 2']
+    if (op == 0x31):
+        return ['sp = %s' % NN, 'pc += 2']
+    if (op == 0xFA):
+        return ['a = read(%s)' % NN, 'pc += 2']
+    if (op == 0xEA):
+        return ['write(%s, a)' % NN, 'pc += 2']
+    if (op == 0xF0):
+        return ['a = read(0xFF00 + %s)' % N, 'pc += 1']
+    if (op == 0xE0):
+        return ['write(0xFF00 + %s, a)' % N, 'pc += 1']
+
+    # Jumps, calls, returns and restarts
+    if (op == 0xC3):
+        return ['pc = %s' % NN]
+    if ((op & 0xE7) == 0xC2):
+        return branch_source(op, cond, ['pc = %s' % NN], 2)
+    if (op == 0x18):
+        return ['pc = (pc + 1 + (%s ^ 0x80) - 0x80) & 0xFFFF' % N]
+    if ((op & 0xE7) == 0x20):
+        return branch_source(op, cond, ['pc = (pc + 1 + (%s ^ 0x80) - 0x80) & 0xFFFF' % N], 1)
+    if (op == 0xCD):
+        return call
+    if ((op & 0xE7) == 0xC4):
+        return branch_source(op, cond, call, 2)
+    if (op == 0xC9):
+        return ret
+    if ((op & 0xE7) == 0xC0):
+        return branch_source(op, cond, ret, 0)[:-2]
+    if ((op & 0xC7) == 0xC7):
+        return push_source('pc >> 8', 'pc & 0xFF') + ['pc = 0x%04X' % (op & 0x38)]
+
+    # Everything else translate handles has no operands
+    translated = translate(op, 0, 0, 0)
+    if (translated is None or translated[1] != 1):
+        return handler_source(op)
+    return strip_exits(translated[0])
+
+def if_tree(name, lo, hi, leaf):
+    # Binary if-tree on name over values lo up to hi, leaf(value) gives
+    # each value's source lines
+    if (hi - lo == 1):
+        return leaf(lo)
+    mid = (lo + hi) // 2
+    return (['if (%s < 0x%02X):' % (name, mid)]
+        + ['    ' + line for line in if_tree(name, lo, mid, leaf)]
+        + ['else:']
+        + ['    ' + line for line in if_tree(name, mid, hi, leaf)])
+
+def dispatch_source(op):
+    return opcode_source(op) + ['cycles += %d' % CLOCKS[op]]
+
+def generate():
+    body = [
+        'regs = cpu.regs',
+        'mmu = cpu.mmu',
+        'read = mmu.get',
+        'write = mmu.set',
+        'opcodes = cpu.opcodes',
+        'cb_opcodes = cpu.cb_opcodes',
+        'scheduler = cpu.scheduler',
+        'interrupts = cpu.interrupts',
+        'if (cpu.pending_flags is not None):',
+        '    cpu.sync_flags()'
+    ] + RELOAD + [
+        'try:',
+        '    for step in range(steps):',
+        '        if (cycles >= target):',
+        '            break',
+        '        op = read(pc)',
+        '        pc += 1'
+    ]
+    body += ['        ' + line for line in if_tree('op', 0x00, 0x100, dispatch_source)]
+    body += [
+        '        if (cycles >= scheduler.next_time or interrupts.ready):'
+    ] + ['            ' + line for line in SPILL] + [
+        '            if (cycles >= scheduler.next_time):',
+        '                scheduler.run_due(cycles)',
+        '            if (interrupts.ready):',
+        '                cpu.handle_interrupts()'
+    ] + ['            ' + line for line in RELOAD] + [
+        'finally:'
+    ] + ['    ' + line for line in SPILL]
+
+    return 'def run(cpu, steps, target):\n' + ''.join('    ' + line + '\n' for line in body)
+
+_run = None
+
+def build():
+    # The generated function is the same for every CPU, compiled once
+    global _run
+    if (_run is None):
+        namespace = {'CB_CLOCKS': CB_CLOCKS}
+        exec(compile(generate(), '<localcore>', 'exec'), namespace)
+        _run = namespace['run']
+    return _run
+
+class LocalCore(Core):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.run_locals = build()
+
+    def step(self):
+        self.run_locals(self.cpu, 1, self.cpu.cycles + 1)
+
+    def run(self, steps):
+        # Runs up to steps instructions
+        self.run_locals(self.cpu, steps, float('inf'))
+
+    def run_cycles(self, n):
+        # As CPU.run_cycles. Every instruction takes at least one clock, so
+        # n steps always reach the target.
+        cpu = self.cpu
+        start = cpu.cycles
+        target = start + n
+        cpu.cycle_target = target
+        self.run_locals(cpu, n, target)
+        return cpu.cycles - start
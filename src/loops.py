@@ -0,0 +1,400 @@
+from cpu import REG_A, REG_B, REG_D, REG_H
+from cycles import CLOCKS, CB_CLOCKS, BRANCH_CLOCKS
+
+## Idle loop detection
+# Games without HALT wait for V-Blank by spinning on LY or a flag set by an
+# interrupt handler, e.g.
+#
+#   wait: LDH A, (0x44)
+#         CP 0x90
+#         JR NZ, wait
+#
+# A backward branch closing a short straight-line loop that can't write
+# memory is a candidate. Once two consecutive iterations leave the
+# registers unchanged, took exactly the loop's cost in clocks and no event
+# ran in between, the loop can't make progress on its own, so whole
+# iterations are skipped up to the next scheduled event, which is the only
+# thing that can change what it polls. Since only whole iterations are
+# skipped the loop leaves at the same point in time as if stepped.
+
+# Instructions allowed in an idle loop body, opcode -> length. None of them
+# write memory, touch the stack or branch.
+SAFE = {0x00: 1, 0x0A: 1, 0x1A: 1, 0x2A: 1, 0x3A: 1, 0xFA: 3, 0xF0: 2, 0xF2: 1}
+for op in range(0x40, 0x70):
+    SAFE[op] = 1
+for op in range(0x78, 0xC0):
+    SAFE[op] = 1
+for op in [0x06, 0x0E, 0x16, 0x1E, 0x26, 0x2E, 0x3E, 0xC6, 0xCE, 0xD6, 0xDE, 0xE6, 0xEE, 0xF6, 0xFE]:
+    SAFE[op] = 2
+for op in [0x04, 0x05, 0x0C, 0x0D, 0x14, 0x15, 0x1C, 0x1D, 0x24, 0x25, 0x2C, 0x2D, 0x3C, 0x3D]:
+    SAFE[op] = 1
+for op in [0x03, 0x0B, 0x13, 0x1B, 0x23, 0x2B, 0x07, 0x0F, 0x17, 0x1F, 0x27, 0x2F, 0x37, 0x3F]:
+    SAFE[op] = 1
+
+# Branches that can close a loop, opcode -> length
+BRANCHES = {
+    0x18: 2, 0x20: 2, 0x28: 2, 0x30: 2, 0x38: 2,
+    0xC3: 3, 0xC2: 3, 0xCA: 3, 0xD2: 3, 0xDA: 3
+}
+
+MAX_LOOP_LENGTH = 16
+
+def wrap_branch(cpu, op, check):
+    # Calls check(branch address, target, base clocks) whenever branch op
+    # jumps backwards. The caller adds the base clocks after the handler
+    # returns, so they aren't in cpu.cycles yet.
+    handler = cpu.opcodes[op]
+    base = CLOCKS[op]
+
+    def branch():
+        pc = cpu.pc - 1
+        handler()
+        if (cpu.pc <= pc):
+            check(pc, cpu.pc, base)
+
+    cpu.opcodes[op] = branch
+    cpu.operand_opcodes[op] = None
+    cpu.flush_decode_cache()
+
+class IdleLoopDetector:
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+        # Branch address -> clocks per iteration, or None if the loop at
+        # that branch can't be idle
+        self.loops = {}
+        # Branch address -> clocks skipped
+        self.skipped = {}
+        # (branch address, registers, SP, next event, clock) at the last
+        # backward branch
+        self.last = None
+
+        for op in BRANCHES:
+            wrap_branch(cpu, op, self.check)
+
+    def analyse(self, branch, target):
+        # Clocks for one trip round the loop, None unless every instruction
+        # from target up to the branch is safe
+        get = self.cpu.mmu.get
+        pc = target
+        clocks = 0
+
+        for i in range(MAX_LOOP_LENGTH):
+            op = get(pc)
+            if (pc == branch):
+                return clocks + CLOCKS[op] + BRANCH_CLOCKS.get(op, 0)
+            if (op == 0xCB):
+                cb = get(pc + 1)
+                if (not 0x40 <= cb < 0x80):
+                    return None
+                clocks += CLOCKS[op] + CB_CLOCKS[cb]
+                pc += 2
+            elif (op in SAFE):
+                clocks += CLOCKS[op]
+                pc += SAFE[op]
+            else:
+                return None
+
+        return None
+
+    def check(self, branch, target, base):
+        cpu = self.cpu
+        try:
+            clocks = self.loops[branch]
+        except KeyError:
+            clocks = self.loops[branch] = self.analyse(branch, target)
+        if (clocks is None or cpu.interrupts.ready):
+            return
+
+        if (cpu.pending_flags is not None):
+            cpu.sync_flags()
+        # An event between the two arrivals may have changed what the loop
+        # reads, so the next event time has to match as well
+        regs = bytes(cpu.regs)
+        next_time = cpu.scheduler.next_time
+        last = self.last
+        self.last = (branch, regs, cpu.sp, next_time, cpu.cycles)
+
+        if (last is None or last[:4] != (branch, regs, cpu.sp, next_time) or cpu.cycles - last[4] != clocks):
+            return
+
+        # Confirmed idle, skip whole iterations as long as the last skipped
+        # branch ends no later than the next event or the end of the run
+        limit = min(next_time, cpu.cycle_target)
+        iterations = (limit - cpu.cycles - base) // clocks
+        if (iterations > 0):
+            cpu.cycles += iterations * clocks
+            self.skipped[branch] = self.skipped.get(branch, 0) + iterations * clocks
+            self.last = (branch, regs, cpu.sp, next_time, cpu.cycles)
+
+    def stats(self):
+        return {
+            'candidates': sum(1 for clocks in self.loops.values() if clocks is not None),
+            'rejected': sum(1 for clocks in self.loops.values() if clocks is None),
+            'idle': len(self.skipped),
+            'skipped_clocks': sum(self.skipped.values())
+        }
+
+## Counted loop collapsing
+# Delay loops count a register down to zero and do nothing else:
+#
+#   wait: DEC B              wait: DEC BC
+#         JR NZ, wait              LD A, B
+#                                  OR C
+#                                  JR NZ, wait
+#
+# When one of these branches back, the number of trips left is known from
+# the counter. All but the last are skipped at once: the counter is set one
+# above where those trips would leave it and the body is run a single time
+# without its clocks, which leaves registers and F exactly as stepping
+# would. The last trip is stepped so the loop exits normally.
+
+# Branches that can close a counted loop, taken while the counter isn't 0
+COUNTED_BRANCHES = [0x20, 0xC2]
+
+DEC_R = [0x05, 0x0D, 0x15, 0x1D, 0x25, 0x2D, 0x3D]
+DEC_RR = [0x0B, 0x1B, 0x2B]
+
+class CountedLoopCollapser:
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+        # Branch address -> (body opcodes, counter registers, clocks per
+        # iteration), or None if the loop isn't a counted one
+        self.loops = {}
+        # Branch address -> iterations skipped
+        self.collapsed = {}
+
+        for op in COUNTED_BRANCHES:
+            wrap_branch(cpu, op, self.check)
+
+    def analyse(self, branch, target):
+        get = self.cpu.mmu.get
+        op = get(branch)
+        body = [get(addr) for addr in range(target, branch)]
+        clocks = sum(CLOCKS[b] for b in body) + CLOCKS[op] + BRANCH_CLOCKS[op]
+
+        if (len(body) == 1 and body[0] in DEC_R):
+            return (body, (body[0] >> 3,), clocks)
+
+        if (len(body) == 3 and body[0] in DEC_RR):
+            hi = (body[0] >> 4) * 2
+            lo = hi + 1
+            # LD A, hi; OR lo or the other way round
+            if (body[1] - 0x78 in (hi, lo) and body[2] - 0xB0 in (hi, lo) and body[1] - 0x78 != body[2] - 0xB0):
+                return (body, (hi, lo), clocks)
+
+        return None
+
+    def check(self, branch, target, base):
+        cpu = self.cpu
+        try:
+            loop = self.loops[branch]
+        except KeyError:
+            loop = self.loops[branch] = self.analyse(branch, target)
+        if (loop is None or cpu.interrupts.ready):
+            return
+
+        body, counter, clocks = loop
+        regs = cpu.regs
+        if (len(counter) == 1):
+            count = regs[counter[0]]
+        else:
+            count = (regs[counter[0]] << 8) | regs[counter[1]]
+
+        # The last skipped branch must end no later than the next event or
+        # the end of the run, as it would have when stepping
+        limit = min(cpu.scheduler.next_time, cpu.cycle_target)
+        iterations = min(count - 1, (limit - cpu.cycles - base) // clocks)
+        if (iterations <= 0):
+            return
+
+        count -= iterations - 1
+        if (len(counter) == 1):
+            regs[counter[0]] = count
+        else:
+            regs[counter[0]] = count >> 8
+            regs[counter[1]] = count & 0xFF
+        opcodes = cpu.opcodes
+        for op in body:
+            opcodes[op]()
+
+        cpu.cycles += iterations * clocks
+        self.collapsed[branch] = self.collapsed.get(branch, 0) + iterations
+
+## Copy and fill loops
+# Loops that copy or fill memory a byte at a time, counted down as above:
+#
+#   copy: LD A, (DE)         fill: LD (HL+), A
+#         LD (HL+), A              DEC B
+#         INC DE                   JR NZ, fill
+#         DEC BC
+#         LD A, B
+#         OR C
+#         JR NZ, copy
+#
+# The bytes all but the last trip would move go in as one slice assignment
+# on the MMU's arrays, with one call to the code listeners for the range
+# written. The last skipped trip is then run through the handlers as for
+# counted loops. Only plain memory is copied this way and never between
+# overlapping ranges; anything else is left to step.
+
+# LD A, (rr) and LD (rr), A, opcode -> (register pair, step)
+LOADS = {0x0A: (REG_B, 0), 0x1A: (REG_D, 0), 0x2A: (REG_H, 1), 0x3A: (REG_H, -1)}
+STORES = {0x02: (REG_B, 0), 0x12: (REG_D, 0), 0x22: (REG_H, 1), 0x32: (REG_H, -1)}
+# INC rr and DEC rr, opcode -> (register pair, step)
+STEPS = {
+    0x03: (REG_B, 1), 0x13: (REG_D, 1), 0x23: (REG_H, 1),
+    0x0B: (REG_B, -1), 0x1B: (REG_D, -1), 0x2B: (REG_H, -1)
+}
+
+def pointer_range(addr, step, count):
+    # Lowest and highest of count addresses from addr
+    if (step > 0):
+        return addr, addr + count - 1
+    return addr - count + 1, addr
+
+def block_slice(span, step, count):
+    array, offset, size = span
+    if (step > 0):
+        return slice(offset, offset + count)
+    return slice(offset - count + 1, offset + 1)
+
+class CopyLoopCollapser:
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+        # Branch address -> (body opcodes, counter registers, source pair
+        # and step or None for a fill, destination pair and step, clocks per
+        # iteration), or None if the loop isn't a copy or fill
+        self.loops = {}
+        # Branch address -> bytes moved as slices
+        self.copied = {}
+
+        for op in COUNTED_BRANCHES:
+            wrap_branch(cpu, op, self.check)
+
+    def analyse(self, branch, target):
+        get = self.cpu.mmu.get
+        op = get(branch)
+        body = [get(addr) for addr in range(target, branch)]
+        clocks = sum(CLOCKS[b] for b in body) + CLOCKS[op] + BRANCH_CLOCKS[op]
+
+        # Counter at the end
+        if (len(body) >= 2 and body[-1] in DEC_R and body[-1] >> 3 != REG_A):
+            counter = (body[-1] >> 3,)
+            moves = body[:-1]
+        elif (len(body) >= 4 and body[-3] in DEC_RR):
+            hi = (body[-3] >> 4) * 2
+            lo = hi + 1
+            # LD A, hi; OR lo or the other way round
+            if (not (body[-2] - 0x78 in (hi, lo) and body[-1] - 0xB0 in (hi, lo) and body[-2] - 0x78 != body[-1] - 0xB0)):
+                return None
+            counter = (hi, lo)
+            moves = body[:-3]
+        else:
+            return None
+
+        # One load into A, then one store from A, pointers stepped by the
+        # (HL+)/(HL-) forms or INC/DEC rr. The destination only moves after
+        # the store.
+        src = dst = None
+        steps = {}
+        for op in moves:
+            if (op in LOADS and src is None and dst is None):
+                src, step = LOADS[op]
+                pair = src
+            elif (op in STORES and dst is None):
+                dst, step = STORES[op]
+                pair = dst
+            elif (op in STEPS):
+                pair, step = STEPS[op]
+                if (dst is None and pair != src):
+                    return None
+            else:
+                return None
+            steps[pair] = steps.get(pair, 0) + step
+
+        if (dst is None or src == dst or set(steps) != set(p for p in (src, dst) if p is not None)):
+            return None
+        if (any(step not in (1, -1) for step in steps.values())):
+            return None
+        # A 16-bit counter goes through A, which a fill needs to keep
+        if (src is None and len(counter) == 2):
+            return None
+        pointers = set(p + i for p in steps for i in (0, 1))
+        if (pointers & set(counter)):
+            return None
+
+        return (body, counter, (src, steps[src]) if src is not None else None, (dst, steps[dst]), clocks)
+
+    def check(self, branch, target, base):
+        cpu = self.cpu
+        try:
+            loop = self.loops[branch]
+        except KeyError:
+            loop = self.loops[branch] = self.analyse(branch, target)
+        if (loop is None or cpu.interrupts.ready):
+            return
+
+        body, counter, src, dst, clocks = loop
+        regs = cpu.regs
+        if (len(counter) == 1):
+            count = regs[counter[0]]
+        else:
+            count = (regs[counter[0]] << 8) | regs[counter[1]]
+
+        # As for counted loops, but the trips before the last skipped one
+        # are the ones moved as a slice
+        limit = min(cpu.scheduler.next_time, cpu.cycle_target)
+        moved = min(count - 1, (limit - cpu.cycles - base) // clocks) - 1
+        if (moved < 1):
+            return
+
+        mmu = cpu.mmu
+        dst_pair, dst_step = dst
+        dst_addr = cpu.get_pair(dst_pair, dst_pair + 1)
+        dst_span = mmu.span(dst_addr, True)
+        if (dst_span is None):
+            return
+        moved = min(moved, dst_span[2] - dst_span[1] if dst_step > 0 else dst_span[1] + 1)
+        dst_range = pointer_range(dst_addr, dst_step, moved)
+
+        if (src is None):
+            values = bytes([regs[REG_A]]) * moved
+        else:
+            src_pair, src_step = src
+            src_addr = cpu.get_pair(src_pair, src_pair + 1)
+            src_span = mmu.span(src_addr)
+            if (src_span is None):
+                return
+            moved = min(moved, src_span[2] - src_span[1] if src_step > 0 else src_span[1] + 1)
+            dst_range = pointer_range(dst_addr, dst_step, moved)
+            src_range = pointer_range(src_addr, src_step, moved)
+            if (src_range[0] <= dst_range[1] and dst_range[0] <= src_range[1]):
+                return
+            values = bytes(src_span[0][block_slice(src_span, src_step, moved)])
+            if (src_step != dst_step):
+                values = values[::-1]
+
+        dst_span[0][block_slice(dst_span, dst_step, moved)] = values
+        if (any(mmu.code_pages[dst_range[0] >> 8:(dst_range[1] >> 8) + 1])):
+            mmu.code_written(dst_range[0], dst_range[1] + 1)
+
+        # Registers as at the start of the last skipped trip, which runs
+        # through the handlers
+        cpu.set_pair(dst_pair, dst_pair + 1, (dst_addr + dst_step * moved) & 0xFFFF)
+        if (src is not None):
+            cpu.set_pair(src_pair, src_pair + 1, (src_addr + src_step * moved) & 0xFFFF)
+        count -= moved
+        if (len(counter) == 1):
+            regs[counter[0]] = count
+        else:
+            regs[counter[0]] = count >> 8
+            regs[counter[1]] = count & 0xFF
+        opcodes = cpu.opcodes
+        for op in body:
+            opcodes[op]()
+
+        cpu.cycles += (moved + 1) * clocks
+        self.copied[branch] = self.copied.get(branch, 0) + moved
@@ -0,0 +1,242 @@
+from cycles import SECOND_CLOCKS
+
+## Memory bank controllers
+# Cartridge hardware behind writes to 0x0000-0x7FFF. A controller keeps
+# its registers and tells the MMU which ROM banks to map at 0x0000 and
+# 0x4000, and which external RAM bank to map at 0xA000 and whether it's
+# enabled. The MMU only re-points page table entries at memoryview windows
+# of the ROM and cartridge RAM, so a switch never copies anything.
+
+# Cartridge header
+CARTRIDGE_TYPE = 0x0147
+RAM_SIZE = 0x0149
+
+# RAM size header byte -> bytes of cartridge RAM
+RAM_SIZES = {
+    0x00: 0,
+    0x01: 0x0800,
+    0x02: 0x2000,
+    0x03: 0x8000,
+    0x04: 0x20000,
+    0x05: 0x10000
+}
+
+class NoMBC:
+    # 32K ROM and up to 8K RAM, writes to ROM are a program bug
+    def __init__(self, mmu):
+        self.mmu = mmu
+
+    def write(self, addr, val):
+        self.mmu.unmapped(addr)
+
+    def map(self):
+        self.mmu.select_rom_bank(1)
+        self.mmu.select_ram_bank(0, True)
+
+    def save_state(self):
+        return ()
+
+    def load_state(self, state):
+        self.map()
+
+class MBC1:
+    def __init__(self, mmu):
+        self.mmu = mmu
+        self.ram_enabled = False
+        # 5 bits written to 0x2000-0x3FFF and 2 to 0x4000-0x5FFF, together
+        # the ROM bank at 0x4000
+        self.bank_1 = 1
+        self.bank_2 = 0
+        # 0x6000-0x7FFF, in mode 1 bank_2 also picks the ROM bank at
+        # 0x0000 and the RAM bank
+        self.mode = 0
+
+    def write(self, addr, val):
+        if (addr <= 0x1FFF):
+            self.ram_enabled = (val & 0x0F) == 0x0A
+        elif (addr <= 0x3FFF):
+            # Bank 0 can't be selected here, 0x20, 0x40 and 0x60 are lost
+            self.bank_1 = (val & 0x1F) or 1
+        elif (addr <= 0x5FFF):
+            self.bank_2 = val & 0x03
+        else:
+            self.mode = val & 0x01
+        self.map()
+
+    def map(self):
+        mmu = self.mmu
+        upper = self.bank_2 << 5
+        if (self.mode):
+            mmu.select_rom_bank((upper | self.bank_1) % mmu.rom_banks, upper % mmu.rom_banks)
+            mmu.select_ram_bank(self.bank_2 % mmu.ram_banks, self.ram_enabled)
+        else:
+            mmu.select_rom_bank((upper | self.bank_1) % mmu.rom_banks)
+            mmu.select_ram_bank(0, self.ram_enabled)
+
+    def save_state(self):
+        return (self.ram_enabled, self.bank_1, self.bank_2, self.mode)
+
+    def load_state(self, state):
+        self.ram_enabled, self.bank_1, self.bank_2, self.mode = state
+        self.map()
+
+# MBC3 clock registers, selected by writing 0x08-0x0C to 0x4000-0x5FFF:
+# seconds, minutes, hours, day low bits and day high bit | halt | day carry
+RTC_MASKS = [0x3F, 0x3F, 0x1F, 0xFF, 0xC1]
+DAY_SECONDS = 24 * 60 * 60
+
+class MBC3:
+    def __init__(self, mmu):
+        self.mmu = mmu
+        self.ram_enabled = False
+        self.rom_bank = 1
+        # RAM bank 0x00-0x03 or clock register 0x08-0x0C
+        self.ram_select = 0
+        # Last value written to 0x6000-0x7FFF, 0x00 then 0x01 latches
+        self.latch = None
+        self.latched = [0x00] * 5
+
+        # The clock isn't ticked, it's worked out from the cycle counter
+        # when latched: rtc_seconds counted at cycle rtc_cycles, plus the
+        # time since unless halted
+        self.rtc_seconds = 0
+        self.rtc_cycles = 0
+        self.rtc_halt = 0
+        self.rtc_carry = 0
+
+    def write(self, addr, val):
+        if (addr <= 0x1FFF):
+            self.ram_enabled = (val & 0x0F) == 0x0A
+        elif (addr <= 0x3FFF):
+            self.rom_bank = (val & 0x7F) or 1
+        elif (addr <= 0x5FFF):
+            self.ram_select = val & 0x0F
+        else:
+            if (self.latch == 0x00 and val == 0x01):
+                self.latched = self.clock_registers()
+            self.latch = val
+            return
+        self.map()
+
+    def map(self):
+        mmu = self.mmu
+        mmu.select_rom_bank(self.rom_bank % mmu.rom_banks)
+        if (self.ram_select >= 0x08 and self.ram_enabled):
+            mmu.select_ram_handler(self.clock_register)
+        else:
+            mmu.select_ram_bank(self.ram_select % mmu.ram_banks, self.ram_enabled)
+
+    def seconds(self):
+        if (self.rtc_halt):
+            return self.rtc_seconds
+        return self.rtc_seconds + (self.mmu.clock() - self.rtc_cycles) // SECOND_CLOCKS
+
+    def clock_registers(self):
+        seconds = self.seconds()
+        days = seconds // DAY_SECONDS
+        carry = 1 if (self.rtc_carry or days > 0x1FF) else 0
+        return [
+            seconds % 60,
+            seconds // 60 % 60,
+            seconds // 3600 % 24,
+            days & 0xFF,
+            ((days >> 8) & 0x01) | (self.rtc_halt << 6) | (carry << 7)
+        ]
+
+    def clock_register(self, addr, val = None):
+        # The selected register at any address in 0xA000-0xBFFF. Reads give
+        # the latched value, writes set the running clock.
+        i = self.ram_select - 0x08
+        if (i > 4):
+            return 0xFF if val is None else None
+        if (val is None):
+            return self.latched[i]
+
+        registers = self.clock_registers()
+        registers[i] = val & RTC_MASKS[i]
+        self.latched[i] = registers[i]
+        seconds, minutes, hours, days, high = registers
+        self.rtc_seconds = seconds + 60 * minutes + 3600 * hours + DAY_SECONDS * (days | ((high & 0x01) << 8))
+        self.rtc_cycles = self.mmu.clock()
+        self.rtc_halt = (high >> 6) & 0x01
+        self.rtc_carry = high >> 7
+
+    def save_state(self):
+        return (self.ram_enabled, self.rom_bank, self.ram_select, self.latch, tuple(self.latched),
+            self.rtc_seconds, self.rtc_cycles, self.rtc_halt, self.rtc_carry)
+
+    def load_state(self, state):
+        (self.ram_enabled, self.rom_bank, self.ram_select, self.latch, latched,
+            self.rtc_seconds, self.rtc_cycles, self.rtc_halt, self.rtc_carry) = state
+        self.latched = list(latched)
+        self.map()
+
+class MBC5:
+    # RAM bank bits, on rumble cartridges bit 3 drives the motor instead
+    RAM_MASK = 0x0F
+
+    def __init__(self, mmu):
+        self.mmu = mmu
+        self.ram_enabled = False
+        # 9 bits, low 8 written to 0x2000-0x2FFF and bit 8 to 0x3000-0x3FFF.
+        # Unlike MBC1 and MBC3, bank 0 can be mapped at 0x4000.
+        self.rom_bank = 1
+        self.ram_bank = 0
+
+    def write(self, addr, val):
+        if (addr <= 0x1FFF):
+            self.ram_enabled = (val & 0x0F) == 0x0A
+        elif (addr <= 0x2FFF):
+            self.rom_bank = (self.rom_bank & 0x100) | val
+        elif (addr <= 0x3FFF):
+            self.rom_bank = ((val & 0x01) << 8) | (self.rom_bank & 0xFF)
+        elif (addr <= 0x5FFF):
+            self.ram_bank = val & self.RAM_MASK
+        else:
+            return
+        self.map()
+
+    def map(self):
+        mmu = self.mmu
+        mmu.select_rom_bank(self.rom_bank % mmu.rom_banks)
+        mmu.select_ram_bank(self.ram_bank % mmu.ram_banks, self.ram_enabled)
+
+    def save_state(self):
+        return (self.ram_enabled, self.rom_bank, self.ram_bank)
+
+    def load_state(self, state):
+        self.ram_enabled, self.rom_bank, self.ram_bank = state
+        self.map()
+
+class MBC5Rumble(MBC5):
+    RAM_MASK = 0x07
+
+# Cartridge type header byte -> controller, anything else runs as NoMBC
+MBC_TYPES = {
+    0x00: NoMBC,
+    0x01: MBC1,      # MBC1
+    0x02: MBC1,      # MBC1+RAM
+    0x03: MBC1,      # MBC1+RAM+BATTERY
+    0x0F: MBC3,      # MBC3+TIMER+BATTERY
+    0x10: MBC3,      # MBC3+TIMER+RAM+BATTERY
+    0x11: MBC3,      # MBC3
+    0x12: MBC3,      # MBC3+RAM
+    0x13: MBC3,      # MBC3+RAM+BATTERY
+    0x19: MBC5,      # MBC5
+    0x1A: MBC5,      # MBC5+RAM
+    0x1B: MBC5,      # MBC5+RAM+BATTERY
+    0x1C: MBC5Rumble, # MBC5+RUMBLE
+    0x1D: MBC5Rumble, # MBC5+RUMBLE+RAM
+    0x1E: MBC5Rumble  # MBC5+RUMBLE+RAM+BATTERY
+}
+
+def header(rom, addr):
+    return rom[addr] if addr < len(rom) else 0
+
+def cartridge_ram_size(rom):
+    # At least one full 8K bank, cartridges without RAM have always had
+    # the region to write to
+    return max(0x2000, RAM_SIZES.get(header(rom, RAM_SIZE), 0))
+
+def make_mbc(mmu):
+    return MBC_TYPES.get(header(mmu.ROM, CARTRIDGE_TYPE), NoMBC)(mmu)
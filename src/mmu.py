@@ -1,154 +1,274 @@
 import numpy as np
 from exceptions.memory_access_error import MemoryAccessError
+from interrupts import InterruptController
+from mbc import cartridge_ram_size, make_mbc
+
+# Plain memory, reads and writes have no side effects. (start, end, name)
+MEMORY_REGIONS = [
+    (0x0000, 0x4000, 'ROM_0'),
+    (0x4000, 0x8000, 'ROM_BANK'),
+    (0x8000, 0x9800, 'CHAR_RAM'),
+    (0x9800, 0x9C00, 'BG_MAP_1'),
+    (0x9C00, 0xA000, 'BG_MAP_2'),
+    (0xA000, 0xC000, 'EXT_RAM'),
+    (0xC000, 0xE000, 'WORK_RAM'),
+    (0xFE00, 0xFEA0, 'OAM'),
+    (0xFF80, 0xFFFF, 'HIGH_RAM')
+]
+
+# Regions that are windows onto the cartridge, re-pointed on bank switches
+BANKED_REGIONS = ['ROM_0', 'ROM_BANK', 'EXT_RAM']
+
+# Arrays holding everything a program can change, for save states. All
+# of the cartridge RAM rather than the bank mapped in EXT_RAM.
+STATE_ARRAYS = [name for start, end, name in MEMORY_REGIONS if name not in BANKED_REGIONS] + ['HW_REGS_TEMP', 'CART_RAM']
 
 class MMU:
 
     def __init__(self, rom_file):
-        self.ROM = rom_file
-        self.WORK_RAM = np.zeros(8192, dtype=np.uint8)
-        self.EXT_RAM = np.zeros(8192, dtype=np.uint8)
-        self.CHAR_RAM = np.zeros(6144, dtype=np.uint8)
-        self.BG_MAP_1 = np.zeros(1024, dtype=np.uint8)
-        self.BG_MAP_2 = np.zeros(1024, dtype=np.uint8)
-        self.OAM = np.zeros(1024, dtype=np.uint8)
-        self.HIGH_RAM = np.zeros(127, dtype=np.uint8)
-        self.INTERRUPT = 0x00
-
-        self.HW_REGS_TEMP = np.zeros(128, dtype=np.uint8)
-
-    def get(self, addr):
-        # Memory map reference: http://gameboy.mongenel.com/dmg/asmmemmap.html
-
-        # Cartridge ROM bank 0 0x0000-0x3FFF
-        if addr >= 0x0000 and addr <= 0x3FFF:
-            addr_adj = addr
-            return self.ROM[addr_adj]
-
-        # Cartridge ROM switchable bank 0x4000-0x7FFF
-        elif addr >= 0x4000 and addr <= 0x7FFF:
-            # TODO: Implement bank switching; currently just 32K max rom size
-            addr_adj = addr
-            return self.ROM[addr_adj]
-
-        # Character RAM 0x8000-0x97FF
-        elif addr >= 0x8000 and addr <= 0x97FF:
-            addr_adj = addr - 0x8000
-            return self.CHAR_RAM[addr_adj]
-
-        # BG Map Data 1 0x9800-0x9BF
-        elif addr >= 0x9800 and addr <= 0x9BFF:
-            addr_adj = addr - 0x9800
-            return self.BG_MAP_1[addr_adj]
-
-        # BG Map Data 2 0x9C00-0x9FFF
-        elif addr >= 0x9C00 and addr <= 0x9FFF:
-            addr_adj = addr - 0x9C00
-            return self.BG_MAP_2[addr_adj]
-
-        # External RAM (if available) 0xA000-0xBFFF
-        elif addr >= 0xA000 and addr <= 0xBFFF:
-            addr_adj = addr - 0xA000
-            return self.EXT_RAM[addr_adj]
-
-        # Work RAM 0xC000-0xDFFF
-        elif addr >= 0xC000 and addr <= 0xDFFF:
-            addr_adj = addr - 0xC000
-            return self.WORK_RAM[addr_adj]
-
-        # Echo RAM (Reserved, shouldn't be used) 0xE000-0xFDFF
-        elif addr >= 0xE000 and addr <= 0xFDFF:
-            raise NotImplementedError('Access of unimplemented memory space ' + str(addr))
-
+        # Any buffer of bytes, read through a memoryview so reads give ints
+        self.ROM = memoryview(rom_file).cast('B')
+        self.rom_banks = max(1, (len(self.ROM) + 0x3FFF) // 0x4000)
+        self.CART_RAM = memoryview(bytearray(cartridge_ram_size(self.ROM)))
+        self.ram_banks = len(self.CART_RAM) // 0x2000
+
+        # The address space from 0x8000 up as one flat bytearray, the RAM
+        # regions and IO registers are memoryview slices of it
+        self.memory = bytearray(0x10000)
+        view = memoryview(self.memory)
+        for start, end, name in MEMORY_REGIONS:
+            if (name not in BANKED_REGIONS):
+                setattr(self, name, view[start:end])
+        self.HW_REGS_TEMP = view[0xFF00:0xFF80]
+
+        # IF (0xFF0F) and IE (0xFFFF)
+        self.interrupts = InterruptController(self.memory)
+
+        # Pages (addr >> 8) of RAM holding cached code. Writes into a flagged
+        # page are passed to each code listener as a range (start, end),
+        # which returns whether it still has code in those pages.
+        self.code_pages = bytearray(0x100)
+        self.code_listeners = []
+
+        # ROM banks mapped at 0x4000-0x7FFF and 0x0000-0x3FFF, bank
+        # listeners are passed both whenever either changes. Cartridge RAM
+        # bank mapped at 0xA000-0xBFFF.
+        self.rom_bank = None
+        self.rom_bank_0 = None
+        self.ram_bank = None
+        self.ram_enabled = None
+        self.bank_listeners = []
+
+        # Clock count for cartridge timers, the CPU points this at its own
+        self.clock = lambda: 0
+
+        self.mbc = make_mbc(self)
+        self.map_pages()
+        self.mbc.map()
+
+    def add_code_listener(self, listener):
+        self.code_listeners.append(listener)
+
+    def add_bank_listener(self, listener):
+        self.bank_listeners.append(listener)
+
+    def rom_window(self, bank):
+        start = (bank % self.rom_banks) * 0x4000
+        return self.ROM[start:start + 0x4000]
+
+    def select_rom_bank(self, bank, bank_0 = 0):
+        if (bank == self.rom_bank and bank_0 == self.rom_bank_0):
+            return
+        self.rom_bank = bank
+        self.rom_bank_0 = bank_0
+        self.ROM_0 = self.rom_window(bank_0)
+        self.ROM_BANK = self.rom_window(bank)
+        self.read_pages[0x00:0x40] = [(self.ROM_0, 0x0000, None)] * 0x40
+        self.read_pages[0x40:0x80] = [(self.ROM_BANK, 0x4000, None)] * 0x40
+        for listener in self.bank_listeners:
+            listener(bank, bank_0)
+
+    def select_ram_bank(self, bank, enabled):
+        # While disabled reads give 0xFF and writes are dropped
+        if (bank == self.ram_bank and enabled == self.ram_enabled):
+            return
+        self.ram_bank = bank
+        self.ram_enabled = enabled
+        self.EXT_RAM = self.CART_RAM[bank * 0x2000:(bank + 1) * 0x2000]
+        if (enabled):
+            self.map_external((self.EXT_RAM, 0xA000, None))
+        else:
+            self.map_external((None, 0, self.disabled_ram))
+
+    def select_ram_handler(self, handler):
+        # Passes 0xA000-0xBFFF accesses to handler instead of RAM, as for
+        # MBC3's clock registers
+        self.ram_bank = None
+        self.ram_enabled = False
+        self.map_external((None, 0, handler))
+
+    def map_external(self, entry):
+        self.read_pages[0xA0:0xC0] = [entry] * 0x20
+        self.write_pages[0xA0:0xC0] = self.plain_write_pages[0xA0:0xC0] = [entry] * 0x20
+        # Code cached from what was mapped before is gone
+        if (any(self.code_pages[0xA0:0xC0])):
+            self.code_written(0xA000, 0xC000)
+
+    def mark_code(self, page):
+        self.code_pages[page] = 1
+        # Writes into the page now have to reach the code listeners
+        array, start, handler = self.write_pages[page]
+        if (handler is None):
+            self.write_pages[page] = (array, start, self.set_code)
+
+    def code_written(self, addr, end = None):
+        # A write to addr, or a block write from addr up to end
+        if (end is None):
+            end = addr + 1
+        if (not any([listener(addr, end) for listener in self.code_listeners])):
+            for page in range(addr >> 8, ((end - 1) >> 8) + 1):
+                self.code_pages[page] = 0
+                self.write_pages[page] = self.plain_write_pages[page]
+
+    def save_state(self):
+        state = dict((name, np.array(getattr(self, name))) for name in STATE_ARRAYS)
+        state['mbc'] = self.mbc.save_state()
+        return state
+
+    def load_state(self, state):
+        for name in STATE_ARRAYS:
+            getattr(self, name)[:] = state[name]
+        self.mbc.load_state(state['mbc'])
+        # Cached code may no longer match what's in RAM
+        self.code_written(0x8000, 0x10000)
+
+    def span(self, addr, writable = False):
+        # Backing array of the plain memory region holding addr, as
+        # (array, offset of addr, region size), or None. Lets block copies
+        # work on slices instead of byte by byte.
+        for start, end, name in MEMORY_REGIONS:
+            if (start <= addr < end):
+                if (writable and name in ('ROM_0', 'ROM_BANK')):
+                    return None
+                if (name == 'EXT_RAM' and not self.ram_enabled):
+                    return None
+                return (getattr(self, name), addr - start, end - start)
+        return None
+
+    ## Page table
+    # Memory map reference: http://gameboy.mongenel.com/dmg/asmmemmap.html
+    # One entry per 256-byte page (addr >> 8), for reads and for writes, as
+    # (array, address of array[0], handler). Plain pages index the array,
+    # pages with a handler pass it the access instead.
+
+    def map_pages(self):
+        unmapped = (None, 0, self.unmapped)
+        self.read_pages = [unmapped] * 0x100
+        self.write_pages = [unmapped] * 0x100
+
+        # Cartridge ROM, bank 0 0x0000-0x3FFF and switchable bank 0x4000-0x7FFF,
+        # read pages are filled in by select_rom_bank. Writes go to the
+        # memory bank controller.
+        for page in range(0x00, 0x80):
+            self.write_pages[page] = (None, 0, self.mbc.write)
+
+        # Character RAM and BG map data 1 & 2 0x8000-0x9FFF, work RAM
+        # 0xC000-0xDFFF. External RAM 0xA000-0xBFFF is filled in by
+        # select_ram_bank.
+        for page in list(range(0x80, 0xA0)) + list(range(0xC0, 0xE0)):
+            self.read_pages[page] = self.write_pages[page] = (self.memory, 0x0000, None)
+
+        # Echo RAM (Reserved, shouldn't be used) 0xE000-0xFDFF stays unmapped
+
+        # OAM and unusable memory 0xFE00-0xFEFF
+        self.read_pages[0xFE] = self.write_pages[0xFE] = (None, 0, self.oam)
+
+        # Hardware IO registers, high RAM and the interrupt register
+        # 0xFF00-0xFFFF. Reads are plain, IF and IE are kept in memory by
+        # the interrupt controller.
+        self.read_pages[0xFF] = (self.memory, 0x0000, None)
+        self.write_pages[0xFF] = (None, 0, self.set_high)
+
+        # Entries for pages without code, see mark_code
+        self.plain_write_pages = list(self.write_pages)
+
+    def unmapped(self, addr, val = None):
+        raise NotImplementedError('Access of unimplemented memory space ' + str(addr))
+
+    def disabled_ram(self, addr, val = None):
+        if (val is None):
+            return 0xFF
+
+    def set_code(self, addr, val):
+        array, start, handler = self.plain_write_pages[addr >> 8]
+        array[addr - start] = val
+        self.code_written(addr)
+
+    def oam(self, addr, val = None):
         # OAM - Object Attribute Memory 0xFE00-0xFE9F
-        elif addr >= 0xFE00 and addr <= 0xFE9F:
-            addr_adj = addr - 0xFE00
-            return self.OAM[addr_adj]
+        if (addr <= 0xFE9F):
+            if (val is None):
+                return self.memory[addr]
+            self.memory[addr] = val
+            return
 
         # Unusable Memory 0xFEA0-0xFEFF
-        elif addr >= 0xFEA0 and addr <= 0xFEFF:
-            raise NotImplementedError('Access of unimplemented memory space ' + str(addr))
+        self.unmapped(addr)
 
+    def set_high(self, addr, val):
         # Hardware I/O Registers 0xFF00-0xFF7F
-        elif addr >= 0xFF00 and addr <= 0xFF7F:
-            # TODO: Implement HW regs GET
-            addr_adj = addr - 0xFF00
-            return self.HW_REGS_TEMP[addr_adj]
+        if (addr <= 0xFF7F):
+            # TODO: Implement HW regs SET
+            if (addr == 0xFF0F):
+                self.interrupts.set_flags(val)
+                return
+            self.memory[addr] = val
 
         # High RAM 0xFF80-0xFFFE
-        elif addr >= 0xFF80 and addr <= 0xFFFE:
-            addr_adj = addr - 0xFF80
-            return self.HIGH_RAM[addr_adj]
+        elif (addr <= 0xFFFE):
+            self.memory[addr] = val
+            if (self.code_pages[0xFF]):
+                self.code_written(addr)
 
         # Interrupt register 0xFFFF
-        elif addr == 0xFFFF:
-            return self.INTERRUPT
-
         else:
-            raise MemoryAccessError('Crazy out of range address requested from MMU: ' + str(addr))
+            self.interrupts.set_enable(val)
+
+    def read16(self, addr):
+        # Little-endian word at addr, with the page looked up once unless
+        # the word straddles two pages
+        if (0 <= addr < 0xFFFF and (addr & 0xFF) != 0xFF):
+            array, start, handler = self.read_pages[addr >> 8]
+            if (handler is None):
+                return array[addr - start] | (array[addr + 1 - start] << 8)
+        return self.get(addr) | (self.get(addr + 1) << 8)
+
+    def write16(self, addr, val):
+        if (0 <= addr < 0xFFFF and (addr & 0xFF) != 0xFF):
+            array, start, handler = self.write_pages[addr >> 8]
+            if (handler is None or handler == self.set_code):
+                array[addr - start] = val & 0xFF
+                array[addr + 1 - start] = val >> 8
+                if (handler is not None):
+                    self.code_written(addr, addr + 2)
+                return
+        # High byte first, the order a push writes in
+        self.set(addr + 1, val >> 8)
+        self.set(addr, val & 0xFF)
 
+    def get(self, addr):
+        if (addr < 0 or addr > 0xFFFF):
+            raise MemoryAccessError('Crazy out of range address requested from MMU: ' + str(addr))
+        array, start, handler = self.read_pages[addr >> 8]
+        if (handler is not None):
+            return handler(addr)
+        return array[addr - start]
 
     def set(self, addr, val):
-        # Cartridge ROM bank 0 0x0000-0x3FFF
-        if addr >= 0x0000 and addr <= 0x3FFF:
-            raise NotImplementedError('Access of unimplemented memory space ' + str(addr))
-
-        # Cartridge ROM switchable bank 0x4000-0x7FFF
-        elif addr >= 0x4000 and addr <= 0x7FFF:
-            raise NotImplementedError('Access of unimplemented memory space ' + str(addr))
-
-        # Character RAM 0x8000-0x97FF
-        elif addr >= 0x8000 and addr <= 0x97FF:
-            # return self.VRAM[addr - 0x8000]
-            addr_adj = addr - 0x8000
-            self.CHAR_RAM[addr_adj] = val
-
-        # BG Map Data 1 0x9800-0x9BFF
-        elif addr >= 0x9800 and addr <= 0x9BFF:
-            addr_adj = addr - 0x9800
-            self.BG_MAP_1[addr_adj] = val
-
-        # BG Map Data 2 0x9C00-0x9FFF
-        elif addr >= 0x9C00 and addr <= 0x9FFF:
-            addr_adj = addr - 0x9C00
-            self.BG_MAP_2[addr_adj] = val
-
-        # External RAM (if available) 0xA000-0xBFFF
-        elif addr >= 0xA000 and addr <= 0xBFFF:
-            addr_adj = addr - 0xA000
-            self.EXT_RAM[addr_adj] = val
-
-        # Work RAM 0xC000-0xDFFF
-        elif addr >= 0xC000 and addr <= 0xDFFF:
-            addr_adj = addr - 0xC000
-            self.WORK_RAM[addr_adj] = val
-
-        # Echo RAM (Reserved, shouldn't be used) 0xE000-0xFDFF
-        elif addr >= 0xE000 and addr <= 0xFDFF:
-            raise NotImplementedError('Access of unimplemented memory space ' + str(addr))
-
-        # OAM - Object Attribute Memory 0xFE00-0xFE9F
-        elif addr >= 0xFE00 and addr <= 0xFE9F:
-            addr_adj = addr - 0xFE00
-            self.OAM[addr_adj] = val
-
-        # Unusable Memory 0xFEA0-0xFEFF
-        elif addr >= 0xFEA0 and addr <= 0xFEFF:
-            raise NotImplementedError('Access of unimplemented memory space ' + str(addr))
-
-        # Hardware I/O Registers 0xFF00-0xFF7F
-        elif addr >= 0xFF00 and addr <= 0xFF7F:
-            # TODO: Implement HW regs SET
-            addr_adj = addr - 0xFF00
-            self.HW_REGS_TEMP[addr_adj] = val
-
-        # High RAM 0xFF80-0xFFFE
-        elif addr >= 0xFF80 and addr <= 0xFFFE:
-            addr_adj = addr - 0xFF80
-            self.HIGH_RAM[addr_adj] = val
-
-        # Interrupt register 0xFFFF
-        elif addr == 0xFFFF:
-            self.INTERRUPT = val
-
-        else:
+        if (addr < 0 or addr > 0xFFFF):
             raise MemoryAccessError('Crazy out of range address requested from MMU: ' + str(addr))
+        array, start, handler = self.write_pages[addr >> 8]
+        if (handler is not None):
+            handler(addr, val)
+            return
+        array[addr - start] = val
@@ -0,0 +1,239 @@
+import numpy as np
+from core import Core
+from cycles import CLOCKS, CB_CLOCKS
+from localcore import REGS, if_tree, opcode_source, handler_source
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+## Numba core
+# The fetch/decode/execute loop of LocalCore as a kernel working only on
+# NumPy arrays and ints, so Numba can compile it in nopython mode: a flat
+# 64K copy of the memory map, the register file and clock count in a state
+# array, and MMU.code_pages. The CPU and MMU stay the real state. Memory
+# is copied in before each kernel call and RAM copied back after, and the
+# kernel returns to Python for anything with side effects:
+#   - scheduled events, by never running past the next event
+#   - writes outside plain RAM (IO registers, IE, bank control, banked
+#     external RAM) or into pages holding code, which are queued and done
+#     through MMU.set
+#   - interrupts pending, and the few opcodes LocalCore also leaves to the
+#     CPU's own handlers (HALT, STOP, EI, DI, RETI, DAA...), run by CPU.tick
+# Without Numba the same kernel runs as plain Python, far slower than CPU
+# itself, so numba_core() hands back the CPU instead.
+
+# Kernel exit reasons
+LIMIT = 0
+FALLBACK = 1
+WRITES = 2
+
+# State array layout, registers first in CPU.regs order
+STATE_SP = 8
+STATE_PC = 9
+STATE_CYCLES = 10
+
+# Queued writes, (count, addr, val, addr, val). No instruction writes more
+# than twice and the kernel stops after any instruction that queued one.
+MAX_WRITES = 2
+
+def read(mem, addr):
+    return int(mem[addr & 0xFFFF])
+
+def write(mem, code, writes, addr, val):
+    addr &= 0xFFFF
+    if (((0x8000 <= addr < 0xA000) or (0xC000 <= addr < 0xE000) or (0xFE00 <= addr < 0xFEA0) or (0xFF80 <= addr < 0xFFFF))
+            and not code[addr >> 8]):
+        mem[addr] = val
+    else:
+        n = writes[0]
+        writes[1 + 2 * n] = addr
+        writes[2 + 2 * n] = val
+        writes[0] = n + 1
+
+## CB opcodes
+# Inlined rather than left to the CPU, they're far too common to leave the
+# kernel for. (result, carry out) of v, as the CPU's rotates and shifts.
+SHIFTS = [
+    ('((v << 1) | (v >> 7)) & 0xFF', 'v >> 7'),        # RLC
+    ('(v >> 1) | ((v & 0x01) << 7)', 'v & 0x01'),      # RRC
+    ('((v << 1) | ((f >> 4) & 0x01)) & 0xFF', 'v >> 7'), # RL
+    ('(v >> 1) | (((f >> 4) & 0x01) << 7)', 'v & 0x01'), # RR
+    ('(v << 1) & 0xFF', 'v >> 7'),                     # SLA
+    ('(v >> 1) | (v & 0x80)', 'v & 0x01'),             # SRA
+    ('((v & 0x0F) << 4) | (v >> 4)', '0'),             # SWAP
+    ('v >> 1', 'v & 0x01')                             # SRL
+]
+
+def cb_leaf(x):
+    reg = REGS[x & 0x07]
+    if (reg is None):
+        lines = ['hl = (h << 8) | l', 'v = read(hl)']
+        store = 'write(hl, %s)'
+    else:
+        lines = ['v = %s' % reg]
+        store = reg + ' = %s'
+    group = x >> 6
+    bit = 1 << ((x >> 3) & 0x07)
+
+    if (group == 0):
+        result, carry = SHIFTS[(x >> 3) & 0x07]
+        lines += [
+            't = %s' % result,
+            'f = (0x00 if t else 0x80) | ((%s) << 4)' % carry,
+            store % 't'
+        ]
+    elif (group == 1):
+        lines += ['f = (f & 0x10) | (0x20 if v & 0x%02X else 0xA0)' % bit]
+    elif (group == 2):
+        lines += [store % ('v & 0x%02X' % (~bit & 0xFF))]
+    else:
+        lines += [store % ('v | 0x%02X' % bit)]
+    return lines + ['cycles += %d' % CB_CLOCKS[x]]
+
+def kernel_leaf(op):
+    if (op == 0xCB):
+        return ['x = read(pc)', 'pc += 1'] + if_tree('x', 0x00, 0x100, cb_leaf) + ['cycles += %d' % CLOCKS[op]]
+    lines = opcode_source(op)
+    if (lines == handler_source(op)):
+        # Back to Python with pc on the opcode, for CPU.tick to run
+        return ['pc -= 1', 'reason = %d' % FALLBACK, 'break']
+    return lines + ['cycles += %d' % CLOCKS[op]]
+
+def generate():
+    load = ['%s = int(state[%d])' % (reg, i) for i, reg in enumerate(REGS) if reg is not None]
+    load += [
+        'f = int(state[6])',
+        'sp = int(state[%d])' % STATE_SP,
+        'pc = int(state[%d])' % STATE_PC,
+        'cycles = int(state[%d])' % STATE_CYCLES
+    ]
+    store = ['state[%d] = %s' % (i, reg) for i, reg in enumerate(REGS) if reg is not None]
+    store += [
+        'state[6] = f',
+        'state[%d] = sp' % STATE_SP,
+        'state[%d] = pc' % STATE_PC,
+        'state[%d] = cycles' % STATE_CYCLES
+    ]
+
+    body = load + [
+        'reason = %d' % LIMIT,
+        'while (cycles < limit):',
+        '    op = read(pc)',
+        '    pc += 1'
+    ]
+    leaves = if_tree('op', 0x00, 0x100, kernel_leaf)
+    body += ['    ' + line for line in leaves] + [
+        '    if (writes[0]):',
+        '        reason = %d' % WRITES,
+        '        break'
+    ] + store + ['return reason']
+
+    source = 'def run(mem, code, writes, state, limit):\n' + ''.join('    ' + line + '\n' for line in body)
+    # Memory access goes through the arrays passed in
+    return source.replace('read(', 'read(mem, ').replace('write(', 'write(mem, code, writes, ')
+
+_kernels = {}
+
+def build(jit):
+    # Compiled once per process, Numba's own cache keeps it across runs
+    if (jit not in _kernels):
+        namespace = {}
+        if (jit):
+            namespace['read'] = numba.njit(read)
+            namespace['write'] = numba.njit(write)
+        else:
+            namespace['read'] = read
+            namespace['write'] = write
+        exec(compile(generate(), '<numbacore>', 'exec'), namespace)
+        kernel = namespace['run']
+        _kernels[jit] = numba.njit(kernel) if jit else kernel
+    return _kernels[jit]
+
+class NumbaCore(Core):
+    def __init__(self, cpu, jit = True):
+        self.cpu = cpu
+        self.kernel = build(jit and numba is not None)
+        self.memory = np.zeros(0x10000, dtype=np.uint8)
+        self.flat = np.frombuffer(cpu.mmu.memory, dtype=np.uint8)
+        self.code = np.frombuffer(cpu.mmu.code_pages, dtype=np.uint8)
+        self.writes = np.zeros(1 + 2 * MAX_WRITES, dtype=np.int64)
+        self.state = np.zeros(STATE_CYCLES + 1, dtype=np.int64)
+        self.load_rom()
+        cpu.mmu.add_bank_listener(lambda bank, bank_0: self.load_rom())
+
+    def load_rom(self):
+        # The kernel's copy of the banks mapped now
+        mmu = self.cpu.mmu
+        for start, window in ((0x0000, mmu.ROM_0), (0x4000, mmu.ROM_BANK)):
+            self.memory[start:start + len(window)] = np.frombuffer(window, dtype=np.uint8)
+
+    def load(self):
+        cpu = self.cpu
+        memory = self.memory
+        cpu.sync_flags()
+        memory[0x8000:] = self.flat[0x8000:]
+        # Disabled RAM and MBC3's clock registers read the same everywhere
+        array, start, handler = cpu.mmu.read_pages[0xA0]
+        if (handler is None):
+            memory[0xA000:0xC000] = np.frombuffer(array, dtype=np.uint8)
+        else:
+            memory[0xA000:0xC000] = handler(0xA000)
+        self.state[:8] = np.frombuffer(cpu.regs, dtype=np.uint8)
+        self.state[STATE_SP] = cpu.sp
+        self.state[STATE_PC] = cpu.pc
+        self.state[STATE_CYCLES] = cpu.cycles
+
+    def store(self):
+        cpu = self.cpu
+        memory = self.memory
+        # IO registers and external RAM are only ever written through MMU.set
+        self.flat[0x8000:0xA000] = memory[0x8000:0xA000]
+        self.flat[0xC000:0xFF00] = memory[0xC000:0xFF00]
+        self.flat[0xFF80:] = memory[0xFF80:]
+        cpu.regs[:] = self.state[:8].astype(np.uint8).tobytes()
+        cpu.sp = int(self.state[STATE_SP])
+        cpu.pc = int(self.state[STATE_PC])
+        cpu.cycles = int(self.state[STATE_CYCLES])
+
+    def run_until(self, target):
+        # Runs the kernel up to target or the next event, then whatever it
+        # returned to Python for
+        cpu = self.cpu
+        if (cpu.interrupts.ready):
+            cpu.tick()
+            return
+        self.load()
+        reason = self.kernel(self.memory, self.code, self.writes, self.state, min(target, cpu.scheduler.next_time))
+        self.store()
+        if (reason == FALLBACK):
+            cpu.tick()
+            return
+        writes = self.writes
+        for i in range(int(writes[0])):
+            cpu.mmu.set(int(writes[1 + 2 * i]), int(writes[2 + 2 * i]))
+        writes[0] = 0
+        # As the end of CPU.tick
+        if (cpu.cycles >= cpu.scheduler.next_time):
+            cpu.scheduler.run_due(cpu.cycles)
+        if (cpu.interrupts.ready):
+            cpu.handle_interrupts()
+
+    def step(self):
+        self.run_until(self.cpu.cycles + 1)
+
+    def run_cycles(self, n):
+        cpu = self.cpu
+        start = cpu.cycles
+        target = start + n
+        cpu.cycle_target = target
+        while (cpu.cycles < target):
+            self.run_until(target)
+        return cpu.cycles - start
+
+def numba_core(cpu):
+    # NumbaCore if Numba is installed, otherwise the CPU runs itself
+    if (numba is None):
+        return cpu
+    return NumbaCore(cpu)
@@ -0,0 +1,439 @@
+from core import Core
+from cycles import CLOCKS, BRANCH_CLOCKS
+
+## Basic-block recompiler
+# Straight-line runs of ROM code are translated to Python source with the
+# registers held in locals, compiled once and cached by start address.
+# A block runs until it reaches a branch, an instruction it can't translate
+# or a write into IO space, bank control or a page holding code, then
+# returns to the dispatcher, which checks for interrupts before the next
+# block. ROM blocks are cached per bank, like CPU's decode cache.
+
+# Register order used by the opcode encoding, (HL) sits at index 6
+REGS = ['b', 'c', 'd', 'e', 'h', 'l', None, 'a']
+PAIRS = [('b', 'c'), ('d', 'e'), ('h', 'l')]
+
+# Condition codes for JP/JR/CALL/RET cc, indexed by bits 3-4 of the opcode
+CONDITIONS = [
+    'not (f & 0x80)',
+    '(f & 0x80)',
+    'not (f & 0x10)',
+    '(f & 0x10)'
+]
+
+MAX_BLOCK_LENGTH = 64
+
+# Regions code is cached from, (start, end). Blocks never cross a region end.
+# Writes into RAM holding blocks invalidate them through MMU.code_written.
+CODE_REGIONS = [
+    (0x0000, 0x4000), # ROM bank 0
+    (0x4000, 0x8000), # Switchable ROM bank
+    (0xA000, 0xC000), # External RAM
+    (0xC000, 0xE000), # Work RAM
+    (0xFF80, 0xFFFF)  # High RAM
+]
+
+def alu_source(i, x):
+    # 8-bit ALU op i (ADD, ADC, SUB, SBC, AND, XOR, OR, CP) on A and x,
+    # ADC and SBC carry in unconditionally as their handlers do
+    if (i in (0, 1)):
+        c = i
+        return [
+            'x = %s' % x,
+            't = a + x + %d' % c,
+            'f = (f & 0x0F) | (0x00 if t & 0xFF else 0x80) | (0x20 if (a & 0x0F) + (x & 0x0F) + %d > 0x0F else 0x00) | (0x10 if t > 0xFF else 0x00)' % c,
+            'a = t & 0xFF'
+        ]
+    elif (i in (2, 3, 7)):
+        c = 1 if i == 3 else 0
+        lines = [
+            'x = %s' % x,
+            't = a - x - %d' % c,
+            'f = (f & 0x0F) | 0x40 | (0x00 if t & 0xFF else 0x80) | (0x20 if (a & 0x0F) < (x & 0x0F) + %d else 0x00) | (0x10 if t < 0 else 0x00)' % c
+        ]
+        if (i != 7):
+            lines.append('a = t & 0xFF')
+        return lines
+    else:
+        op = {4: '&', 5: '^', 6: '|'}[i]
+        h = '0x20' if i == 4 else '0x00'
+        return [
+            'a %s= %s' % (op, x),
+            'f = (f & 0x0F) | (0x00 if a else 0x80) | %s' % h
+        ]
+
+def push_source(hi, lo):
+    return [
+        'write(sp - 1, %s)' % hi,
+        'write(sp - 2, %s)' % lo,
+        'sp -= 2'
+    ]
+
+def write_source(addr, val):
+    return ['dirty = code_pages[%s >> 8]' % addr, 'write(%s, %s)' % (addr, val)]
+
+def exit_source(nxt):
+    # CYCLES is filled in by Recompiler.compile with the clocks run up to
+    # and including the exiting instruction
+    return ['    pc = 0x%04X' % nxt, '    cycles = CYCLES', '    return']
+
+def write_exit(addr, nxt):
+    # Leave the block after a write that may have hit an IO register or code,
+    # possibly this block's own
+    return ['if (dirty or not 0x8000 <= %s < 0xFF00):' % addr] + exit_source(nxt)
+
+def branch_source(op, cond, taken, nxt):
+    lines = ['if %s:' % cond]
+    lines += ['    ' + line for line in taken]
+    lines += ['    cycles += %d' % BRANCH_CLOCKS[op], 'else:', '    pc = 0x%04X' % nxt]
+    return lines
+
+def translate(op, n, nn, pc):
+    # Returns (source lines, length, ends block), or None if op can't be
+    # translated. n and nn are the immediate operands following op.
+    nxt = pc + 1
+
+    if (op == 0x00):
+        return [], 1, False
+
+    # LD r1, r2 / LD r, (HL) / LD (HL), r
+    if (0x40 <= op < 0x80 and op != 0x76):
+        dst, src = REGS[(op >> 3) & 0x07], REGS[op & 0x07]
+        if (src is None):
+            return ['%s = read((h << 8) | l)' % dst], 1, False
+        elif (dst is None):
+            return ['hl = (h << 8) | l'] + write_source('hl', src) + write_exit('hl', nxt), 1, False
+        elif (dst != src):
+            return ['%s = %s' % (dst, src)], 1, False
+        return [], 1, False
+
+    # LD r, n / LD (HL), n
+    if ((op & 0xC7) == 0x06):
+        dst = REGS[(op >> 3) & 0x07]
+        if (dst is None):
+            return ['hl = (h << 8) | l'] + write_source('hl', '0x%02X' % n) + write_exit('hl', nxt + 1), 2, False
+        return ['%s = 0x%02X' % (dst, n)], 2, False
+
+    # 8-bit ALU
+    if (0x80 <= op < 0xC0):
+        src = REGS[op & 0x07]
+        x = 'read((h << 8) | l)' if src is None else src
+        return alu_source((op >> 3) & 0x07, x), 1, False
+    if ((op & 0xC7) == 0xC6):
+        return alu_source((op >> 3) & 0x07, '0x%02X' % n), 2, False
+
+    # INC/DEC r, (HL)
+    if ((op & 0xC6) == 0x04):
+        dst = REGS[(op >> 3) & 0x07]
+        if (op & 0x01):
+            lines = ['v = (%s - 1) & 0xFF', 'f = (f & 0x1F) | 0x40 | (0x00 if v else 0x80) | (0x20 if (v & 0x0F) == 0x0F else 0x00)']
+        else:
+            lines = ['v = (%s + 1) & 0xFF', 'f = (f & 0x1F) | (0x00 if v else 0x80) | (0x00 if v & 0x0F else 0x20)']
+        if (dst is None):
+            lines[0] = lines[0] % 'read(hl)'
+            return ['hl = (h << 8) | l'] + lines + write_source('hl', 'v') + write_exit('hl', nxt), 1, False
+        lines[0] = lines[0] % dst
+        return lines + ['%s = v' % dst], 1, False
+
+    # 16-bit loads and arithmetic on BC, DE, HL
+    if ((op & 0xCF) in (0x01, 0x03, 0x09, 0x0B) and op < 0x30):
+        hi, lo = PAIRS[op >> 4]
+        if ((op & 0x0F) == 0x01):
+            return ['%s = 0x%02X' % (hi, nn >> 8), '%s = 0x%02X' % (lo, nn & 0xFF)], 3, False
+        elif ((op & 0x0F) == 0x09):
+            return [
+                'hl = (h << 8) | l',
+                'rr = (%s << 8) | %s' % (hi, lo),
+                't = hl + rr',
+                'f = (f & 0x8F) | (0x20 if (hl & 0xFFF) + (rr & 0xFFF) > 0xFFF else 0x00) | (0x10 if t > 0xFFFF else 0x00)',
+                'h = (t >> 8) & 0xFF',
+                'l = t & 0xFF'
+            ], 1, False
+        delta = '1' if (op & 0x0F) == 0x03 else '0xFFFF'
+        return [
+            't = (((%s << 8) | %s) + %s) & 0xFFFF' % (hi, lo, delta),
+            '%s = t >> 8' % hi,
+            '%s = t & 0xFF' % lo
+        ], 1, False
+
+    # SP
+    if (op == 0x31):
+        return ['sp = 0x%04X' % nn], 3, False
+    if (op == 0x33):
+        return ['sp = (sp + 1) & 0xFFFF'], 1, False
+    if (op == 0x3B):
+        return ['sp = (sp - 1) & 0xFFFF'], 1, False
+    if (op == 0x39):
+        return [
+            'hl = (h << 8) | l',
+            't = hl + sp',
+            'f = (f & 0x8F) | (0x20 if (hl & 0xFFF) + (sp & 0xFFF) > 0xFFF else 0x00) | (0x10 if t > 0xFFFF else 0x00)',
+            'h = (t >> 8) & 0xFF',
+            'l = t & 0xFF'
+        ], 1, False
+    if (op == 0xF9):
+        return ['sp = (h << 8) | l'], 1, False
+
+    # LD A, (rr) / LD (rr), A
+    if (op in (0x0A, 0x1A)):
+        hi, lo = PAIRS[op >> 4]
+        return ['a = read((%s << 8) | %s)' % (hi, lo)], 1, False
+    if (op in (0x02, 0x12)):
+        hi, lo = PAIRS[op >> 4]
+        return ['rr = (%s << 8) | %s' % (hi, lo)] + write_source('rr', 'a') + write_exit('rr', nxt), 1, False
+
+    # LDI/LDD
+    if (op in (0x22, 0x2A, 0x32, 0x3A)):
+        delta = '1' if op < 0x30 else '0xFFFF'
+        lines = ['hl = (h << 8) | l']
+        if (op & 0x08):
+            lines.append('a = read(hl)')
+        else:
+            lines += write_source('hl', 'a')
+        lines += ['t = (hl + %s) & 0xFFFF' % delta, 'h = t >> 8', 'l = t & 0xFF']
+        if (not op & 0x08):
+            lines += write_exit('hl', nxt)
+        return lines, 1, False
+
+    # Loads to and from fixed addresses, writes to IO and bank control end
+    # the block
+    if (op == 0xFA):
+        return ['a = read(0x%04X)' % nn], 3, False
+    if (op == 0xEA):
+        if (nn >= 0xFF00 or nn < 0x8000):
+            return ['write(0x%04X, a)' % nn], 3, True
+        return write_source('0x%04X' % nn, 'a') + ['if (dirty):'] + exit_source(pc + 3), 3, False
+    if (op == 0xF0):
+        return ['a = read(0x%04X)' % (0xFF00 + n)], 2, False
+    if (op == 0xE0):
+        return ['write(0x%04X, a)' % (0xFF00 + n)], 2, True
+    if (op == 0xF2):
+        return ['a = read(0xFF00 + c)'], 1, False
+    if (op == 0xE2):
+        return ['write(0xFF00 + c, a)'], 1, True
+
+    # PUSH/POP
+    if ((op & 0xCF) in (0xC5, 0xC1)):
+        hi, lo = (PAIRS + [('a', 'f')])[(op >> 4) & 0x03]
+        if (op & 0x04):
+            return push_source(hi, lo), 1, False
+        return ['%s = read(sp)' % lo, '%s = read(sp + 1)' % hi, 'sp += 2'], 1, False
+
+    # Rotates on A
+    if (op == 0x07):
+        return ['a = ((a << 1) | (a >> 7)) & 0xFF', 'f = (f & 0x0F) | (0x00 if a else 0x80) | ((a & 0x01) << 4)'], 1, False
+    if (op == 0x17):
+        return [
+            't = ((a << 1) & 0xFF) | ((f >> 4) & 0x01)',
+            'f = (f & 0x0F) | (0x00 if t else 0x80) | ((a >> 7) << 4)',
+            'a = t'
+        ], 1, False
+    if (op == 0x0F):
+        return [
+            't = (a >> 1) | ((a & 0x01) << 7)',
+            'f = (f & 0x0F) | (0x00 if t else 0x80) | ((a & 0x01) << 4)',
+            'a = t'
+        ], 1, False
+    if (op == 0x1F):
+        return [
+            't = (a >> 1) | ((f & 0x10) << 3)',
+            'f = (f & 0x0F) | (0x00 if a & 0xFE else 0x80) | ((a & 0x01) << 4)',
+            'a = t'
+        ], 1, False
+
+    # Misc
+    if (op == 0x2F):
+        return ['a ^= 0xFF', 'f |= 0x60'], 1, False
+    if (op == 0x37):
+        return ['f = (f & 0x8F) | 0x10'], 1, False
+    if (op == 0x3F):
+        return ['f = (f & 0x9F) ^ 0x10'], 1, False
+
+    # Jumps, calls, returns and restarts end the block
+    cond = CONDITIONS[(op >> 3) & 0x03]
+    if (op == 0xC3):
+        return ['pc = 0x%04X' % nn], 3, True
+    if ((op & 0xE7) == 0xC2):
+        return branch_source(op, cond, ['pc = 0x%04X' % nn], pc + 3), 3, True
+    if (op == 0x18):
+        return ['pc = 0x%04X' % ((pc + 2 + (n ^ 0x80) - 0x80) & 0xFFFF)], 2, True
+    if ((op & 0xE7) == 0x20):
+        return branch_source(op, cond, ['pc = 0x%04X' % ((pc + 2 + (n ^ 0x80) - 0x80) & 0xFFFF)], pc + 2), 2, True
+    if (op == 0xE9):
+        return ['pc = (h << 8) | l'], 1, True
+    if (op == 0xCD):
+        return push_source('0x%02X' % ((pc + 3) >> 8), '0x%02X' % ((pc + 3) & 0xFF)) + ['pc = 0x%04X' % nn], 3, True
+    if ((op & 0xE7) == 0xC4):
+        lines = push_source('0x%02X' % ((pc + 3) >> 8), '0x%02X' % ((pc + 3) & 0xFF)) + ['pc = 0x%04X' % nn]
+        return branch_source(op, cond, lines, pc + 3), 3, True
+    if (op == 0xC9):
+        return ['pc = read(sp) | (read(sp + 1) << 8)', 'sp += 2'], 1, True
+    if ((op & 0xE7) == 0xC0):
+        lines = ['pc = read(sp) | (read(sp + 1) << 8)', 'sp += 2']
+        return branch_source(op, cond, lines, nxt), 1, True
+    if ((op & 0xC7) == 0xC7):
+        return push_source('0x%02X' % (nxt >> 8), '0x%02X' % (nxt & 0xFF)) + ['pc = 0x%04X' % (op & 0x38)], 1, True
+
+    return None
+
+def region_end(addr):
+    for start, end in CODE_REGIONS:
+        if (start <= addr < end):
+            return end
+    return None
+
+class Recompiler(Core):
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.mmu = cpu.mmu
+        # RAM blocks by start address
+        self.blocks = {}
+
+        # ROM blocks, per bank mapped at 0x0000 and at 0x4000
+        self.fixed_blocks = {}
+        self.rom_blocks = {}
+        self.select_bank(self.mmu.rom_bank, self.mmu.rom_bank_0)
+        self.mmu.add_bank_listener(self.select_bank)
+
+        # For RAM blocks, start address -> end of the block's last byte and
+        # page -> start addresses of the blocks touching it
+        self.extents = {}
+        self.page_blocks = {}
+        self.mmu.add_code_listener(self.invalidate)
+
+    def select_bank(self, bank, bank_0 = 0):
+        self.fixed = self.fixed_blocks.setdefault(bank_0, {})
+        self.bank = self.rom_blocks.setdefault(bank, {})
+
+    def decode(self, pc):
+        # Returns a list of (address, opcode, source lines) and the address the block
+        # falls through to
+        get = self.mmu.get
+        limit = region_end(pc)
+        instructions = []
+        ends = False
+
+        while (not ends and len(instructions) < MAX_BLOCK_LENGTH and pc < limit):
+            op = get(pc)
+            n = get(pc + 1) if pc + 1 < limit else 0
+            nn = ((get(pc + 2) << 8) | n) if pc + 2 < limit else 0
+            translated = translate(op, n, nn, pc)
+            if (translated is None):
+                break
+            lines, length, ends = translated
+            if (pc + length > limit):
+                break
+            instructions.append((pc, op, lines))
+            pc += length
+
+        return instructions, pc
+
+    def compile(self, start):
+        instructions, end = self.decode(start)
+        if (not instructions):
+            return None
+
+        name = 'block_%04X' % start
+        body = [
+            'b, c, d, e, h, l, f, a = regs',
+            'sp = cpu.sp',
+            'pc = 0x%04X' % end,
+            'cycles = %d' % sum(CLOCKS[op] for addr, op, lines in instructions),
+            'try:'
+        ]
+        clocks = 0
+        for addr, op, lines in instructions:
+            clocks += CLOCKS[op]
+            body.append('    # 0x%04X' % addr)
+            body += ['    ' + line.replace('CYCLES', str(clocks)) for line in lines or ['pass']]
+        body += [
+            'finally:',
+            '    regs[:] = (b, c, d, e, h, l, f, a)',
+            '    cpu.sp = sp',
+            '    cpu.pc = pc',
+            '    cpu.cycles += cycles'
+        ]
+        source = 'def %s(cpu, regs, read, write, code_pages):\n' % name + ''.join('    ' + line + '\n' for line in body)
+
+        namespace = {}
+        exec(compile(source, '<%s>' % name, 'exec'), namespace)
+        return namespace[name], end
+
+    def lookup(self, pc):
+        # Cached block at pc, compiling it on first use. None if pc can't
+        # start a block, that's cached too.
+        if (pc >= 0x8000):
+            blocks = self.blocks
+        else:
+            blocks = self.fixed if pc < 0x4000 else self.bank
+        try:
+            return blocks[pc]
+        except KeyError:
+            pass
+
+        if (region_end(pc) is None):
+            return None
+
+        compiled = self.compile(pc)
+        if (compiled is None):
+            block, end = None, pc + 1
+        else:
+            block, end = compiled
+
+        blocks[pc] = block
+        if (pc >= 0x8000):
+            self.extents[pc] = end
+            for page in range(pc >> 8, ((end - 1) >> 8) + 1):
+                self.page_blocks.setdefault(page, []).append(pc)
+                self.mmu.mark_code(page)
+
+        return block
+
+    def invalidate(self, start, end):
+        # Called by the MMU on a write from start up to end into pages
+        # holding blocks, drops the blocks it overlaps. Returns whether
+        # those pages still hold any.
+        pages = range(start >> 8, ((end - 1) >> 8) + 1)
+        stale = set(block for page in pages for block in self.page_blocks.get(page, [])
+            if block < end and self.extents[block] > start)
+
+        for block in stale:
+            block_end = self.extents.pop(block)
+            del self.blocks[block]
+            for p in range(block >> 8, ((block_end - 1) >> 8) + 1):
+                self.page_blocks[p].remove(block)
+
+        return any(self.page_blocks.get(page) for page in pages)
+
+    def step(self):
+        # Runs one block, or one instruction through the interpreter where
+        # no block could be built
+        cpu = self.cpu
+        block = self.lookup(cpu.pc)
+
+        if (block is None):
+            cpu.tick()
+            return
+
+        if (cpu.pending_flags is not None):
+            cpu.sync_flags()
+        mmu = self.mmu
+        block(cpu, cpu.regs, mmu.get, mmu.set, mmu.code_pages)
+        if (cpu.cycles >= cpu.scheduler.next_time):
+            cpu.scheduler.run_due(cpu.cycles)
+        if (cpu.interrupts.ready):
+            cpu.handle_interrupts()
+
+    def run_cycles(self, n):
+        # As CPU.run_cycles, a block always runs to its end so the budget may
+        # be overshot by up to one block
+        cpu = self.cpu
+        step = self.step
+        start = cpu.cycles
+        target = start + n
+        cpu.cycle_target = target
+
+        while (cpu.cycles < target):
+            step()
+
+        return cpu.cycles - start
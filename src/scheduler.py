@@ -0,0 +1,28 @@
+import heapq
+
+## Event scheduler
+# Hardware that acts at a known time (LCD lines, timer overflow, serial
+# transfer) schedules a callback against the CPU's clock counter instead of
+# being stepped every instruction. Callbacks get the time they were due.
+
+# Time of the next event when nothing is scheduled
+NEVER = 1 << 62
+
+class Scheduler:
+    def __init__(self):
+        self.events = []
+        self.next_time = NEVER
+        # Keeps events due at the same time in the order they were scheduled
+        self.count = 0
+
+    def schedule(self, time, callback):
+        heapq.heappush(self.events, (time, self.count, callback))
+        self.count += 1
+        self.next_time = self.events[0][0]
+
+    def run_due(self, now):
+        events = self.events
+        while (events and events[0][0] <= now):
+            time, count, callback = heapq.heappop(events)
+            callback(time)
+        self.next_time = events[0][0] if events else NEVER
@@ -0,0 +1,81 @@
+import hashlib
+from cpu import REG_INDEX
+from mmu import STATE_ARRAYS
+from exceptions.divergence_error import DivergenceError
+
+## Lockstep validation
+# Runs a candidate core next to a reference core, each on its own CPU
+# loaded with the same ROM. After every candidate step the reference runs
+# until it has caught up on clocks, so a Recompiler step of a whole block
+# lines up with the instructions in it. Registers, flags and a hash of
+# memory are compared every `interval` steps. On a mismatch both cores go
+# back to the last matching state and replay step by step to find the first
+# instruction where they differ, which is raised as a DivergenceError.
+
+def fingerprint(cpu):
+    cpu.sync_flags()
+    interrupts = cpu.interrupts
+    digest = hashlib.sha1()
+    for name in STATE_ARRAYS:
+        digest.update(getattr(cpu.mmu, name).tobytes())
+
+    state = dict((reg, cpu.regs[i]) for reg, i in REG_INDEX.items())
+    state.update({
+        'SP': cpu.sp,
+        'PC': cpu.pc,
+        'cycles': cpu.cycles,
+        'halted': cpu.halted,
+        'IME': interrupts.ime,
+        'IF': interrupts.flags,
+        'IE': interrupts.enable,
+        'memory': digest.hexdigest()
+    })
+    return state
+
+def differences(reference, candidate):
+    return dict((name, (reference[name], candidate[name]))
+        for name in reference if reference[name] != candidate[name])
+
+class LockstepValidator:
+    def __init__(self, reference, candidate, interval = 1000):
+        self.reference = reference
+        self.candidate = candidate
+        self.interval = interval
+        # Candidate steps checked so far
+        self.steps = 0
+
+    def step(self):
+        self.candidate.step()
+        target = self.candidate.cpu.cycles
+        reference = self.reference
+        while (reference.cpu.cycles < target):
+            reference.step()
+
+    def run(self, steps):
+        # Runs the candidate for steps steps, raises DivergenceError if the
+        # cores stop agreeing
+        ref, cand = self.reference.cpu, self.candidate.cpu
+        end = self.steps + steps
+        while (self.steps < end):
+            saved = (ref.save_state(), cand.save_state())
+            n = min(self.interval, end - self.steps)
+            for i in range(n):
+                self.step()
+            if (fingerprint(ref) != fingerprint(cand)):
+                ref.load_state(saved[0])
+                cand.load_state(saved[1])
+                self.replay(n)
+            self.steps += n
+
+    def replay(self, n):
+        ref, cand = self.reference.cpu, self.candidate.cpu
+        for i in range(n):
+            pc = cand.pc
+            op = cand.mmu.get(pc)
+            self.step()
+            diff = differences(fingerprint(ref), fingerprint(cand))
+            if (diff):
+                raise DivergenceError(self.steps + i + 1, pc, op, diff)
+
+        # Only differed when run without checks in between
+        raise DivergenceError(None, cand.pc, cand.mmu.get(cand.pc), differences(fingerprint(ref), fingerprint(cand)))
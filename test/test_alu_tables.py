@@ -0,0 +1,47 @@
+import numpy as np
+import alu_tables
+from mmu import MMU
+from cpu import CPU
+
+def test_save_and_read(tmp_path):
+    tables = alu_tables.build_tables()
+    path = str(tmp_path / 'alu_tables.bin')
+    alu_tables.save_tables(tables, path)
+    assert alu_tables.read_tables(path) == tables
+
+def test_tables_match_alu():
+    tables = alu_tables.load_tables()
+    cpu = CPU(MMU(np.zeros(0x8000, dtype=np.uint8)))
+
+    for a in range(0, 0x100, 0x07):
+        for b in range(0x100):
+            for c in range(2):
+                index = (c << 16) | (a << 8) | b
+
+                cpu.set_reg_8('F', 0x00)
+                result = cpu.add_8(a, b, c)
+                assert tables['ADD'][index] == (cpu.get_reg_8('F') << 8) | result
+
+                cpu.set_reg_8('F', 0x00)
+                result = cpu.sub_8(a, b, c)
+                assert tables['SUB'][index] == (cpu.get_reg_8('F') << 8) | result
+
+def test_table_opcodes():
+    # ALU opcodes must behave the same with and without tables
+    for op in list(range(0x80, 0xC0)) + list(range(0xC6, 0x100, 0x08)):
+        for a in (0x00, 0x0F, 0x3C, 0x80, 0xFF):
+            rom_file = np.zeros(0x8000, dtype=np.uint8)
+            rom_file[0x0100] = op
+            rom_file[0x0101] = 0x5A
+            rom_file[0x0123] = 0xC3
+            states = []
+            for use_alu_tables in (False, True):
+                cpu = CPU(MMU(rom_file), use_alu_tables=use_alu_tables)
+                cpu.set_reg_16('BC', 0x01F0)
+                cpu.set_reg_16('DE', 0x8F10)
+                cpu.set_reg_16('HL', 0x0123)
+                cpu.set_reg_8('A', a)
+                cpu.set_reg_8('F', 0x10)
+                cpu.tick()
+                states.append((cpu.get_reg_16('AF'), cpu.pc))
+            assert states[0] == states[1]
@@ -0,0 +1,110 @@
+import random
+import numpy as np
+from mmu import MMU
+from cpu import CPU
+from lcd import LCD
+from batch import BatchCPU, START, BUTTON_A
+
+def make_cpu(rom_file, seed):
+    rng = random.Random(seed)
+    cpu = CPU(MMU(rom_file))
+    LCD(cpu.mmu, cpu.scheduler)
+    cpu.regs[:] = rng.randbytes(8)
+    cpu.set_reg_16('BC', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('DE', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('HL', 0xC000 + rng.randrange(0x1FFF))
+    cpu.sp = 0xC100 + rng.randrange(0x1E00)
+    cpu.mmu.WORK_RAM[:] = np.frombuffer(rng.randbytes(0x2000), dtype=np.uint8)
+    return cpu
+
+def load(batch, k, cpu):
+    batch.regs[k] = list(cpu.regs)
+    batch.sp[k] = cpu.sp
+    batch.pc[k] = cpu.pc
+    batch.memory[k, 0xC000:0xE000] = cpu.mmu.WORK_RAM
+
+def state(batch, k):
+    return (
+        bytes(batch.regs[k].astype(np.uint8)), int(batch.sp[k]), int(batch.pc[k]), int(batch.cycles[k]),
+        batch.memory[k, 0xC000:0xE000].tobytes(), batch.memory[k, 0xFF80:0xFFFF].tobytes(), bool(batch.ime[k])
+    )
+
+def cpu_state(cpu):
+    return (
+        bytes(cpu.regs), cpu.sp, cpu.pc, cpu.cycles,
+        cpu.mmu.WORK_RAM.tobytes(), cpu.mmu.HIGH_RAM.tobytes(), cpu.interrupts.ime
+    )
+
+def test_opcodes():
+    # Every opcode and CB opcode must match CPU.tick, with a different
+    # operand and state on each instance
+    skip = [0xD3, 0xDB, 0xDD, 0xE3, 0xE4, 0xEB, 0xEC, 0xED, 0xF4, 0xFC, 0xFD]
+    for op in range(0x100):
+        if (op in skip):
+            continue
+        rom_file = np.zeros(0x8000, dtype=np.uint8)
+        rom_file[0x0100] = op
+        batch = BatchCPU(rom_file, 16)
+        cpus = []
+        for k in range(batch.n):
+            rom_file[0x0101] = (k * 53 + op) & 0xFF
+            rom_file[0x0102] = 0xC0 | (k & 0x1F)
+            cpu = make_cpu(rom_file.copy(), k)
+            batch.memory[k, 0x0101:0x0103] = rom_file[0x0101:0x0103]
+            load(batch, k, cpu)
+            cpus.append(cpu)
+
+        batch.step(np.arange(batch.n))
+        for k, cpu in enumerate(cpus):
+            cpu.tick()
+            assert state(batch, k) == cpu_state(cpu), (hex(op), k)
+
+def make_rom():
+    # Draws tile 1 at the top left, then counts V-Blanks in B and copies
+    # P1 into C from a HALT loop
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0040:0x0042] = [0x04, 0xD9] # INC B; RETI
+    rom_file[0x0100:0x0123] = [
+        0x21, 0x10, 0x80, # LD HL, 0x8010
+        0x3E, 0xFF,       # LD A, 0xFF
+        0x22,             # LD (HL+), A - tile 1 row 0 in colour 1
+        0x3E, 0x01,       # LD A, 0x01
+        0xEA, 0x00, 0x98, # LD (0x9800), A
+        0x3E, 0xE4,       # LD A, 0xE4
+        0xE0, 0x47,       # LDH (0x47), A
+        0x3E, 0x91,       # LD A, 0x91
+        0xE0, 0x40,       # LDH (0x40), A
+        0x3E, 0x01,       # LD A, 0x01
+        0xE0, 0xFF,       # LDH (0xFF), A
+        0xFB,             # EI
+        0x3E, 0x10,       # LD A, 0x10 <-
+        0xE0, 0x00,       # LDH (0x00), A
+        0xF0, 0x00,       # LDH A, (0x00)
+        0x4F,             # LD C, A
+        0x76,             # HALT
+        0xC3, 0x18, 0x01  # JP 0x0118
+    ]
+    return rom_file
+
+def test_step_frames():
+    rom_file = make_rom()
+    batch = BatchCPU(rom_file, 3)
+    actions = np.array([[0, START, BUTTON_A]] * 4)
+    frames = batch.step_frames(actions)
+    assert frames.shape == (4, 3, 144, 160)
+
+    # Matches CPU.run_frame apart from P1
+    cpu = CPU(MMU(rom_file))
+    LCD(cpu.mmu, cpu.scheduler)
+    for i in range(4):
+        cpu.run_frame()
+    assert int(batch.regs[0, 0]) == cpu.get_reg_8('B') == 4
+    assert int(batch.cycles[0]) == cpu.cycles
+
+    # Buttons read through P1 with bit 5 low
+    assert list(batch.regs[:, 1]) == [0xDF, 0xD7, 0xDE]
+
+    # Tile 1 row 0 is colour 1, shade 1 through BGP 0xE4
+    assert (frames[-1, :, 0, 0:8] == 1).all()
+    assert (frames[-1, :, 1:8, 0:8] == 0).all()
+    assert batch.step_frames([0, 0, 0]).shape == (3, 144, 160)
@@ -0,0 +1,98 @@
+import random
+import numpy as np
+import codegen
+from mmu import MMU
+from cpu import CPU
+
+def make_cpu(rom_file, seed, **options):
+    rng = random.Random(seed)
+    cpu = CPU(MMU(rom_file), **options)
+    cpu.regs[:] = rng.randbytes(8)
+    cpu.regs[6] &= 0xF0
+    cpu.set_reg_16('BC', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('DE', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('HL', 0xC000 + rng.randrange(0x1FFF))
+    cpu.sp = 0xC100 + rng.randrange(0x1E00)
+    cpu.mmu.WORK_RAM[:] = np.frombuffer(rng.randbytes(0x2000), dtype=np.uint8)
+    return cpu
+
+def state(cpu):
+    cpu.sync_flags()
+    return (bytes(cpu.regs), cpu.sp, cpu.pc, cpu.cycles, cpu.mmu.WORK_RAM.tobytes())
+
+def test_specialised_opcodes():
+    # Every generated handler must match the generic one
+    skip = [0x10, 0x76, 0xCB, 0xD3, 0xDB, 0xDD, 0xE3, 0xE4, 0xEB, 0xEC, 0xED, 0xF4, 0xFC, 0xFD]
+    for options in ({}, {'lazy_flags': True}):
+        for op in range(0x100):
+            if (op in skip):
+                continue
+            for seed in range(4):
+                rom_file = np.zeros(0x8000, dtype=np.uint8)
+                rom_file[0x0100] = op
+                rom_file[0x0101] = (seed * 53) & 0xFF
+                rom_file[0x0102] = 0xC0 | seed
+
+                generic = make_cpu(rom_file, seed, specialise=False, **options)
+                specialised = make_cpu(rom_file, seed, **options)
+                assert specialised.opcodes[op] is not generic.opcodes[op]
+
+                # Leave some flags pending for the lazy handlers to sync
+                for cpu in (generic, specialised):
+                    cpu.regs[7] = cpu.add_8(cpu.regs[7], seed * 0x41)
+                    cpu.tick()
+                assert state(specialised) == state(generic), hex(op)
+
+def test_generated_source():
+    source = codegen.generate(CPU, set([('LD_r1_r2', (7, 0)), ('JR_NZ', ())]), 'test')
+    assert 'SOURCE_HASH = \'test\'' in source
+    assert 'def LD_r1_r2_7_0():' in source
+    assert 'regs[7] = regs[0]' in source
+    assert 'set_flag' not in source
+    assert 'get_flag' not in source
+
+def test_module_cache(tmp_path, monkeypatch):
+    path = tmp_path / 'cpu_handlers.py'
+    monkeypatch.setattr(codegen, 'MODULE_PATH', str(path))
+    monkeypatch.setattr(codegen, '_module', None)
+    monkeypatch.setattr(codegen, '_layouts', {})
+    monkeypatch.setattr(codegen, 'MODULE', 'cpu_handlers_test')
+
+    module = codegen.load_module(set([('NOP', ())]))
+    assert path.exists()
+    assert module.SIGNATURES == [('NOP', ())]
+
+    # Already covered, nothing rebuilt
+    assert codegen.load_module(set([('NOP', ())])) is module
+
+    # New handlers are added to what the module already has
+    module = codegen.load_module(set([('DI', ())]))
+    assert module.SIGNATURES == [('DI', ()), ('NOP', ())]
+
+    # Stale source hash
+    module.SOURCE_HASH = 'stale'
+    module = codegen.load_module(set([('EI', ())]))
+    assert module.SIGNATURES == [('EI', ())]
+
+def test_operand_opcodes():
+    # Decoded handlers taking their operand must match the fetching ones
+    skip = [0x76, 0xD3, 0xDB, 0xDD, 0xE3, 0xE4, 0xEB, 0xEC, 0xED, 0xF4, 0xFC, 0xFD]
+    for op in range(0x100):
+        if (op in skip):
+            continue
+        for seed in range(4):
+            rom_file = np.zeros(0x8000, dtype=np.uint8)
+            rom_file[0x0100] = op
+            rom_file[0x0101] = (seed * 53 + op) & 0xFF
+            rom_file[0x0102] = 0xC0 | seed
+
+            fetching = make_cpu(rom_file, seed, decode_cache=False)
+            decoded = make_cpu(rom_file, seed)
+            for cpu in (fetching, decoded):
+                cpu.tick()
+            assert state(decoded) == state(fetching), hex(op)
+
+    cpu = make_cpu(rom_file, 0)
+    for op in (0x06, 0x18, 0x20, 0xC3, 0xCB, 0xCD, 0xEA):
+        assert cpu.operand_opcodes[op] is not None, hex(op)
+    assert cpu.operand_opcodes[0x00] is None
@@ -1,6 +1,8 @@
 import numpy as np
+import pytest
 from mmu import MMU
-from cpu import CPU
+from cpu import CPU, REG_H, REG_L
+from lcd import LCD
 
 def test_registers():
     cpu = CPU(MMU(np.zeros(0x8000, dtype=np.uint8)))
@@ -24,6 +26,19 @@ def test_registers():
     assert cpu.sp == 0xFFFE
     assert cpu.pc == 0x0100
 
+def test_register_file():
+    cpu = CPU(MMU(np.zeros(0x8000, dtype=np.uint8)))
+
+    cpu.set_pair(REG_H, REG_L, 0x1234)
+    assert cpu.get_pair(REG_H, REG_L) == 0x1234
+    assert cpu.regs[REG_H] == 0x12
+    assert cpu.regs[REG_L] == 0x34
+    assert cpu.get_reg_16('HL') == 0x1234
+
+    # Registers are 8 bits wide
+    with pytest.raises(ValueError):
+        cpu.set_reg_8('A', 0x100)
+
 def test_flags():
     flags = ['Z', 'N', 'H', 'C']
     cpu = CPU(MMU(np.zeros(0x8000, dtype=np.uint8)))
@@ -1563,6 +1578,22 @@ def test_SWAP_n():
     cpu.tick()
     assert cpu.mmu.get(0xC001) == 0xBA
 
+def test_SWAP_flags():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xCB
+    rom_file[0x0101] = 0x37
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_8('A', 0x00)
+    cpu.set_flag('N', 1)
+    cpu.set_flag('H', 1)
+    cpu.set_flag('C', 1)
+    cpu.tick()
+    assert cpu.get_reg_8('A') == 0x00
+    assert cpu.get_flag('Z') == 1
+    assert cpu.get_flag('N') == 0
+    assert cpu.get_flag('H') == 0
+    assert cpu.get_flag('C') == 0
+
 def test_DAA():
     # Set/reset N flag to test post add/subtract DAA respectively
     # Addition
@@ -2178,6 +2209,30 @@ def test_RR_n():
         assert cpu.get_flag('H') == 0
         assert cpu.get_flag('C') == 1
 
+def test_RR_n_zero():
+    # Z comes from the result, not from the byte being rotated
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xCB
+    rom_file[0x0101] = 0x1F
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_8('A', 0x01)
+    cpu.set_flag('C', 0)
+    cpu.tick()
+    assert cpu.get_reg_8('A') == 0x00
+    assert cpu.get_flag('Z') == 1
+    assert cpu.get_flag('C') == 1
+
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xCB
+    rom_file[0x0101] = 0x1F
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_8('A', 0x00)
+    cpu.set_flag('C', 1)
+    cpu.tick()
+    assert cpu.get_reg_8('A') == 0x80
+    assert cpu.get_flag('Z') == 0
+    assert cpu.get_flag('C') == 0
+
 def test_RLC_HL():
     # Test carry
     rom_file = np.zeros(0x8000, dtype=np.uint8)
@@ -2757,6 +2812,21 @@ def test_BIT():
         assert cpu.get_flag('N') == 0
         assert cpu.get_flag('H') == 1
 
+def test_BIT_flags():
+    # C and the low nibble of F are untouched, nothing leaks above bit 7
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xCB
+    rom_file[0x0101] = 0x47
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_8('A', 0xFE)
+    cpu.set_reg_8('F', 0x1A)
+    cpu.tick()
+    assert cpu.get_flag('Z') == 1
+    assert cpu.get_flag('N') == 0
+    assert cpu.get_flag('H') == 1
+    assert cpu.get_flag('C') == 1
+    assert cpu.get_reg_8('F') == 0xBA
+
 def test_SET():
     ops = {
         0xC7: 'A',
@@ -2789,6 +2859,17 @@ def test_SET():
         cpu.tick()
         assert cpu.mmu.get(cpu.get_reg_16('HL')) == 0x01 << i
 
+def test_SET_flags():
+    # SET leaves F alone, H included
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xCB
+    rom_file[0x0101] = 0xC7
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_8('F', 0x50)
+    cpu.tick()
+    assert cpu.get_reg_8('A') == 0x01
+    assert cpu.get_reg_8('F') == 0x50
+
 def test_RES():
     ops = {
         0x87: 'A',
@@ -2926,7 +3007,16 @@ def test_JR_n():
     cpu = CPU(MMU(rom_file))
     cpu.pc = 0x0012
     cpu.tick()
-    assert cpu.pc == 0x0047
+    assert cpu.pc == 0x0048
+
+    # Backwards
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0012] = 0x18
+    rom_file[0x0013] = 0xFE
+    cpu = CPU(MMU(rom_file))
+    cpu.pc = 0x0012
+    cpu.tick()
+    assert cpu.pc == 0x0012
 
 def test_JR_cc_n():
     # NZ
@@ -2936,7 +3026,7 @@ def test_JR_cc_n():
     cpu = CPU(MMU(rom_file))
     cpu.set_flag('Z', 0)
     cpu.tick()
-    assert cpu.pc == 0x0135
+    assert cpu.pc == 0x0136
 
     rom_file = np.zeros(0x8000, dtype=np.uint8)
     rom_file[0x0100] = 0x20
@@ -2961,7 +3051,7 @@ def test_JR_cc_n():
     cpu = CPU(MMU(rom_file))
     cpu.set_flag('Z', 1)
     cpu.tick()
-    assert cpu.pc == 0x0135
+    assert cpu.pc == 0x0136
 
     # NC
     rom_file = np.zeros(0x8000, dtype=np.uint8)
@@ -2970,7 +3060,7 @@ def test_JR_cc_n():
     cpu = CPU(MMU(rom_file))
     cpu.set_flag('C', 0)
     cpu.tick()
-    assert cpu.pc == 0x0135
+    assert cpu.pc == 0x0136
 
     rom_file = np.zeros(0x8000, dtype=np.uint8)
     rom_file[0x0100] = 0x30
@@ -2995,7 +3085,7 @@ def test_JR_cc_n():
     cpu = CPU(MMU(rom_file))
     cpu.set_flag('C', 1)
     cpu.tick()
-    assert cpu.pc == 0x0135
+    assert cpu.pc == 0x0136
 
 # Calls
 
@@ -3278,9 +3368,10 @@ def test_interrupts():
     cpu.mmu.set(0xFF0F, 0x01)
     cpu.mmu.set(0xFFFF, 0x01)
     cpu.tick()
+    cpu.tick()
     assert cpu.pc == 0x0040
     assert cpu.interrupt_master_enable == False
-    assert cpu.pop_stack() == 0x0101
+    assert cpu.pop_stack() == 0x0102
 
     #LDCD status
     rom_file = np.zeros(0x8000, dtype=np.uint8)
@@ -3289,9 +3380,10 @@ def test_interrupts():
     cpu.mmu.set(0xFF0F, 0x02)
     cpu.mmu.set(0xFFFF, 0x02)
     cpu.tick()
+    cpu.tick()
     assert cpu.pc == 0x0048
     assert cpu.interrupt_master_enable == False
-    assert cpu.pop_stack() == 0x0101
+    assert cpu.pop_stack() == 0x0102
 
     #Timer overflow
     rom_file = np.zeros(0x8000, dtype=np.uint8)
@@ -3300,9 +3392,10 @@ def test_interrupts():
     cpu.mmu.set(0xFF0F, 0x04)
     cpu.mmu.set(0xFFFF, 0x04)
     cpu.tick()
+    cpu.tick()
     assert cpu.pc == 0x0050
     assert cpu.interrupt_master_enable == False
-    assert cpu.pop_stack() == 0x0101
+    assert cpu.pop_stack() == 0x0102
 
     #Serial transfer complete
     rom_file = np.zeros(0x8000, dtype=np.uint8)
@@ -3311,9 +3404,10 @@ def test_interrupts():
     cpu.mmu.set(0xFF0F, 0x08)
     cpu.mmu.set(0xFFFF, 0x08)
     cpu.tick()
+    cpu.tick()
     assert cpu.pc == 0x0058
     assert cpu.interrupt_master_enable == False
-    assert cpu.pop_stack() == 0x0101
+    assert cpu.pop_stack() == 0x0102
 
     #P10-P13 input low
     rom_file = np.zeros(0x8000, dtype=np.uint8)
@@ -3322,9 +3416,10 @@ def test_interrupts():
     cpu.mmu.set(0xFF0F, 0x10)
     cpu.mmu.set(0xFFFF, 0x10)
     cpu.tick()
+    cpu.tick()
     assert cpu.pc == 0x0060
     assert cpu.interrupt_master_enable == False
-    assert cpu.pop_stack() == 0x0101
+    assert cpu.pop_stack() == 0x0102
 
     #Interrupt master disable
     rom_file = np.zeros(0x8000, dtype=np.uint8)
@@ -3345,7 +3440,8 @@ def test_interrupts():
     cpu.mmu.set(0xFF0F, 0x00)
     cpu.mmu.set(0xFFFF, 0x01)
     cpu.tick()
-    assert cpu.pc == 0x0101
+    cpu.tick()
+    assert cpu.pc == 0x0102
     assert cpu.interrupt_master_enable == True
 
     #Enable disabled
@@ -3355,39 +3451,240 @@ def test_interrupts():
     cpu.mmu.set(0xFF0F, 0x01)
     cpu.mmu.set(0xFFFF, 0x00)
     cpu.tick()
-    assert cpu.pc == 0x0101
+    cpu.tick()
+    assert cpu.pc == 0x0102
     assert cpu.interrupt_master_enable == True
 
     #Test priorities
     rom_file = np.zeros(0x8000, dtype=np.uint8)
-    rom_file[0x0100] = 0xFB
-    rom_file[0x0101] = 0xFB
-    rom_file[0x0102] = 0xFB
-    rom_file[0x0103] = 0xFB
-    rom_file[0x0104] = 0xFB
     cpu = CPU(MMU(rom_file))
     cpu.mmu.set(0xFF0F, 0x1F)
     cpu.mmu.set(0xFFFF, 0x1F)
+
+    for n, vector in enumerate([0x0040, 0x0048, 0x0050, 0x0058, 0x0060]):
+        cpu.pc = 0x0100 + n
+        cpu.interrupt_master_enable = True
+        cpu.tick()
+        assert cpu.pc == vector
+        assert cpu.pop_stack() == 0x0101 + n
+    assert cpu.mmu.get(0xFF0F) == 0x00
+
+def test_EI_delay():
+    # EI takes effect after the next instruction
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xFB # EI
+    rom_file[0x0101] = 0x04 # INC B
+    cpu = CPU(MMU(rom_file))
+    cpu.mmu.set(0xFF0F, 0x01)
+    cpu.mmu.set(0xFFFF, 0x01)
+    cpu.tick()
+    assert cpu.pc == 0x0101
+    assert cpu.interrupt_master_enable == False
     cpu.tick()
+    assert cpu.get_reg_8('B') == 0x01
     assert cpu.pc == 0x0040
-    assert cpu.pop_stack() == 0x0101
+    assert cpu.pop_stack() == 0x0102
+
+    # EI; DI never lets an interrupt in
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xFB # EI
+    rom_file[0x0101] = 0xF3 # DI
+    cpu = CPU(MMU(rom_file))
+    cpu.mmu.set(0xFF0F, 0x01)
+    cpu.mmu.set(0xFFFF, 0x01)
+    for i in range(3):
+        cpu.tick()
+    assert cpu.pc == 0x0103
+    assert cpu.interrupt_master_enable == False
 
-    cpu.pc = 0x101
+    # RETI enables straight away
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xD9 # RETI
+    cpu = CPU(MMU(rom_file))
+    cpu.push_stack(0x1234)
+    cpu.mmu.set(0xFF0F, 0x04)
+    cpu.mmu.set(0xFFFF, 0x04)
     cpu.tick()
-    assert cpu.pc == 0x0048
+    assert cpu.pc == 0x0050
+    assert cpu.pop_stack() == 0x1234
+
+def test_lazy_flags():
+    # Every ALU op must leave F exactly as the eager helpers do
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    eager = CPU(MMU(rom_file))
+    lazy = CPU(MMU(rom_file), lazy_flags=True)
+
+    for val1 in range(0, 0x100, 0x0F):
+        for val2 in range(0, 0x100, 0x0D):
+            for carry in (False, True):
+                for cpu in (eager, lazy):
+                    cpu.set_reg_8('F', 0x00)
+                    cpu.add_8(val1, val2, carry)
+                assert lazy.get_reg_8('F') == eager.get_reg_8('F')
+
+                for cpu in (eager, lazy):
+                    cpu.set_reg_8('F', 0x00)
+                    cpu.sub_8(val1, val2, carry)
+                assert lazy.get_reg_8('F') == eager.get_reg_8('F')
+
+                for cpu in (eager, lazy):
+                    cpu.set_reg_8('F', 0x00)
+                    cpu.add_16(val1 << 8, val2 << 4, carry)
+                assert lazy.get_reg_8('F') == eager.get_reg_8('F')
+
+                for cpu in (eager, lazy):
+                    cpu.set_reg_8('F', 0x00)
+                    cpu.sub_16(val1 << 8, val2 << 4, carry)
+                assert lazy.get_reg_8('F') == eager.get_reg_8('F')
+
+def test_lazy_flags_PUSH_AF():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0x3E # LD A, 0xFF
+    rom_file[0x0101] = 0xFF
+    rom_file[0x0102] = 0xC6 # ADD A, 0x01
+    rom_file[0x0103] = 0x01
+    rom_file[0x0104] = 0xF5 # PUSH AF
+    cpu = CPU(MMU(rom_file), lazy_flags=True)
+
+    for i in range(3):
+        cpu.tick()
+
+    assert cpu.pop_stack() == 0x00B0
+
+def test_cycles():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0x00 # NOP
+    rom_file[0x0101] = 0xCB # BIT 0, (HL)
+    rom_file[0x0102] = 0x46
+    rom_file[0x0103] = 0xCB # SET 0, (HL)
+    rom_file[0x0104] = 0xC6
+    rom_file[0x0105] = 0xC2 # JP NZ, 0x0200
+    rom_file[0x0106] = 0x00
+    rom_file[0x0107] = 0x02
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_16('HL', 0xC000)
+
+    cpu.tick()
+    assert cpu.cycles == 4
+    cpu.tick()
+    assert cpu.cycles == 16
+    cpu.tick()
+    assert cpu.cycles == 32
+
+    # Taken
+    cpu.set_flag('Z', 0)
+    cpu.tick()
+    assert cpu.pc == 0x0200
+    assert cpu.cycles == 48
+
+    # Not taken
+    cpu.pc = 0x0105
+    cpu.set_flag('Z', 1)
+    cpu.tick()
+    assert cpu.pc == 0x0108
+    assert cpu.cycles == 60
+
+def test_run_cycles():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xC3 # JP 0x0100
+    rom_file[0x0101] = 0x00
+    rom_file[0x0102] = 0x01
+    cpu = CPU(MMU(rom_file))
+
+    assert cpu.run_cycles(100) == 112
+    assert cpu.cycles == 112
+
+    cpu.run_frame()
+    assert cpu.cycles == 70224
+    cpu.run_frame()
+    assert cpu.cycles == 70224 * 2
+
+def test_HALT():
+    # Woken by V-Blank with interrupts enabled
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0xFB # EI
+    rom_file[0x0101] = 0x76 # HALT
+    cpu = CPU(MMU(rom_file))
+    LCD(cpu.mmu, cpu.scheduler)
+    cpu.mmu.set(0xFFFF, 0x01)
+
+    cpu.run_cycles(65000)
+    assert cpu.halted
+    assert cpu.pc == 0x0101
+
+    cpu.run_cycles(1000)
+    assert not cpu.halted
+    assert cpu.interrupt_master_enable == False
     assert cpu.pop_stack() == 0x0102
 
-    cpu.pc = 0x102
+    # Woken without interrupts enabled, carries on after HALT
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0x76 # HALT
+    cpu = CPU(MMU(rom_file))
+    LCD(cpu.mmu, cpu.scheduler)
+    cpu.mmu.set(0xFFFF, 0x01)
+
+    cpu.run_cycles(66000)
+    assert not cpu.halted
+    assert cpu.pc > 0x0101
+    assert cpu.sp == 0xFFFE
+
+def test_HALT_fast_forward():
+    # Nothing scheduled, HALT sleeps through the whole run
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100] = 0x76 # HALT
+    cpu = CPU(MMU(rom_file))
+    calls = []
+    cpu.opcodes[0x76] = lambda: calls.append(cpu.HALT())
+
+    assert cpu.run_cycles(70224) == 70224
+    assert cpu.pc == 0x0100
+    assert len(calls) == 1
+
+def test_decode_cache():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100:0x0103] = [0x3E, 0x42, 0x00] # LD A, 0x42; NOP
+    rom_file[0x4000:0x4002] = [0x3E, 0x24]       # LD A, 0x24
+    cpu = CPU(MMU(rom_file))
+
     cpu.tick()
-    assert cpu.pc == 0x0050
-    assert cpu.pop_stack() == 0x0103
+    handler, operand, length, clocks = cpu.fixed_cache[0x0100]
+    assert (operand, length, clocks) == (0x42, 2, 8)
+    assert cpu.get_reg_8('A') == 0x42
 
-    cpu.pc = 0x103
+    # Each ROM bank keeps its own entries
+    cpu.pc = 0x4000
     cpu.tick()
-    assert cpu.pc == 0x0058
-    assert cpu.pop_stack() == 0x0104
+    bank = cpu.bank_cache
+    assert 0x4000 in bank
+    cpu.mmu.select_rom_bank(2)
+    assert cpu.bank_cache == {}
+    cpu.mmu.select_rom_bank(1)
+    assert cpu.bank_cache is bank
 
-    cpu.pc = 0x104
+    # RAM isn't cached
+    cpu.mmu.set(0xC000, 0x00)
+    cpu.pc = 0xC000
     cpu.tick()
-    assert cpu.pc == 0x0060
-    assert cpu.pop_stack() == 0x0105
+    assert 0xC000 not in cpu.bank_cache
+
+def test_save_state():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100:0x0105] = [0x3C, 0x22, 0xC3, 0x00, 0x01] # INC A; LD (HL+), A; JP 0x0100
+    cpu = CPU(MMU(rom_file))
+    LCD(cpu.mmu, cpu.scheduler)
+    cpu.set_reg_16('HL', 0xC000)
+
+    cpu.run_cycles(1000)
+    saved = cpu.save_state()
+    cpu.run_cycles(5000)
+    after = cpu.save_state()
+
+    cpu.load_state(saved)
+    assert cpu.save_state()['memory']['WORK_RAM'].tobytes() == saved['memory']['WORK_RAM'].tobytes()
+    cpu.run_cycles(5000)
+    state = cpu.save_state()
+    assert state['regs'] == after['regs']
+    assert (state['pc'], state['cycles']) == (after['pc'], after['cycles'])
+    assert state['memory']['WORK_RAM'].tobytes() == after['memory']['WORK_RAM'].tobytes()
+    assert state['memory']['HW_REGS_TEMP'].tobytes() == after['memory']['HW_REGS_TEMP'].tobytes()
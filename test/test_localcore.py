@@ -0,0 +1,92 @@
+import random
+import numpy as np
+from mmu import MMU
+from cpu import CPU
+from lcd import LCD
+from localcore import LocalCore
+
+def make_cpu(rom_file, seed, **options):
+    rng = random.Random(seed)
+    cpu = CPU(MMU(rom_file), **options)
+    cpu.regs[:] = rng.randbytes(8)
+    cpu.regs[6] &= 0xF0
+    cpu.set_reg_16('BC', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('DE', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('HL', 0xC000 + rng.randrange(0x1FFF))
+    cpu.sp = 0xC100 + rng.randrange(0x1E00)
+    cpu.mmu.WORK_RAM[:] = np.frombuffer(rng.randbytes(0x2000), dtype=np.uint8)
+    return cpu
+
+def state(cpu):
+    cpu.sync_flags()
+    return (
+        bytes(cpu.regs), cpu.sp, cpu.pc, cpu.cycles, cpu.halted,
+        cpu.mmu.WORK_RAM.tobytes(), cpu.mmu.HIGH_RAM.tobytes(), cpu.mmu.HW_REGS_TEMP.tobytes(),
+        cpu.interrupts.flags, cpu.interrupts.enable, cpu.interrupts.ime
+    )
+
+def test_opcodes():
+    # Every opcode, and every CB opcode, must match CPU.tick
+    skip = [0x10, 0xD3, 0xDB, 0xDD, 0xE3, 0xE4, 0xEB, 0xEC, 0xED, 0xF4, 0xFC, 0xFD]
+    for options in ({}, {'lazy_flags': True}):
+        for op in range(0x100):
+            if (op in skip):
+                continue
+            for seed in range(4):
+                rom_file = np.zeros(0x8000, dtype=np.uint8)
+                rom_file[0x0100] = op
+                rom_file[0x0101] = (seed * 53 + op) & 0xFF
+                rom_file[0x0102] = 0xC0 | seed
+
+                cpu = make_cpu(rom_file, seed, **options)
+                cpu.tick()
+
+                local = make_cpu(rom_file, seed, **options)
+                LocalCore(local).step()
+
+                assert state(local) == state(cpu), hex(op)
+
+def test_interrupts():
+    # Counts V-Blanks in B from a HALT loop, with EI and RETI around it
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0040:0x0042] = [0x04, 0xD9] # INC B; RETI
+    rom_file[0x0100:0x010A] = [
+        0x3E, 0x01,       # LD A, 0x01
+        0xE0, 0xFF,       # LDH (0xFF), A
+        0xFB,             # EI
+        0x76,             # HALT <-
+        0x0C,             # INC C
+        0xC3, 0x05, 0x01  # JP 0x0105
+    ]
+
+    cpus = []
+    for run_frame in (lambda cpu: cpu.run_frame, lambda cpu: LocalCore(cpu).run_frame):
+        cpu = CPU(MMU(rom_file))
+        LCD(cpu.mmu, cpu.scheduler)
+        frame = run_frame(cpu)
+        for i in range(3):
+            frame()
+        cpus.append(cpu)
+
+    assert cpus[0].get_reg_8('B') == 3
+    assert state(cpus[1]) == state(cpus[0])
+
+def test_run_cycles():
+    # A copy loop run in short slices matches CPU.run_cycles
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100:0x010E] = [
+        0x21, 0x00, 0xC0, # LD HL, 0xC000
+        0x11, 0x00, 0xD0, # LD DE, 0xD000
+        0x1A,             # LD A, (DE) <-
+        0x22,             # LD (HL+), A
+        0x13,             # INC DE
+        0xCB, 0x6C,       # BIT 5, H
+        0x28, 0xF9,       # JR Z, 0x0106
+        0x76
+    ]
+    cpu = make_cpu(rom_file, 1)
+    local = make_cpu(rom_file, 1)
+    core = LocalCore(local)
+    for i in range(20):
+        assert core.run_cycles(1000) == cpu.run_cycles(1000)
+        assert state(local) == state(cpu)
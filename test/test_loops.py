@@ -0,0 +1,263 @@
+import numpy as np
+from mmu import MMU
+from cpu import CPU
+from lcd import LCD
+from loops import IdleLoopDetector, CountedLoopCollapser, CopyLoopCollapser
+
+def make_cpu(code, attach):
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100:0x0100 + len(code)] = code
+    cpu = CPU(MMU(rom_file))
+    LCD(cpu.mmu, cpu.scheduler)
+    detector = attach(cpu) if attach else None
+
+    # Notes when events actually run, which skipping must not change
+    cpu.seen = []
+    def probe(time):
+        cpu.seen.append((time, cpu.cycles, cpu.pc))
+        cpu.scheduler.schedule(time + 1000, probe)
+    cpu.scheduler.schedule(1000, probe)
+
+    return cpu, detector
+
+def state(cpu):
+    return (bytes(cpu.regs), cpu.sp, cpu.pc, cpu.cycles, int(cpu.mmu.get(0xFF44)), cpu.seen)
+
+def test_LY_poll_loop():
+    code = [
+        0xF0, 0x44, # LDH A, (0x44)
+        0xFE, 0x90, # CP 0x90
+        0x20, 0xFA, # JR NZ, -6
+        0x04,       # INC B
+        0xF0, 0x44, # LDH A, (0x44)
+        0xFE, 0x90, # CP 0x90
+        0x28, 0xFA, # JR Z, -6
+        0xC3, 0x00, 0x01 # JP 0x0100
+    ]
+
+    stepped, _ = make_cpu(code, None)
+    skipped, detector = make_cpu(code, IdleLoopDetector)
+
+    for i in range(3):
+        stepped.run_frame()
+        skipped.run_frame()
+        assert state(skipped) == state(stepped)
+
+    assert stepped.regs[0] == 3
+    stats = detector.stats()
+    assert stats['idle'] == 2
+    assert stats['skipped_clocks'] > 70224 * 2
+
+def test_ram_flag_loop():
+    # Waits on a flag in work RAM that nothing sets
+    code = [
+        0x21, 0x00, 0xC0, # LD HL, 0xC000
+        0x7E,             # LD A, (HL)
+        0xB7,             # OR A
+        0x28, 0xFC        # JR Z, -4
+    ]
+
+    stepped, _ = make_cpu(code, None)
+    skipped, detector = make_cpu(code, IdleLoopDetector)
+
+    stepped.run_cycles(10000)
+    skipped.run_cycles(10000)
+    assert state(skipped) == state(stepped)
+    assert detector.stats()['skipped_clocks'] > 0
+
+def test_busy_loop_not_idle():
+    # Counts B down, registers change every trip round
+    code = [
+        0x06, 0x00, # LD B, 0
+        0x05,       # DEC B
+        0x20, 0xFD, # JR NZ, -3
+        0x18, 0xF9  # JR -7
+    ]
+
+    stepped, _ = make_cpu(code, None)
+    skipped, detector = make_cpu(code, IdleLoopDetector)
+
+    stepped.run_cycles(20000)
+    skipped.run_cycles(20000)
+    assert state(skipped) == state(stepped)
+    assert detector.skipped == {}
+
+def test_unsafe_loop_rejected():
+    # Writes memory inside the loop
+    code = [
+        0x21, 0x00, 0xC0, # LD HL, 0xC000
+        0x77,             # LD (HL), A
+        0x18, 0xFD        # JR -3
+    ]
+
+    cpu, detector = make_cpu(code, IdleLoopDetector)
+    cpu.run_cycles(1000)
+    assert detector.loops == {0x0104: None}
+    assert detector.stats()['rejected'] == 1
+
+def test_counted_loops():
+    code = [
+        0x06, 0x00,       # LD B, 0
+        0x05,             # DEC B
+        0x20, 0xFD,       # JR NZ, -3
+        0x01, 0x34, 0x12, # LD BC, 0x1234
+        0x0B,             # DEC BC
+        0x78,             # LD A, B
+        0xB1,             # OR C
+        0x20, 0xFB,       # JR NZ, -5
+        0x11, 0x00, 0x03, # LD DE, 0x0300
+        0x1B,             # DEC DE
+        0x7B,             # LD A, E
+        0xB2,             # OR D
+        0xC2, 0x10, 0x01, # JP NZ, 0x0110
+        0x1E, 0x20,       # LD E, 0x20
+        0x1D,             # DEC E
+        0xC2, 0x18, 0x01, # JP NZ, 0x0118
+        0x3C,             # INC A
+        0xC3, 0x00, 0x01  # JP 0x0100
+    ]
+
+    stepped, _ = make_cpu(code, None)
+    collapsed, collapser = make_cpu(code, CountedLoopCollapser)
+
+    for i in range(3):
+        stepped.run_frame()
+        collapsed.run_frame()
+        assert state(collapsed) == state(stepped)
+
+    assert collapser.loops[0x0103] is not None
+    assert collapser.loops[0x010B] is not None
+    assert collapser.loops[0x0113] is not None
+    assert collapser.loops[0x0119] is not None
+    assert sum(collapser.collapsed.values()) > 0x1234
+
+    # Stopping part way through a loop
+    stepped.run_cycles(12345)
+    collapsed.run_cycles(12345)
+    assert state(collapsed) == state(stepped)
+
+def test_not_counted_loop():
+    code = [
+        0x06, 0x10, # LD B, 0x10
+        0x05,       # DEC B
+        0x05,       # DEC B
+        0x20, 0xFC, # JR NZ, -4
+        0x18, 0xF8  # JR -8
+    ]
+
+    stepped, _ = make_cpu(code, None)
+    collapsed, collapser = make_cpu(code, CountedLoopCollapser)
+    stepped.run_cycles(5000)
+    collapsed.run_cycles(5000)
+    assert state(collapsed) == state(stepped)
+    assert collapser.loops[0x0104] is None
+    assert collapser.collapsed == {}
+
+def memory(cpu):
+    mmu = cpu.mmu
+    return (mmu.CHAR_RAM.tobytes(), mmu.WORK_RAM.tobytes(), mmu.HIGH_RAM.tobytes(), mmu.OAM.tobytes())
+
+def test_copy_loops():
+    code = [
+        0x21, 0x00, 0x80, # LD HL, 0x8000
+        0x11, 0x00, 0x00, # LD DE, 0x0000
+        0x01, 0x00, 0x18, # LD BC, 0x1800
+        0x1A,             # LD A, (DE)
+        0x22,             # LD (HL+), A
+        0x13,             # INC DE
+        0x0B,             # DEC BC
+        0x78,             # LD A, B
+        0xB1,             # OR C
+        0x20, 0xF8,       # JR NZ, -8
+        0x21, 0xFF, 0xDF, # LD HL, 0xDFFF
+        0x3E, 0x5A,       # LD A, 0x5A
+        0x06, 0x00,       # LD B, 0
+        0x32,             # LD (HL-), A
+        0x05,             # DEC B
+        0x20, 0xFC,       # JR NZ, -4
+        0x21, 0x00, 0xDF, # LD HL, 0xDF00
+        0x11, 0x80, 0xFF, # LD DE, 0xFF80
+        0x0E, 0x7F,       # LD C, 0x7F
+        0x2A,             # LD A, (HL+)
+        0x12,             # LD (DE), A
+        0x13,             # INC DE
+        0x0D,             # DEC C
+        0xC2, 0x24, 0x01, # JP NZ, 0x0124
+        0x21, 0x9F, 0xFE, # LD HL, 0xFE9F
+        0x11, 0x7F, 0x80, # LD DE, 0x807F
+        0x0E, 0xA0,       # LD C, 0xA0
+        0x1A,             # LD A, (DE)
+        0x1B,             # DEC DE
+        0x32,             # LD (HL-), A
+        0x0D,             # DEC C
+        0x20, 0xFA,       # JR NZ, -6
+        0x3C,             # INC A
+        0x18, 0xFE        # JR -2
+    ]
+    data = np.random.default_rng(5).integers(0, 0x100, 0x7E00, dtype=np.uint8)
+
+    stepped, _ = make_cpu(code, None)
+    copied, collapser = make_cpu(code, CopyLoopCollapser)
+    for cpu in (stepped, copied):
+        cpu.mmu.ROM[0x0200:0x8000] = data
+
+    for cycles in (5000, 30000, 70000, 400000):
+        stepped.run_cycles(cycles)
+        copied.run_cycles(cycles)
+        assert state(copied) == state(stepped)
+        assert memory(copied) == memory(stepped)
+
+    assert stepped.pc == 0x013A
+    assert set(branch for branch, loop in collapser.loops.items() if loop is not None) == {
+        0x010F, 0x011A, 0x0128, 0x0137
+    }
+    assert sum(collapser.copied.values()) > 0x1000
+
+def test_copy_loop_code_listener():
+    # Fill of a page holding code reaches the listeners once
+    code = [
+        0x21, 0x00, 0xC0, # LD HL, 0xC000
+        0x06, 0x00,       # LD B, 0
+        0x22,             # LD (HL+), A
+        0x05,             # DEC B
+        0x20, 0xFC,       # JR NZ, -4
+        0x18, 0xFE        # JR -2
+    ]
+
+    cpu, collapser = make_cpu(code, CopyLoopCollapser)
+    written = []
+    def listener(start, end):
+        written.append((start, end))
+        return True
+    cpu.mmu.add_code_listener(listener)
+    cpu.mmu.mark_code(0xC0)
+
+    cpu.run_cycles(10000)
+    # One call per range, in order and covering the fill exactly
+    assert written[0] == (0xC000, 0xC001)
+    assert written[-1] == (0xC0FF, 0xC100)
+    assert all(a[1] == b[0] for a, b in zip(written, written[1:]))
+    assert max(end - start for start, end in written) > 1
+    assert len(written) < 0x80
+
+def test_overlapping_copy():
+    code = [
+        0x21, 0x01, 0xC0, # LD HL, 0xC001
+        0x11, 0x00, 0xC0, # LD DE, 0xC000
+        0x06, 0x40,       # LD B, 0x40
+        0x1A,             # LD A, (DE)
+        0x22,             # LD (HL+), A
+        0x13,             # INC DE
+        0x05,             # DEC B
+        0x20, 0xFA,       # JR NZ, -6
+        0x18, 0xFE        # JR -2
+    ]
+
+    stepped, _ = make_cpu(code, None)
+    copied, collapser = make_cpu(code, CopyLoopCollapser)
+    for cpu in (stepped, copied):
+        cpu.mmu.WORK_RAM[0] = 0x77
+        cpu.run_cycles(5000)
+
+    assert memory(copied) == memory(stepped)
+    assert copied.mmu.WORK_RAM[0x40] == 0x77
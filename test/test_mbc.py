@@ -0,0 +1,228 @@
+import numpy as np
+from mmu import MMU
+from cpu import CPU
+from localcore import LocalCore
+from numbacore import NumbaCore
+from recompiler import Recompiler
+from cycles import SECOND_CLOCKS
+from mbc import MBC1, MBC3, MBC5, MBC5Rumble, NoMBC
+
+def make_rom(banks, cartridge_type, ram_size = 0x00):
+    # Each bank starts with its own number, low byte first
+    rom_file = np.zeros(banks * 0x4000, dtype=np.uint8)
+    for bank in range(banks):
+        rom_file[bank * 0x4000] = bank & 0xFF
+        rom_file[bank * 0x4000 + 1] = bank >> 8
+    rom_file[0x0147] = cartridge_type
+    rom_file[0x0149] = ram_size
+    return rom_file
+
+def test_header():
+    assert isinstance(MMU(make_rom(2, 0x00)).mbc, NoMBC)
+    assert isinstance(MMU(make_rom(2, 0x03)).mbc, MBC1)
+    assert isinstance(MMU(make_rom(2, 0x10)).mbc, MBC3)
+    assert isinstance(MMU(make_rom(2, 0x1B)).mbc, MBC5)
+    assert isinstance(MMU(make_rom(2, 0x1E)).mbc, MBC5Rumble)
+    # Not supported, runs as a plain 32K cartridge
+    assert isinstance(MMU(make_rom(2, 0xFC)).mbc, NoMBC)
+
+def test_mbc1_rom_banks():
+    rom_file = make_rom(64, 0x01)
+    mmu = MMU(rom_file)
+    assert (mmu.get(0x0000), mmu.get(0x4000)) == (0, 1)
+
+    mmu.set(0x2000, 0x05)
+    assert mmu.get(0x4000) == 5
+    # Windows onto the ROM, nothing copied
+    assert mmu.ROM_BANK.obj is rom_file
+
+    # Bank 0 selects bank 1
+    mmu.set(0x2000, 0x00)
+    assert mmu.get(0x4000) == 1
+
+    # Upper bits, and in mode 1 the bank at 0x0000 too
+    mmu.set(0x2000, 0x02)
+    mmu.set(0x4000, 0x01)
+    assert (mmu.get(0x0000), mmu.get(0x4000)) == (0, 0x22)
+    mmu.set(0x6000, 0x01)
+    assert (mmu.get(0x0000), mmu.get(0x4000)) == (0x20, 0x22)
+    assert (mmu.rom_bank_0, mmu.rom_bank) == (0x20, 0x22)
+
+    # Banks past the end of the ROM wrap
+    small = MMU(make_rom(4, 0x01))
+    small.set(0x2000, 0x06)
+    assert small.get(0x4000) == 2
+
+def test_mbc1_ram_banks():
+    mmu = MMU(make_rom(4, 0x03, 0x03))
+    assert len(mmu.CART_RAM) == 0x8000
+
+    # Disabled at power on
+    mmu.set(0xA000, 0x12)
+    assert mmu.get(0xA000) == 0xFF
+    assert mmu.span(0xA000) is None
+
+    mmu.set(0x0000, 0x0A)
+    mmu.set(0xA000, 0x12)
+    assert mmu.get(0xA000) == 0x12
+
+    # RAM banks only switch in mode 1
+    mmu.set(0x4000, 0x02)
+    assert mmu.get(0xA000) == 0x12
+    mmu.set(0x6000, 0x01)
+    assert mmu.get(0xA000) == 0x00
+    mmu.write16(0xA010, 0x3456)
+    assert mmu.CART_RAM[0x4010] == 0x56
+
+    mmu.set(0x4000, 0x00)
+    assert mmu.get(0xA000) == 0x12
+
+    mmu.set(0x0000, 0x00)
+    assert mmu.get(0xA000) == 0xFF
+
+def test_mbc3_banks():
+    mmu = MMU(make_rom(128, 0x13, 0x03))
+    mmu.set(0x2000, 0x7F)
+    assert mmu.get(0x4000) == 0x7F
+    mmu.set(0x2000, 0x00)
+    assert mmu.get(0x4000) == 1
+
+    mmu.set(0x0000, 0x0A)
+    mmu.set(0x4000, 0x03)
+    mmu.set(0xA000, 0x44)
+    assert mmu.CART_RAM[0x6000] == 0x44
+    mmu.set(0x4000, 0x00)
+    assert mmu.get(0xA000) == 0x00
+
+def test_mbc3_clock():
+    cpu = CPU(MMU(make_rom(4, 0x10, 0x03)))
+    mmu = cpu.mmu
+    mmu.set(0x0000, 0x0A)
+
+    def latch():
+        mmu.set(0x6000, 0x00)
+        mmu.set(0x6000, 0x01)
+
+    def registers():
+        values = []
+        for register in range(0x08, 0x0D):
+            mmu.set(0x4000, register)
+            values.append(mmu.get(0xA000))
+        return values
+
+    # Nothing ticks, the registers are worked out from the clock count
+    # when latched
+    cpu.cycles = (2 * 86400 + 3 * 3600 + 4 * 60 + 5) * SECOND_CLOCKS
+    assert registers() == [0, 0, 0, 0, 0]
+    latch()
+    assert registers() == [5, 4, 3, 2, 0]
+
+    # Held until the next latch
+    cpu.cycles += 10 * SECOND_CLOCKS
+    assert registers() == [5, 4, 3, 2, 0]
+    latch()
+    assert registers()[0] == 15
+
+    # Setting a register sets the running clock, halt stops it
+    mmu.set(0x4000, 0x0C)
+    mmu.set(0xA000, 0x40)
+    mmu.set(0x4000, 0x08)
+    mmu.set(0xA000, 0x00)
+    cpu.cycles += 100 * SECOND_CLOCKS
+    latch()
+    assert registers() == [0, 4, 3, 2, 0x40]
+    mmu.set(0x4000, 0x0C)
+    mmu.set(0xA000, 0x00)
+    cpu.cycles += 61 * SECOND_CLOCKS
+    latch()
+    assert registers() == [1, 5, 3, 2, 0]
+
+    # Day 511 rolls over into the carry bit
+    mmu.set(0x4000, 0x0B)
+    mmu.set(0xA000, 0xFF)
+    mmu.set(0x4000, 0x0C)
+    mmu.set(0xA000, 0x01)
+    cpu.cycles += 86400 * SECOND_CLOCKS
+    latch()
+    assert registers()[3:] == [0x00, 0x80]
+
+    # Back to RAM
+    mmu.set(0x4000, 0x00)
+    mmu.set(0xA000, 0x12)
+    assert mmu.CART_RAM[0] == 0x12
+
+def test_mbc5_banks():
+    # 8M of ROM, bank 0x100 and up need the ninth bit
+    mmu = MMU(make_rom(512, 0x1B, 0x04))
+    assert mmu.rom_banks == 512 and mmu.ram_banks == 16
+    mmu.set(0x2000, 0x34)
+    mmu.set(0x3000, 0x01)
+    assert mmu.read16(0x4000) == 0x134
+    mmu.set(0x2000, 0xFF)
+    assert mmu.rom_bank == 0x1FF
+
+    # Bank 0 can be mapped at 0x4000 too
+    mmu.set(0x3000, 0x00)
+    mmu.set(0x2000, 0x00)
+    assert mmu.rom_bank == 0
+
+    mmu.set(0x0000, 0x0A)
+    mmu.set(0x4000, 0x0F)
+    mmu.set(0xBFFF, 0x99)
+    assert mmu.CART_RAM[0x1FFFF] == 0x99
+
+    # On rumble cartridges bit 3 is the motor
+    rumble = MMU(make_rom(4, 0x1D, 0x04))
+    rumble.set(0x4000, 0x0B)
+    assert rumble.ram_bank == 3
+
+def test_save_state():
+    mmu = MMU(make_rom(8, 0x03, 0x03))
+    mmu.set(0x0000, 0x0A)
+    mmu.set(0x2000, 0x03)
+    mmu.set(0xA000, 0x77)
+    saved = mmu.save_state()
+
+    mmu.set(0x2000, 0x05)
+    mmu.set(0xA000, 0x00)
+    mmu.set(0x0000, 0x00)
+    mmu.load_state(saved)
+    assert (mmu.get(0x4000), mmu.get(0xA000)) == (3, 0x77)
+
+    # MBC3 keeps its clock
+    cpu = CPU(MMU(make_rom(4, 0x10, 0x03)))
+    cpu.mmu.set(0x0000, 0x0A)
+    cpu.mmu.set(0x4000, 0x08)
+    cpu.cycles = 30 * SECOND_CLOCKS
+    saved = cpu.mmu.save_state()
+    cpu.mmu.set(0xA000, 0x10)
+    cpu.mmu.load_state(saved)
+    cpu.mmu.set(0x6000, 0x00)
+    cpu.mmu.set(0x6000, 0x01)
+    assert cpu.mmu.get(0xA000) == 30
+
+def test_cores_follow_banks():
+    # The same address called in two banks, each core must see the bank
+    # mapped at the time and not what it cached earlier
+    rom_file = make_rom(4, 0x01)
+    rom_file[0x8000:0x8002] = [0x04, 0xC9] # Bank 2: INC B; RET
+    rom_file[0xC000:0xC002] = [0x0C, 0xC9] # Bank 3: INC C; RET
+    rom_file[0x0100:0x011A] = [
+        0x3E, 0x02,       # LD A, 0x02
+        0xEA, 0x00, 0x20, # LD (0x2000), A
+        0xCD, 0x00, 0x40, # CALL 0x4000
+        0x3E, 0x03,       # LD A, 0x03
+        0xEA, 0x00, 0x20, # LD (0x2000), A
+        0xCD, 0x00, 0x40, # CALL 0x4000
+        0x3E, 0x02,       # LD A, 0x02
+        0xEA, 0x00, 0x20, # LD (0x2000), A
+        0xCD, 0x00, 0x40, # CALL 0x4000
+        0x18, 0xFE        # JR -2
+    ]
+
+    for make_core in (lambda cpu: cpu, LocalCore, Recompiler, lambda cpu: NumbaCore(cpu, jit=False)):
+        cpu = CPU(MMU(rom_file))
+        cpu.set_reg_16('BC', 0x0000)
+        make_core(cpu).run_cycles(1000)
+        assert cpu.pc == 0x0118
+        assert (cpu.get_reg_8('B'), cpu.get_reg_8('C')) == (2, 1)
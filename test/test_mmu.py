@@ -123,3 +123,126 @@ def test_interrupt_register():
 
     mmu.set(0xFFFF, 0xA0)
     assert mmu.get(0xFFFF) == 0xA0
+
+def test_interrupt_mask():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    mmu = MMU(rom_file)
+    interrupts = mmu.interrupts
+
+    mmu.set(0xFF0F, 0x05)
+    assert interrupts.pending == 0
+    mmu.set(0xFFFF, 0x0C)
+    assert interrupts.pending == 0x04
+    assert interrupts.ready == 0
+
+    interrupts.set_ime(True)
+    assert interrupts.ready == 0x04
+    assert interrupts.dispatch() == 0x0050
+    assert mmu.get(0xFF0F) == 0x01
+    assert interrupts.ready == 0
+
+    interrupts.request(0x08)
+    assert mmu.get(0xFF0F) == 0x09
+    assert interrupts.pending == 0x08
+
+def test_code_pages():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    mmu = MMU(rom_file)
+    written = []
+
+    def listener(start, end):
+        written.append((start, end))
+        return start != 0xC0FF
+
+    mmu.add_code_listener(listener)
+    mmu.mark_code(0xC0)
+
+    # Pages without code don't reach the listener
+    mmu.set(0xC100, 0x01)
+    assert written == []
+
+    mmu.set(0xC010, 0x01)
+    assert written == [(0xC010, 0xC011)]
+    assert mmu.code_pages[0xC0] == 1
+
+    # Listener no longer has code in the page
+    mmu.set(0xC0FF, 0x01)
+    assert mmu.code_pages[0xC0] == 0
+    mmu.set(0xC010, 0x01)
+    assert written == [(0xC010, 0xC011), (0xC0FF, 0xC100)]
+
+    # Block writes reach the listener once
+    mmu.mark_code(0xC1)
+    mmu.code_written(0xC0F0, 0xC110)
+    assert written[-1] == (0xC0F0, 0xC110)
+    assert mmu.code_pages[0xC1] == 1
+
+def test_span():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    mmu = MMU(rom_file)
+
+    array, offset, size = mmu.span(0xC123, True)
+    assert array is mmu.WORK_RAM
+    assert (offset, size) == (0x123, 0x2000)
+    assert mmu.span(0xFE10)[2] == 0xA0
+    assert mmu.span(0x1234)[0].obj is rom_file
+    assert mmu.span(0x1234, True) is None
+    assert mmu.span(0xFF44) is None
+
+def test_words():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0150:0x0152] = [0x34, 0x12]
+    mmu = MMU(rom_file)
+    assert mmu.read16(0x0150) == 0x1234
+
+    mmu.write16(0xC010, 0xBEEF)
+    assert (mmu.get(0xC010), mmu.get(0xC011)) == (0xEF, 0xBE)
+    assert mmu.read16(0xC010) == 0xBEEF
+
+    # Straddling two regions, and IO
+    mmu.write16(0x97FF, 0x1234)
+    assert (mmu.CHAR_RAM[0x17FF], mmu.BG_MAP_1[0x000]) == (0x34, 0x12)
+    assert mmu.read16(0x97FF) == 0x1234
+    mmu.write16(0xFF7F, 0x5678)
+    assert (mmu.HW_REGS_TEMP[0x7F], mmu.HIGH_RAM[0x00]) == (0x78, 0x56)
+    assert mmu.read16(0xFF7F) == 0x5678
+    mmu.write16(0xFFFE, 0x0F01)
+    assert mmu.read16(0xFFFE) == 0x0F01
+    assert mmu.interrupts.enable == 0x0F
+
+    with pytest.raises(NotImplementedError):
+        mmu.write16(0x1000, 0)
+
+    # Words in a page holding code reach the listeners once, a word
+    # straddling pages a byte at a time
+    written = []
+    mmu.add_code_listener(lambda start, end: written.append((start, end)) or True)
+    mmu.mark_code(0xC0)
+    mmu.write16(0xC010, 0x0000)
+    assert written == [(0xC010, 0xC012)]
+    mmu.write16(0xC0FF, 0x0000)
+    assert written[1:] == [(0xC0FF, 0xC100)]
+
+def test_flat_memory():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    mmu = MMU(rom_file)
+
+    # Regions are views of the one address space
+    mmu.set(0xC010, 0x12)
+    assert mmu.WORK_RAM[0x10] == 0x12
+    mmu.HIGH_RAM[0x05] = 0x34
+    assert mmu.memory[0xFF85] == 0x34
+    assert mmu.get(0xFF85) == 0x34
+
+    # IF and IE read back from memory
+    mmu.set(0xFFFF, 0x05)
+    mmu.interrupts.request(0x04)
+    assert (mmu.get(0xFF0F), mmu.get(0xFFFF)) == (0x04, 0x05)
+
+def test_plain_ints():
+    # Reads give Python ints whatever buffer the ROM came in
+    for rom_file in (np.zeros(0x8000, dtype=np.uint8), bytes(0x8000)):
+        mmu = MMU(rom_file)
+        for addr in (0x0150, 0x4150, 0xC000, 0xFF44, 0xFF85, 0xFFFF):
+            assert type(mmu.get(addr)) is int, hex(addr)
+        assert type(mmu.read16(0x0150)) is int
@@ -0,0 +1,95 @@
+import random
+import numpy as np
+import numbacore
+from mmu import MMU
+from cpu import CPU
+from lcd import LCD
+from numbacore import NumbaCore, numba_core
+
+def make_cpu(rom_file, seed, **options):
+    rng = random.Random(seed)
+    cpu = CPU(MMU(rom_file), **options)
+    cpu.regs[:] = rng.randbytes(8)
+    cpu.regs[6] &= 0xF0
+    cpu.set_reg_16('BC', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('DE', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('HL', 0xC000 + rng.randrange(0x1FFF))
+    cpu.sp = 0xC100 + rng.randrange(0x1E00)
+    cpu.mmu.WORK_RAM[:] = np.frombuffer(rng.randbytes(0x2000), dtype=np.uint8)
+    return cpu
+
+def state(cpu):
+    cpu.sync_flags()
+    return (
+        bytes(cpu.regs), cpu.sp, cpu.pc, cpu.cycles, cpu.halted,
+        cpu.mmu.WORK_RAM.tobytes(), cpu.mmu.HIGH_RAM.tobytes(), cpu.mmu.HW_REGS_TEMP.tobytes(),
+        cpu.interrupts.flags, cpu.interrupts.enable, cpu.interrupts.ime
+    )
+
+def test_opcodes():
+    # Every opcode, and every CB opcode, must match CPU.tick. The kernel
+    # runs as plain Python here whether or not Numba is installed.
+    skip = [0x10, 0xD3, 0xDB, 0xDD, 0xE3, 0xE4, 0xEB, 0xEC, 0xED, 0xF4, 0xFC, 0xFD]
+    for op in range(0x100):
+        if (op in skip):
+            continue
+        for seed in range(4):
+            rom_file = np.zeros(0x8000, dtype=np.uint8)
+            rom_file[0x0100] = op
+            rom_file[0x0101] = (seed * 53 + op) & 0xFF
+            rom_file[0x0102] = 0xC0 | seed
+
+            cpu = make_cpu(rom_file, seed)
+            cpu.tick()
+
+            kernel = make_cpu(rom_file, seed)
+            NumbaCore(kernel, jit=False).step()
+
+            assert state(kernel) == state(cpu), hex(op)
+
+def test_cb_opcodes():
+    # The kernel has its own CB opcodes rather than the CPU's
+    for x in range(0x100):
+        for seed in range(2):
+            rom_file = np.zeros(0x8000, dtype=np.uint8)
+            rom_file[0x0100:0x0102] = [0xCB, x]
+
+            cpu = make_cpu(rom_file, seed)
+            cpu.tick()
+
+            kernel = make_cpu(rom_file, seed)
+            NumbaCore(kernel, jit=False).step()
+
+            assert state(kernel) == state(cpu), hex(x)
+
+def test_io_writes():
+    # Writes to IO registers and IE go through MMU.set, the V-Blank
+    # interrupt they enable is taken between kernel calls
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0040:0x0042] = [0x04, 0xD9] # INC B; RETI
+    rom_file[0x0100:0x010B] = [
+        0x3E, 0x01,       # LD A, 0x01
+        0xE0, 0xFF,       # LDH (0xFF), A
+        0xE0, 0x42,       # LDH (0x42), A
+        0xFB,             # EI
+        0x0C,             # INC C <-
+        0xC3, 0x07, 0x01  # JP 0x0107
+    ]
+
+    cpus = []
+    for run_frame in (lambda cpu: cpu.run_frame, lambda cpu: NumbaCore(cpu, jit=False).run_frame):
+        cpu = CPU(MMU(rom_file))
+        LCD(cpu.mmu, cpu.scheduler)
+        frame = run_frame(cpu)
+        for i in range(2):
+            frame()
+        cpus.append(cpu)
+
+    assert cpus[0].get_reg_8('B') == 2
+    assert cpus[0].mmu.HW_REGS_TEMP[0x42] == 0x01
+    assert state(cpus[1]) == state(cpus[0])
+
+def test_fallback(monkeypatch):
+    cpu = CPU(MMU(np.zeros(0x8000, dtype=np.uint8)))
+    monkeypatch.setattr(numbacore, 'numba', None)
+    assert numba_core(cpu) is cpu
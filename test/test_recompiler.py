@@ -0,0 +1,126 @@
+import random
+import numpy as np
+from mmu import MMU
+from cpu import CPU
+from recompiler import Recompiler, translate
+
+def make_cpu(rom_file, seed):
+    rng = random.Random(seed)
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_8('A', rng.randrange(0x100))
+    cpu.set_reg_16('BC', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_16('DE', 0xC000 + rng.randrange(0x1FFF))
+    cpu.set_reg_8('F', rng.randrange(0x100))
+    cpu.set_reg_16('HL', 0xC000 + rng.randrange(0x1FFF))
+    cpu.sp = 0xC100 + rng.randrange(0x1E00)
+    cpu.mmu.WORK_RAM[:] = np.frombuffer(rng.randbytes(0x2000), dtype=np.uint8)
+    return cpu
+
+def state(cpu):
+    return (
+        bytes(cpu.regs), cpu.sp, cpu.pc, cpu.cycles,
+        cpu.mmu.WORK_RAM.tobytes(), cpu.mmu.HIGH_RAM.tobytes(), cpu.mmu.HW_REGS_TEMP.tobytes(),
+        cpu.mmu.interrupts.flags, cpu.mmu.interrupts.enable
+    )
+
+def test_translated_opcodes():
+    # Each translated opcode must match the interpreter
+    for op in range(0x100):
+        translated = translate(op, 0x00, 0x0000, 0x0100)
+        if (translated is None):
+            continue
+        length = translated[1]
+
+        for seed in range(8):
+            rom_file = np.zeros(0x8000, dtype=np.uint8)
+            rom_file[0x0100] = op
+            rom_file[0x0101] = (seed * 37) & 0xFF
+            rom_file[0x0102] = 0xC0 | seed
+            rom_file[0x0100 + length] = 0x76 # HALT isn't translated
+
+            cpu = make_cpu(rom_file, seed)
+            cpu.tick()
+
+            compiled = make_cpu(rom_file, seed)
+            Recompiler(compiled).step()
+
+            assert state(compiled) == state(cpu), hex(op)
+
+def test_fibonacci():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100:0x010F] = [
+        0x16, 0x0D, # LD D, 13
+        0x06, 0x00, # LD B, 0
+        0x0E, 0x01, # LD C, 1
+        0x78,       # LD A, B <-
+        0x81,       # ADD A, C
+        0x48,       # LD C, B
+        0x47,       # LD B, A
+        0x15,       # DEC D
+        0xC2, 0x06, 0x01, # JP NZ, 0x0106
+        0x76
+    ]
+    cpu = CPU(MMU(rom_file))
+    recompiler = Recompiler(cpu)
+
+    while cpu.pc != 0x010E:
+        recompiler.step()
+
+    assert cpu.get_reg_8('B') == 233
+    assert sorted(recompiler.fixed) == [0x0100, 0x0106]
+
+def test_io_write_ends_block():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0100:0x0106] = [
+        0x21, 0x0F, 0xFF, # LD HL, 0xFF0F
+        0x77,             # LD (HL), A
+        0x3C,             # INC A
+        0x76
+    ]
+    cpu = CPU(MMU(rom_file))
+    cpu.set_reg_8('A', 0x01)
+    Recompiler(cpu).step()
+
+    assert cpu.pc == 0x0104
+    assert cpu.mmu.get(0xFF0F) == 0x01
+    assert cpu.get_reg_8('A') == 0x01
+
+def test_ram_code_invalidation():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    cpu = CPU(MMU(rom_file))
+    recompiler = Recompiler(cpu)
+    for i, val in enumerate([0x3E, 0x05, 0xC3, 0x00, 0x01]): # LD A, 5; JP 0x0100
+        cpu.mmu.set(0xC000 + i, val)
+
+    cpu.pc = 0xC000
+    recompiler.step()
+    assert cpu.get_reg_8('A') == 0x05
+    assert cpu.pc == 0x0100
+    assert 0xC000 in recompiler.blocks
+
+    # Patch the operand of LD A, n
+    cpu.mmu.set(0xC001, 0x07)
+    assert 0xC000 not in recompiler.blocks
+
+    cpu.pc = 0xC000
+    recompiler.step()
+    assert cpu.get_reg_8('A') == 0x07
+
+def test_self_modifying_block():
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    cpu = CPU(MMU(rom_file))
+    recompiler = Recompiler(cpu)
+    code = [
+        0x21, 0x06, 0xC0, # LD HL, 0xC006
+        0x36, 0x09,       # LD (HL), 0x09
+        0x3E, 0x01,       # LD A, 0x01 - operand patched above
+        0xC3, 0x00, 0x01  # JP 0x0100
+    ]
+    for i, val in enumerate(code):
+        cpu.mmu.set(0xC000 + i, val)
+
+    cpu.pc = 0xC000
+    while cpu.pc != 0x0100:
+        recompiler.step()
+
+    assert cpu.get_reg_8('A') == 0x09
@@ -0,0 +1,36 @@
+from scheduler import Scheduler, NEVER
+
+def test_run_due():
+    scheduler = Scheduler()
+    fired = []
+    assert scheduler.next_time == NEVER
+
+    scheduler.schedule(200, lambda time: fired.append(('b', time)))
+    scheduler.schedule(100, lambda time: fired.append(('a', time)))
+    scheduler.schedule(200, lambda time: fired.append(('c', time)))
+    assert scheduler.next_time == 100
+
+    scheduler.run_due(99)
+    assert fired == []
+
+    scheduler.run_due(150)
+    assert fired == [('a', 100)]
+    assert scheduler.next_time == 200
+
+    # Same time runs in the order scheduled
+    scheduler.run_due(1000)
+    assert fired == [('a', 100), ('b', 200), ('c', 200)]
+    assert scheduler.next_time == NEVER
+
+def test_reschedule():
+    scheduler = Scheduler()
+    fired = []
+
+    def event(time):
+        fired.append(time)
+        scheduler.schedule(time + 10, event)
+
+    scheduler.schedule(10, event)
+    scheduler.run_due(35)
+    assert fired == [10, 20, 30]
+    assert scheduler.next_time == 40
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from mmu import MMU
+from cpu import CPU
+from lcd import LCD
+from localcore import LocalCore
+from recompiler import Recompiler
+from validator import LockstepValidator
+from exceptions.divergence_error import DivergenceError
+
+def make_rom():
+    # Copies ROM into work RAM in a loop, counting V-Blanks in B
+    rom_file = np.zeros(0x8000, dtype=np.uint8)
+    rom_file[0x0040:0x0042] = [0x04, 0xD9] # INC B; RETI
+    rom_file[0x0100:0x0114] = [
+        0x3E, 0x01,       # LD A, 0x01
+        0xE0, 0xFF,       # LDH (0xFF), A
+        0xFB,             # EI
+        0x21, 0x00, 0xC0, # LD HL, 0xC000 <-
+        0x11, 0x00, 0x00, # LD DE, 0x0000
+        0x1A,             # LD A, (DE) <-
+        0x3C,             # INC A
+        0x22,             # LD (HL+), A
+        0x13,             # INC DE
+        0xCB, 0x6C,       # BIT 5, H
+        0x28, 0xF8,       # JR Z, 0x010B
+        0x18              # JR 0x0105
+    ]
+    rom_file[0x0114] = 0xEF
+    rom_file[0x0010] = 0x7F
+    rom_file[0x1000:0x2000] = np.arange(0x1000) & 0xFF
+    return rom_file
+
+def make_cpu(rom_file, **options):
+    cpu = CPU(MMU(rom_file), **options)
+    LCD(cpu.mmu, cpu.scheduler)
+    return cpu
+
+@pytest.mark.parametrize('core', [CPU, LocalCore, Recompiler])
+def test_cores_agree(core):
+    rom_file = make_rom()
+    if (core is Recompiler):
+        # Blocks only take interrupts at their end, leave V-Blank disabled
+        rom_file[0x0101] = 0x00
+    reference = make_cpu(rom_file, specialise=False, decode_cache=False)
+    candidate = make_cpu(rom_file)
+    if (core is not CPU):
+        candidate = core(candidate)
+
+    validator = LockstepValidator(reference, candidate, 500)
+    validator.run(30000)
+    assert validator.steps == 30000
+    assert reference.get_reg_8('B') == (0 if core is Recompiler else 3)
+
+def test_divergence():
+    rom_file = make_rom()
+    reference = make_cpu(rom_file)
+    candidate = make_cpu(rom_file, decode_cache=False)
+
+    # INC A that gets 0x7F wrong, first read from 0x0010
+    inc_a = candidate.opcodes[0x3C]
+    def broken():
+        if (candidate.get_reg_8('A') == 0x7F):
+            candidate.set_reg_8('A', 0x00)
+        inc_a()
+    candidate.opcodes[0x3C] = broken
+
+    validator = LockstepValidator(reference, candidate, 1000)
+    with pytest.raises(DivergenceError) as error:
+        validator.run(5000)
+
+    assert error.value.pc == 0x010C
+    assert error.value.op == 0x3C
+    assert 'A' in error.value.differences
+    assert error.value.step == 5 + 16 * 6 + 2